@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""Throughput benchmark of rundbx and extract_dbx_best_poses with stub docking programs (see stubs/dbx_stub.py)
+
+For every number of ligands and of instances per program, a synthetic library is docked in library mode
+and the best poses are extracted. The time spent in the stub programs is read from their log so that the
+time spent in DockBox itself (overhead) can be isolated."""
+import os
+import sys
+import time
+import stat
+import shutil
+import argparse
+import subprocess
+
+import pandas as pd
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+rootdir = os.path.dirname(benchdir)
+
+stub_programs = ['prepare_ligand4.py', 'prepare_receptor4.py', 'prepare_gpf4.py', 'prepare_dpf4.py', 'autogrid4', 'autodock4', \
+'vina', 'babel', 'chimera', 'dms', 'sphgen_cpp', 'sphere_selector', 'showbox', 'grid', 'dock6', 'dsx', 'prepwizard', \
+'structconvert', 'mol2convert', 'glide', 'glide_sort']
+
+# options of each program making the stubs usable (e.g., no AMBER charges for DOCK 6)
+program_options = {'autodock': {'ga_run': '10'}, 'vina': {}, 'dock': {'charge_method': ''}, 'glide': {'use_prepwizard': 'yes'}}
+
+def create_stub_bindir(bindir):
+    """Create a folder with every stub program (to be put first in PATH)"""
+
+    stubfile = os.path.join(benchdir, 'stubs', 'dbx_stub.py')
+    os.chmod(stubfile, os.stat(stubfile).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    shutil.rmtree(bindir, ignore_errors=True)
+    os.makedirs(bindir)
+    for program in stub_programs:
+        os.symlink(stubfile, os.path.join(bindir, program))
+
+def write_library(template, filename, nligands):
+    """Write a library of nligands copies of the first structure of template with different names"""
+
+    with open(template, 'r') as tf:
+        lines = tf.readlines()
+    start = [idx for idx, line in enumerate(lines) if line.startswith('@<TRIPOS>MOLECULE')][0]
+    lines = lines[start:]
+
+    with open(filename, 'w') as mol2f:
+        for idx in range(nligands):
+            mol2f.write(lines[0])
+            mol2f.write('compound%i\n'%(idx+1))
+            mol2f.writelines(lines[2:])
+
+def write_config(filename, programs, ninstances, rescoring, center, boxsize):
+
+    instances = []
+    sections = ''
+    for program in programs:
+        for idx in range(ninstances):
+            instance = program
+            if idx > 0:
+                instance += str(idx)
+            instances.append(instance)
+            sections += '\n[%s]\n'%instance.upper()
+            for key, value in sorted(program_options[program].iteritems()):
+                sections += '%s = %s\n'%(key, value)
+
+    with open(filename, 'w') as cf:
+        cf.write('[DOCKING]\nprogram = %s\nrescoring = %s\nminimize = no\ncleanup = no\n'%(', '.join(instances), \
+'yes' if rescoring else 'no'))
+        if rescoring:
+            cf.write('\n[RESCORING]\nprogram = %s\n'%', '.join(rescoring))
+        cf.write(sections)
+        cf.write('\n[SITE]\ncenter = %s\nboxsize = %s\n'%(center, boxsize))
+
+def read_stub_log(logfile):
+    """Get number of calls and time spent in the stub programs"""
+
+    ncalls = 0
+    duration = 0.0
+    if os.path.isfile(logfile):
+        with open(logfile, 'r') as lf:
+            for line in lf:
+                ncalls += 1
+                duration += float(line.split()[2])
+    return ncalls, duration
+
+def count_files(workdir, excluded):
+    nfiles = 0
+    nbytes = 0
+    for dirpath, dirnames, filenames in os.walk(workdir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if path not in excluded:
+                nfiles += 1
+                nbytes += os.path.getsize(path)
+    return nfiles, nbytes
+
+def run_command(cmd, workdir, env, logfile):
+
+    t0 = time.time()
+    with open(logfile, 'w') as lf:
+        status = subprocess.call(cmd, cwd=workdir, env=env, stdout=lf, stderr=subprocess.STDOUT)
+    if status != 0:
+        sys.exit("Error: command %s failed, check %s file for more details!"%(' '.join(cmd), logfile))
+    return time.time() - t0
+
+def run_benchmark(args, nligands, ninstances, env):
+    """Dock a library of nligands with ninstances per program, returns the measures"""
+
+    workdir = os.path.join(args.workdir, 'lig%i_inst%i'%(nligands, ninstances))
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+
+    write_library(args.ligand, os.path.join(workdir, 'ligands.mol2'), nligands)
+    shutil.copyfile(args.receptor, os.path.join(workdir, 'receptor.pdb'))
+    write_config(os.path.join(workdir, 'config.ini'), args.programs, ninstances, args.rescoring, args.center, args.boxsize)
+
+    stublog = os.path.join(workdir, 'stubs.log')
+    env = dict(env, DBX_STUB_LOG=stublog)
+
+    cmd = [sys.executable, os.path.join(rootdir, 'bin', 'rundbx'), '-l', 'ligands.mol2', '-library', '-r', 'receptor.pdb', \
+'-f', 'config.ini', '-nprocs', str(args.nprocs)]
+    docking_time = run_command(cmd, workdir, env, os.path.join(workdir, 'rundbx.log'))
+    ncalls, external_time = read_stub_log(stublog)
+
+    excluded = [os.path.join(workdir, filename) for filename in ['ligands.mol2', 'receptor.pdb', 'config.ini', 'stubs.log', 'rundbx.log']]
+    nfiles, nbytes = count_files(workdir, excluded)
+
+    extraction_time = float('nan')
+    if args.rescoring:
+        cmd = [sys.executable, os.path.join(rootdir, 'bin', 'extract_dbx_best_poses'), '-dirs'] + \
+['lig%i'%(idx+1) for idx in range(nligands)] + ['-sf', args.rescoring[0]]
+        extraction_time = run_command(cmd, workdir, env, os.path.join(workdir, 'extract.log'))
+
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # external programs of different jobs overlap when more than one process is used
+    overhead = docking_time - external_time/args.nprocs
+    return {'nligands': nligands, 'ninstances': ninstances, 'nprocs': args.nprocs, 'docking_time': docking_time, \
+'external_time': external_time, 'external_calls': ncalls, 'overhead': overhead, 'overhead_per_ligand': overhead/nligands, \
+'files': nfiles, 'files_per_ligand': nfiles*1.0/nligands, 'bytes': nbytes, 'extraction_time': extraction_time}
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description="Benchmark throughput of rundbx and extract_dbx_best_poses with stub docking programs")
+
+    parser.add_argument('-n',
+        dest='nligands',
+        type=int,
+        nargs='+',
+        default=[1, 4, 16],
+        help='Numbers of ligands of the synthetic libraries. Default: 1 4 16')
+
+    parser.add_argument('-instances',
+        dest='ninstances',
+        type=int,
+        nargs='+',
+        default=[1, 2],
+        help='Numbers of instances of each docking program. Default: 1 2')
+
+    parser.add_argument('-programs',
+        dest='programs',
+        nargs='+',
+        choices=sorted(program_options),
+        default=['dock', 'vina'],
+        help='Docking programs. Default: dock vina')
+
+    parser.add_argument('-rescoring',
+        dest='rescoring',
+        nargs='*',
+        default=['dsx'],
+        help='Rescoring programs (no value for no rescoring). Default: dsx')
+
+    parser.add_argument('-delay',
+        dest='delay',
+        type=float,
+        default=0.05,
+        help='Time (s) taken by every call to a stub program. Default: 0.05')
+
+    parser.add_argument('-nposes',
+        dest='nposes',
+        type=int,
+        default=9,
+        help='Number of poses generated by the stub docking programs. Default: 9')
+
+    parser.add_argument('-nprocs',
+        dest='nprocs',
+        type=int,
+        default=1,
+        help='Number of processes used by rundbx. Default: 1')
+
+    parser.add_argument('-l',
+        dest='ligand',
+        default=os.path.join(rootdir, 'examples', 'autodock', 'docking', '1a30_ligand.mol2'),
+        help='Ligand used as a template for the libraries. Default: 1a30 example')
+
+    parser.add_argument('-r',
+        dest='receptor',
+        default=os.path.join(rootdir, 'examples', 'autodock', 'docking', '1a30_protein.pdb'),
+        help='Receptor. Default: 1a30 example')
+
+    parser.add_argument('-center',
+        dest='center',
+        default='37.092, 37.149, 29.264',
+        help='Center of the binding site. Default: center of the 1a30 example')
+
+    parser.add_argument('-boxsize',
+        dest='boxsize',
+        default='30.0, 30.0, 30.0',
+        help='Size of the binding site. Default: 30.0, 30.0, 30.0')
+
+    parser.add_argument('-workdir',
+        dest='workdir',
+        default='dbx_benchmark',
+        help='Folder where the benchmarks are run. Default: dbx_benchmark')
+
+    parser.add_argument('-keep',
+        dest='keep',
+        action='store_true',
+        default=False,
+        help='Keep the folders of each benchmark')
+
+    parser.add_argument('-o',
+        dest='output_file',
+        default='benchmark.csv',
+        help='.csv file with the results. Default: benchmark.csv')
+
+    return parser
+
+def main():
+    args = create_arg_parser().parse_args()
+    args.workdir = os.path.abspath(args.workdir)
+    args.ligand = os.path.abspath(args.ligand)
+    args.receptor = os.path.abspath(args.receptor)
+
+    bindir = os.path.join(args.workdir, 'bin')
+    create_stub_bindir(bindir)
+
+    env = dict(os.environ)
+    env['PATH'] = bindir + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = rootdir + os.pathsep + env.get('PYTHONPATH', '')
+    env['DBX_STUB_DELAY'] = str(args.delay)
+    env['DBX_STUB_NPOSES'] = str(args.nposes)
+
+    results = []
+    for ninstances in args.ninstances:
+        for nligands in args.nligands:
+            print "Running %i ligand(s) with %i instance(s) of %s..."%(nligands, ninstances, ', '.join(args.programs))
+            sys.stdout.flush()
+            results.append(run_benchmark(args, nligands, ninstances, env))
+
+    results = pd.DataFrame(results)
+    columns = ['nligands', 'ninstances', 'nprocs', 'docking_time', 'external_time', 'external_calls', 'overhead', \
+'overhead_per_ligand', 'files', 'files_per_ligand', 'bytes', 'extraction_time']
+    results[columns].to_csv(args.output_file, index=False, float_format='%.3f')
+
+    pd.set_option('display.width', 200)
+    print results[columns].to_string(index=False, float_format=lambda x: '%.2f'%x)
+    print "Results written in %s"%args.output_file
+
+if __name__ == '__main__':
+    main()
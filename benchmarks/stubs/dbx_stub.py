@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""Stand-in for the external programs called by DockBox (the program is given by the name the script is called with)
+
+Each call sleeps DBX_STUB_DELAY seconds (DBX_STUB_DELAY_<PROGRAM> for a specific program) and writes output files
+with the same names and formats as the real program so that DockBox extracts poses and scores as usual.
+DBX_STUB_NPOSES sets the number of poses generated by the docking programs. Every call is appended
+to the file DBX_STUB_LOG (program, start time, duration) if set."""
+import os
+import sys
+import time
+import random
+import shutil
+import hashlib
+
+def get_option(args, flag, default=None):
+    if flag in args and args.index(flag)+1 < len(args):
+        return args[args.index(flag)+1]
+    return default
+
+def get_format_option(args, prefix):
+    """Get format and filename given with babel-like flags (e.g., -imol2 file.mol2)"""
+
+    for idx, arg in enumerate(args):
+        if arg.startswith(prefix) and len(arg) > len(prefix) and idx+1 < len(args):
+            return arg[len(prefix):], args[idx+1]
+    return None, None
+
+def touch(filename, content=''):
+    with open(filename, 'w') as ff:
+        ff.write(content)
+
+def read_mol2(filename):
+    """Read atoms (name, x, y, z, type) of every structure of a .mol2 file"""
+
+    structures = []
+    section = None
+    with open(filename, 'r') as mol2f:
+        for line in mol2f:
+            if line.startswith('@<TRIPOS>'):
+                section = line.strip()
+                if section == '@<TRIPOS>MOLECULE':
+                    structures.append([])
+            elif section == '@<TRIPOS>ATOM' and line.strip():
+                fields = line.split()
+                structures[-1].append((fields[1], float(fields[2]), float(fields[3]), float(fields[4]), fields[5]))
+    return structures
+
+def write_mol2(mol2f, name, atoms):
+
+    mol2f.write('@<TRIPOS>MOLECULE\n%s\n%5i %5i %5i\nSMALL\nUSER_CHARGES\n\n@<TRIPOS>ATOM\n'%(name, len(atoms), 0, 1))
+    for idx, (atname, x, y, z, attype) in enumerate(atoms):
+        mol2f.write('%7i %-8s %10.4f %10.4f %10.4f %-6s %4i %-6s %9.4f\n'%(idx+1, atname, x, y, z, attype, 1, 'LIG', 0.0))
+    mol2f.write('@<TRIPOS>BOND\n')
+
+def read_pdbqt(filename, prefix=''):
+    """Read atoms of every model of a .pdbqt file (or of a .dlg file with prefix 'DOCKED: ')"""
+
+    models = []
+    atoms = []
+    with open(filename, 'r') as pdbqtf:
+        for line in pdbqtf:
+            if not line.startswith(prefix):
+                continue
+            line = line[len(prefix):]
+            if line.startswith(('ATOM', 'HETATM')):
+                atoms.append((line[12:16].strip(), float(line[30:38]), float(line[38:46]), float(line[46:54]), line[77:79].strip() or 'C'))
+            elif line.startswith('ENDMDL') and atoms:
+                models.append(atoms)
+                atoms = []
+    if atoms:
+        models.append(atoms)
+    return models
+
+def write_pdbqt_atoms(ff, atoms, prefix=''):
+    for idx, (atname, x, y, z, attype) in enumerate(atoms):
+        ff.write('%sATOM  %5i %-4s LIG     1    %8.3f%8.3f%8.3f  1.00  0.00     0.000 %-2s\n'%(prefix, idx+1, atname[:4], x, y, z, attype.split('.')[0][:2]))
+
+def generate_poses(atoms, nposes):
+    """Generate poses by small random translations of the input structure, scores are sorted"""
+
+    poses = []
+    for idx in range(nposes):
+        shift = [random.uniform(-1.0, 1.0) for jdx in range(3)]
+        poses.append([(name, x+shift[0], y+shift[1], z+shift[2], attype) for name, x, y, z, attype in atoms])
+    scores = sorted(random.uniform(-12.0, -4.0) for idx in range(nposes))
+    return poses, scores
+
+def get_nposes():
+    return int(os.environ.get('DBX_STUB_NPOSES', '9'))
+
+def run_prepare_ligand4(args):
+    atoms = read_mol2(get_option(args, '-l'))[0]
+    with open(get_option(args, '-o'), 'w') as ff:
+        ff.write('REMARK  4 active torsions:\nROOT\n')
+        write_pdbqt_atoms(ff, atoms)
+        ff.write('ENDROOT\nTORSDOF 4\n')
+
+def run_prepare_receptor4(args):
+    with open(get_option(args, '-r'), 'r') as pdbf:
+        with open(get_option(args, '-o'), 'w') as ff:
+            for line in pdbf:
+                if line.startswith(('ATOM', 'HETATM')):
+                    ff.write(line[:66].ljust(70) + '  0.000 ' + line[76:78].strip() + '\n')
+
+def run_prepare_gpf4(args):
+    touch(get_option(args, '-o'), 'npts 100 100 100\nspacing 0.3\ngridfld target.maps.fld\n')
+
+def run_prepare_dpf4(args):
+    touch(get_option(args, '-o'), 'autodock_parameter_version 4.2\nabout 0.0 0.0 0.0\ntorsdof 4\nga_run 10\nanalysis\n')
+
+def run_autogrid4(args):
+    touch(get_option(args, '-l'), 'autogrid4: Successful Completion.\n')
+    touch('target.maps.fld')
+
+def run_autodock4(args):
+    dlgfile = get_option(args, '-l')
+    with open(get_option(args, '-p'), 'r') as dpff:
+        is_rescoring = 'epdb' in dpff.read()
+
+    with open(dlgfile, 'w') as dlgf:
+        if is_rescoring:
+            dlgf.write('epdb: USER    Estimated Free Energy of Binding    =   %.2f kcal/mol\n'%random.uniform(-12.0, -4.0))
+        else:
+            atoms = read_pdbqt('ligand.pdbqt')[0]
+            poses, scores = generate_poses(atoms, get_nposes())
+            for idx, (pose, score) in enumerate(zip(poses, scores)):
+                dlgf.write('DOCKED: MODEL        %i\n'%(idx+1))
+                dlgf.write('DOCKED: USER    Estimated Free Energy of Binding    =   %.2f kcal/mol\n'%score)
+                write_pdbqt_atoms(dlgf, pose, prefix='DOCKED: ')
+                dlgf.write('DOCKED: ENDMDL\n')
+            dlgf.write('\n    CLUSTERING HISTOGRAM\n')
+
+def run_vina(args):
+    if '--score_only' in args:
+        sys.stdout.write('Affinity: %.5f (kcal/mol)\n'%random.uniform(-12.0, -4.0))
+        return
+
+    options = {}
+    with open(get_option(args, '--config'), 'r') as cf:
+        for line in cf:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                options[key.strip()] = value.strip()
+
+    atoms = read_pdbqt(options['ligand'])[0]
+    poses, scores = generate_poses(atoms, int(options.get('num_modes', get_nposes())))
+    outputfile = options.get('out', os.path.splitext(options['ligand'])[0] + '_out.pdbqt')
+    with open(outputfile, 'w') as ff:
+        for idx, (pose, score) in enumerate(zip(poses, scores)):
+            ff.write('MODEL %i\nREMARK VINA RESULT:    %.1f      0.000      0.000\n'%(idx+1, score))
+            write_pdbqt_atoms(ff, pose)
+            ff.write('ENDMDL\n')
+
+def run_babel(args):
+    informat, inputfile = get_format_option(args, '-i')
+    outformat, outputfile = get_format_option(args, '-o')
+
+    if informat == 'mol2':
+        structures = read_mol2(inputfile)
+        if '-d' in args:
+            # remove hydrogens
+            structures = [[atom for atom in atoms if not atom[0].upper().startswith('H')] for atoms in structures]
+    elif informat == 'pdbqt' and inputfile.endswith('.dlg'):
+        structures = read_pdbqt(inputfile, prefix='DOCKED: ')
+    else:
+        structures = read_pdbqt(inputfile)
+
+    if '-m' in args:
+        base, ext = os.path.splitext(outputfile)
+        for idx, atoms in enumerate(structures):
+            with open(base + str(idx+1) + ext, 'w') as mol2f:
+                write_mol2(mol2f, 'LIG', atoms)
+    else:
+        with open(outputfile, 'w') as mol2f:
+            for atoms in structures:
+                write_mol2(mol2f, 'LIG', atoms)
+
+def run_dock_tools(name, args):
+    """Receptor and grid preparation tools of DOCK 6 (chimera, dms, sphgen_cpp, sphere_selector, showbox, grid)"""
+
+    if name == 'chimera':
+        if args[-1] == 'removeH.cmd':
+            touch('target_noH.pdb')
+        else:
+            touch('target.mol2')
+    elif name == 'dms':
+        touch(get_option(args, '-o'))
+    elif name == 'sphgen_cpp':
+        touch('target_noH_site.sph')
+    elif name == 'sphere_selector':
+        touch('selected_spheres.sph')
+    elif name == 'showbox':
+        touch('target_noH_box.pdb')
+    elif name == 'grid':
+        touch('grid.nrg')
+        touch('grid.bmp')
+
+def run_dock6(args):
+    options = {}
+    with open(get_option(args, '-i'), 'r') as inf:
+        for line in inf:
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                options[fields[0]] = fields[1].strip()
+
+    structures = read_mol2(options['ligand_atom_file'])
+    if options.get('orient_ligand') == 'yes':
+        poses, scores = generate_poses(structures[0], get_nposes())
+        with open(options['ligand_outfile_prefix'] + '_scored.mol2', 'w') as mol2f:
+            for pose, score in zip(poses, scores):
+                mol2f.write('##########    Grid Score:     %.6f\n\n'%(score*5))
+                write_mol2(mol2f, 'LIG', pose)
+    else:
+        # rescoring
+        for atoms in structures:
+            sys.stdout.write('                    Grid Score:     %.6f\n'%random.uniform(-60.0, -20.0))
+
+def run_dsx(args):
+    touch(get_option(args, '-F'), ' 0 | protein | ligand | %.3f | 0.000\n'%random.uniform(-200.0, -50.0))
+
+def run_schrodinger_tools(name, args):
+    """Schrodinger tools (prepwizard, structconvert, mol2convert, glide, glide_sort), Maestro files are faked as .mol2 files"""
+
+    if name == 'prepwizard':
+        touch(args[-1])
+    elif name in ['structconvert', 'mol2convert']:
+        informat, inputfile = get_format_option(args, '-i')
+        outformat, outputfile = get_format_option(args, '-o')
+        if informat in ['mol2', 'mae']:
+            shutil.copyfile(inputfile, outputfile)
+        else:
+            touch(outputfile)
+    elif name == 'glide_sort':
+        shutil.copyfile(args[-3], get_option(args, '-o'))
+    elif name == 'glide':
+        with open(args[-1], 'r') as inf:
+            content = inf.read()
+        if 'LIGANDFILE' in content:
+            ligfile = [line.split()[1] for line in content.splitlines() if line.startswith('LIGANDFILE')][0]
+            poses, scores = generate_poses(read_mol2(ligfile)[0], get_nposes())
+            with open('dock_pv.maegz', 'w') as mol2f:
+                for pose in poses:
+                    write_mol2(mol2f, 'LIG', pose)
+            with open('dock.rept', 'w') as reptf:
+                reptf.write('    Rank Title   Lig#  Score  GScore\n====\n')
+                for idx, score in enumerate(scores):
+                    reptf.write('%-43s%8.2f\n'%('    %i  LIG  1'%(idx+1), score))
+                reptf.write('\n')
+        else:
+            touch('grid.zip')
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+
+    delay = float(os.environ.get('DBX_STUB_DELAY_' + name.upper().split('.')[0], os.environ.get('DBX_STUB_DELAY', '0.1')))
+    # scores and poses are reproducible for a given folder and command
+    random.seed(hashlib.md5((os.getcwd() + ' '.join(sys.argv)).encode('utf-8')).hexdigest())
+
+    start = time.time()
+    time.sleep(delay)
+
+    if name == 'prepare_ligand4.py':
+        run_prepare_ligand4(args)
+    elif name == 'prepare_receptor4.py':
+        run_prepare_receptor4(args)
+    elif name == 'prepare_gpf4.py':
+        run_prepare_gpf4(args)
+    elif name == 'prepare_dpf4.py':
+        run_prepare_dpf4(args)
+    elif name == 'autogrid4':
+        run_autogrid4(args)
+    elif name == 'autodock4':
+        run_autodock4(args)
+    elif name == 'vina':
+        run_vina(args)
+    elif name == 'babel':
+        run_babel(args)
+    elif name in ['chimera', 'dms', 'sphgen_cpp', 'sphere_selector', 'showbox', 'grid']:
+        run_dock_tools(name, args)
+    elif name == 'dock6':
+        run_dock6(args)
+    elif name == 'dsx':
+        run_dsx(args)
+    elif name in ['prepwizard', 'structconvert', 'mol2convert', 'glide', 'glide_sort']:
+        run_schrodinger_tools(name, args)
+    else:
+        sys.exit("Unknown program %s"%name)
+
+    logfile = os.environ.get('DBX_STUB_LOG')
+    if logfile:
+        with open(logfile, 'a') as lf:
+            lf.write('%s %.6f %.6f\n'%(name, start, time.time() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import shutil
+from glob import glob
+
+import cache
+import configure
+import profiling
+
+# folder where the records of every process are written (inherited by worker processes)
+env_accountingdir = 'DBX_ACCOUNTING_DIR'
+
+# folders of the records written while the run is traced, profiled or accounted (not counted as created files)
+env_recorddirs = ['DBX_TRACE_DIR', profiling.env_profiledir, env_accountingdir]
+
+# size of the blocks counted in ru_inblock/ru_oublock
+block_size = 512
+
+# pid of the current process and stack of the stages being run
+pid = None
+stack = []
+
+def is_enabled():
+    return env_accountingdir in os.environ
+
+def enable(accountingdir):
+    """Enable accounting, records are written in accountingdir until they are merged with write_summary"""
+
+    accountingdir = os.path.abspath(accountingdir)
+    shutil.rmtree(accountingdir, ignore_errors=True)
+    os.makedirs(accountingdir)
+    os.environ[env_accountingdir] = accountingdir
+
+def check_process():
+    """Discard the stages inherited from the parent process (worker processes)"""
+    global pid, stack
+
+    if pid != os.getpid():
+        pid = os.getpid()
+        stack = []
+
+def add_record(record):
+
+    # every process has its own file so that no lock is needed
+    with open(os.path.join(os.environ[env_accountingdir], 'records-%i.jsonl'%os.getpid()), 'a') as rf:
+        rf.write(json.dumps(record) + '\n')
+
+def get_written_bytes():
+    """Bytes written to storage by the current process (Linux only, 0 otherwise)"""
+
+    try:
+        with open('/proc/self/io', 'r') as iof:
+            for line in iof:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+def get_file_time():
+    """Get current time of the file system where the records are written (compared with the modification times of the files)"""
+    return cache.get_shared_time(os.path.join(os.environ[env_accountingdir], 'clock-%i'%os.getpid()))
+
+def list_files(workdir, since):
+    """Get size of every file in workdir modified since time since (time of the file system)"""
+
+    recorddirs = [os.environ[name] for name in env_recorddirs if name in os.environ]
+
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(workdir):
+        dirnames[:] = [dirname for dirname in dirnames if os.path.join(dirpath, dirname) not in recorddirs]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # file removed in the meantime
+                continue
+            if stat.st_mtime >= since:
+                files[path] = stat.st_size
+    return files
+
+def start(category, name, workdir):
+    """Start accounting of a stage, files created in workdir are counted"""
+
+    if not is_enabled():
+        return
+    check_process()
+
+    stack.append({'category': category, 'name': name, 'workdir': workdir, 'start': time.time(), 'file_time': get_file_time(), \
+'written_bytes': get_written_bytes(), 'jobs': []})
+
+def stop():
+    """Stop accounting of the current stage and record the resources it used"""
+
+    if not is_enabled():
+        return
+    check_process()
+    if not stack:
+        return
+
+    stage = stack.pop()
+    # files are listed once per stage, files written again (e.g., folder removed and created again) are also counted
+    created = list_files(stage['workdir'], stage['file_time'])
+
+    # resources of the commands are also counted in the enclosing stages
+    jobs = stage['jobs']
+    if stack:
+        stack[-1]['jobs'].extend(jobs)
+
+    record = {'type': 'stage', 'category': stage['category'], 'name': stage['name'], 'wall': time.time() - stage['start'], \
+'processes': len(jobs), 'utime': sum(job['utime'] for job in jobs), 'stime': sum(job['stime'] for job in jobs), \
+'maxrss': max([job['maxrss'] for job in jobs] or [0]), 'files_created': len(created), \
+'bytes_created': sum(created.values()), 'bytes_written': get_written_bytes() - stage['written_bytes'] + \
+sum(job['bytes_written'] for job in jobs)}
+    add_record(record)
+
+def add_job(cmd, wall, rusage):
+    """Record resources used by a command (rusage as returned by os.wait4)"""
+
+    if not is_enabled():
+        return
+    check_process()
+
+    job = {'type': 'job', 'cmd': cmd, 'wall': wall, 'utime': rusage.ru_utime, 'stime': rusage.ru_stime, \
+'maxrss': rusage.ru_maxrss, 'bytes_read': rusage.ru_inblock*block_size, 'bytes_written': rusage.ru_oublock*block_size}
+    if stack:
+        job['category'] = stack[-1]['category']
+        job['name'] = stack[-1]['name']
+        stack[-1]['jobs'].append(job)
+    add_record(job)
+
+def write_summary(filename):
+    """Merge the records of every process in a JSON file with the resources used per stage and per program"""
+
+    while stack:
+        stop()
+    accountingdir = os.environ.pop(env_accountingdir)
+
+    records = []
+    for recordsfile in sorted(glob(accountingdir + '/records-*.jsonl')):
+        with open(recordsfile, 'r') as rf:
+            for line in rf:
+                records.append(json.loads(line))
+    shutil.rmtree(accountingdir, ignore_errors=True)
+
+    programs = configure.known_programs['docking'] + configure.known_programs['rescoring']
+    summary = {'stages': {}, 'programs': {}, 'jobs': [record for record in records if record['type'] == 'job']}
+
+    for record in records:
+        if record['type'] != 'stage':
+            continue
+        keys = [('stages', record['category'] + ':' + record['name'])]
+        # stages of docking and rescoring programs do not overlap (see DockingMethod)
+        if record['category'] in programs:
+            keys.append(('programs', record['category']))
+
+        for table, key in keys:
+            totals = summary[table].setdefault(key, {'count': 0, 'wall': 0.0, 'processes': 0, 'utime': 0.0, 'stime': 0.0, 'maxrss': 0, \
+'files_created': 0, 'bytes_created': 0, 'bytes_written': 0})
+            totals['count'] += 1
+            totals['maxrss'] = max(totals['maxrss'], record['maxrss'])
+            for column in ['wall', 'processes', 'utime', 'stime', 'files_created', 'bytes_created', 'bytes_written']:
+                totals[column] += record[column]
+
+    with open(filename, 'w') as sf:
+        json.dump(summary, sf, indent=1, sort_keys=True)
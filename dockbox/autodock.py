@@ -1,11 +1,12 @@
 import os
 import sys
-import subprocess
 import shutil
 from glob import glob
 
 from mdkit.utility import mol2
 import method
+import runner
+import tracing
 
 required_programs = ['prepare_ligand4.py', 'prepare_receptor4.py', 'prepare_dpf4.py', 'prepare_gpf4.py', 'autogrid4', 'autodock4', 'babel']
 
@@ -13,15 +14,25 @@ default_settings = {'ga_run': '100', 'spacing': '0.3'}
 
 class ADBased(method.DockingMethod):
 
+    # raised by check_ions.py when no charge is known for an ion of the receptor
+    deterministic_failures = ['AssertionError']
+
+    def get_receptor_files(self):
+        return ['target.pdbqt']
+
     def write_rescoring_script(self, filename, file_r, file_l):
         self.write_docking_script(filename, file_r, file_l, rescoring=True)
 
-    def update_output_mol2files(self, sample=None):
-        nfiles = len(glob('pose-*.mol2'))
+    def update_output_mol2files(self, convert_cmd, sample=None):
+        """Convert output structures in pose-N.mol2 files with convert_cmd and update them"""
 
-        mgltools_path = subprocess.check_output('which prepare_ligand4.py', shell=True, executable='/bin/bash')
+        # MGLTools path is looked up while the poses are converted
+        jobs = [runner.submit(convert_cmd), runner.submit('which prepare_ligand4.py')]
+        mgltools_path = runner.check_jobs(jobs)[1]
         mgltools_path = '/'.join(mgltools_path.split('/')[:-3]) 
 
+        nfiles = len(glob('pose-*.mol2'))
+
         for idx in range(nfiles):
             mol2file = 'pose-%s.mol2'%(idx+1)
             mol2.update_mol2file(mol2file, mol2file, ADupdate=sample, unique=True, mask=['h','H'])
@@ -106,7 +117,7 @@ if are_unrecognized_residues:
                 if line.startswith(('ATOM', 'HETATM')):
                     resname = line[17:20].strip()
                     if resname in unrecognized_residues:
-                        assert resname in ions_amber
+                        assert resname in ions_amber, "no formal charge known for ion " + resname
                         charge = "%.3f"%ions_amber[resname]
                         is_ion = True
 
@@ -172,28 +183,37 @@ print \'-p ga_num_evals=%i\'%ga_num_evals\"`"""
             else:
                 ga_num_evals_lines=""
  
+            stage_functions = tracing.script_functions
+
             # write autodock script
             with open(filename, 'w') as ff:
                 script ="""#!/bin/bash
 set -e
+%(stage_functions)s
 
 MGLPATH=`which prepare_ligand4.py`
 MGLPATH=`python -c "print '/'.join('$MGLPATH'.split('/')[:-3])"`
 export PYTHONPATH=$PYTHONPATH:$MGLPATH
 
 # prepare ligand
+dbx_stage ligand_preparation
 prepare_ligand4.py -l %(file_l)s -o ligand.pdbqt
 python check_ligand_pdbqt.py ligand.pdbqt
 
-# prepare receptor
-prepare_receptor4.py -U nphs_lps_waters -r %(file_r)s -o target.pdbqt &> prepare_receptor4.log
-python check_ions.py target.pdbqt prepare_receptor4.log
+# prepare receptor (unless already taken from the cache)
+dbx_stage receptor_preparation
+if [ ! -f target.pdbqt ]; then
+  prepare_receptor4.py -U nphs_lps_waters -r %(file_r)s -o target.pdbqt &> prepare_receptor4.log
+  python check_ions.py target.pdbqt prepare_receptor4.log
+fi
 
 # run autogrid
+dbx_stage grid_generation
 prepare_gpf4.py -l ligand.pdbqt -r target.pdbqt -o grid.gpf %(autogrid_options_flag)s
 autogrid4 -p grid.gpf -l grid.glg
 
 # prepare .dpf file
+dbx_stage docking
 %(ga_num_evals_lines)s
 prepare_dpf4.py -l ligand.pdbqt -r target.pbdqt -o dock.dpf -p move=ligand.pdbqt %(autodock_options_flag)s $ga_num_evals_flag
 
@@ -246,8 +266,7 @@ autodock4 -p dock.dpf -l dock.dlg"""% locals()
         poses_extracted = False
         if os.path.exists('dock.dlg'):
             try:
-                subprocess.check_output('babel -ad -ipdbqt dock.dlg -omol2 pose-.mol2 -m &>/dev/null', shell=True, executable='/bin/bash')
-                self.update_output_mol2files(sample=input_file_l)
+                self.update_output_mol2files('babel -ad -ipdbqt dock.dlg -omol2 pose-.mol2 -m &>/dev/null', sample=input_file_l)
                 poses_extracted = True
             except:
                 for mol2file in glob('pose-*.mol2'):
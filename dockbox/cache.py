@@ -0,0 +1,256 @@
+import os
+import stat
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# hashes of files already read (key: absolute path, size and modification time)
+file_hashes = {}
+
+def get_file_hash(filename):
+    """Get SHA1 hash of the content of a file"""
+
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_size, st.st_mtime)
+
+    if key not in file_hashes:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as ff:
+            for chunk in iter(lambda: ff.read(1048576), ''):
+                sha1.update(chunk)
+        file_hashes[key] = sha1.hexdigest()
+    return file_hashes[key]
+
+def get_hash(*items):
+    """Get SHA1 hash of any (JSON serializable) items"""
+    return hashlib.sha1(json.dumps(items, sort_keys=True)).hexdigest()
+
+class FileLock(object):
+    """Exclusive lock on a file (valid between processes)"""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __enter__(self):
+        self.file = open(self.filename, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+def get_shared_time(filename):
+    """Get current time of the file system where filename is stored (filename is touched)
+
+    Times written by processes of different hosts are compared with this clock rather than with the
+    clocks of the hosts, which may differ (on NFS, the time is set by the server)."""
+
+    with open(filename, 'a'):
+        pass
+    os.utime(filename, None)
+    return os.stat(filename).st_mtime
+
+class ArtifactCache(object):
+    """Content-addressed cache of files. Each entry is a folder <cachedir>/<kind>/<key> which is never modified once created.
+
+    Entries are written in a temporary folder and renamed so that concurrent processes never see incomplete entries.
+    When the size of the cache exceeds max_size (in MB), the least recently used entries are removed."""
+
+    kind = 'artifacts'
+
+    def __init__(self, cachedir, max_size=0):
+
+        self.cachedir = os.path.abspath(cachedir)
+        self.max_size = max_size
+
+        self.entriesdir = os.path.join(self.cachedir, self.kind)
+        if not os.path.isdir(self.entriesdir):
+            try:
+                os.makedirs(self.entriesdir)
+            except OSError:
+                # folder created by another process in the meantime
+                if not os.path.isdir(self.entriesdir):
+                    raise
+
+        self.lockfile = os.path.join(self.cachedir, self.kind + '.lock')
+        self.sizefile = os.path.join(self.cachedir, self.kind + '.size')
+
+    def get_entry(self, key):
+        return os.path.join(self.entriesdir, key)
+
+    def fetch(self, key, filenames, destdir='.'):
+        """Link files of entry key in destdir, returns True if every file was found"""
+
+        entry = self.get_entry(key)
+        if not os.path.isdir(entry):
+            return False
+
+        try:
+            for filename in filenames:
+                dest = os.path.join(destdir, filename)
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                try:
+                    os.link(os.path.join(entry, filename), dest)
+                except OSError:
+                    # different file systems
+                    shutil.copyfile(os.path.join(entry, filename), dest)
+            # update time of last use
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # entry incomplete or evicted in the meantime
+            for filename in filenames:
+                if os.path.lexists(os.path.join(destdir, filename)):
+                    os.remove(os.path.join(destdir, filename))
+            return False
+        return True
+
+    def store(self, key, filenames, srcdir='.'):
+        """Store files of srcdir in entry key"""
+
+        entry = self.get_entry(key)
+        if os.path.isdir(entry):
+            return
+
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.entriesdir)
+        size = 0
+        try:
+            for filename in filenames:
+                dest = os.path.join(tmpdir, filename)
+                shutil.copyfile(os.path.join(srcdir, filename), dest)
+                # files are shared between runs, prevent any modification in place
+                os.chmod(dest, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                size += os.path.getsize(dest)
+        except:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+
+        with FileLock(self.lockfile):
+            if os.path.isdir(entry):
+                # stored by another process in the meantime
+                shutil.rmtree(tmpdir, ignore_errors=True)
+                return
+            os.rename(tmpdir, entry)
+            self.update_size(size)
+
+    def get_entry_size(self, entry):
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(entry):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+        return size
+
+    def get_size(self):
+        """Get total size of entries in bytes from the entries themselves"""
+
+        size = 0
+        for key in os.listdir(self.entriesdir):
+            if not key.startswith('.tmp-'):
+                size += self.get_entry_size(self.get_entry(key))
+        return size
+
+    def update_size(self, shift):
+        """Update total size of entries and evict the least recently used entries if needed (lock should be held)"""
+
+        size = None
+        if os.path.isfile(self.sizefile):
+            with open(self.sizefile, 'r') as sf:
+                try:
+                    size = int(sf.read()) + shift
+                except ValueError:
+                    pass
+        if size is None:
+            size = self.get_size()
+
+        max_size = self.max_size * 1048576
+        if max_size > 0 and size > max_size:
+            entries = []
+            for key in os.listdir(self.entriesdir):
+                entry = self.get_entry(key)
+                if not key.startswith('.tmp-'):
+                    entries.append((os.path.getmtime(entry), entry))
+
+            # remove entries until the cache is 10% below its maximum size
+            for mtime, entry in sorted(entries):
+                if size <= 0.9*max_size:
+                    break
+                size -= self.get_entry_size(entry)
+                shutil.rmtree(entry, ignore_errors=True)
+
+        with open(self.sizefile, 'w') as sf:
+            sf.write(str(max(size, 0)))
+
+class ReceptorCache(ArtifactCache):
+    """Cache of receptor files (target.pdbqt, target.mol2, target_noH.ms, target.mae,...) prepared by the docking programs"""
+
+    kind = 'receptors'
+
+    def get_key(self, file_r, filenames, options):
+        return get_hash(get_file_hash(file_r), sorted(filenames), options)
+
+class ResultCache(ArtifactCache):
+    """Cache of docking results (pose-*.mol2 and score.out files) and of deterministic failures"""
+
+    kind = 'results'
+    failure_file = 'failure.log'
+
+    def get_key(self, file_r, file_l, program, site, options, minimize_options, filter_options):
+        return get_hash(get_file_hash(file_r), get_file_hash(file_l), program, site, options, minimize_options, filter_options)
+
+    def fetch_results(self, key, destdir='.'):
+        """Link the files of entry key in destdir, returns the list of files linked or None if the entry is not found"""
+
+        entry = self.get_entry(key)
+        try:
+            filenames = sorted(os.listdir(entry))
+        except OSError:
+            return None
+
+        if self.fetch(key, filenames, destdir=destdir):
+            return filenames
+        return None
+
+    def store_failure(self, key, logfile):
+        """Store the log file of a failure which would occur again with the same inputs"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            shutil.copyfile(logfile, os.path.join(tmpdir, self.failure_file))
+            self.store(key, [self.failure_file], srcdir=tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+class TransformCache(ArtifactCache):
+    """Cache of the transforms (rotation and translations) superimposing a target onto another one"""
+
+    kind = 'transforms'
+    transform_file = 'transform.txt'
+
+    def get_key(self, file_r1, file_r2):
+        return get_hash(get_file_hash(file_r1), get_file_hash(file_r2))
+
+    def fetch_transform(self, key):
+        """Get the transform of entry key as (rotation, trans1, trans2), None if the entry is not found"""
+
+        entry = self.get_entry(key)
+        try:
+            transform = np.loadtxt(os.path.join(entry, self.transform_file), ndmin=2)
+            # update time of last use
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return transform[:3], transform[3], transform[4]
+
+    def store_transform(self, key, transform):
+
+        rotation, trans1, trans2 = transform
+        tmpdir = tempfile.mkdtemp()
+        try:
+            np.savetxt(os.path.join(tmpdir, self.transform_file), np.vstack([rotation, trans1, trans2]), fmt='%.17g')
+            self.store(key, [self.transform_file], srcdir=tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
@@ -3,6 +3,8 @@ import sys
 from glob import glob
 import subprocess
 
+import license
+
 known_programs = {'docking': ['autodock', 'vina', 'dock', 'glide', 'moe', 'gold'], \
      'rescoring': ['autodock', 'vina', 'dock', 'glide', 'moe', 'dsx', 'colvar']}
 known_programs['scoring'] = known_programs['rescoring']
@@ -12,6 +14,8 @@ programs_handling_ions = ['autodock', 'vina', 'dock']
 
 default_minimize_options = {'charge_method': 'gas', 'ncyc': 1000, 'maxcyc': 2000, 'cut': 999.0, 'solvent': 'vacuo'}
 
+default_filter_options = {'box': True, 'max_extent': None, 'clash_distance': None, 'max_score': None}
+
 path_options = {'dock': ['grid_dir']}
 
 class ConfigSetup(object):
@@ -137,6 +141,28 @@ Make sure the program has been installed and is in your PATH!'%(exe, program))
         else:
             return default
 
+    def get_value_integer_option(self, config, section, option, default=0):
+
+        if config.has_option(section, option):
+            value = config.get(section, option)
+            try:
+                return int(value)
+            except ValueError:
+                raise ValueError("option %s in section %s should be an integer!"%(option, section))
+        else:
+            return default
+
+    def get_value_float_option(self, config, section, option, default=0.0):
+
+        if config.has_option(section, option):
+            value = config.get(section, option)
+            try:
+                return float(value)
+            except ValueError:
+                raise ValueError("option %s in section %s should be a number!"%(option, section))
+        else:
+            return default
+
     def get_value_cleanup_option(self, config, section, default=0):
 
         if config.has_option(section, 'cleanup'):
@@ -160,6 +186,41 @@ class DockingSetup(ConfigSetup):
 
         self.cleanup = self.get_value_cleanup_option(config, 'DOCKING')
         self.minimize = self.set_minimization_options(config)
+        self.set_filter_options(config)
+        self.set_cache_options(config)
+        # store poses folder as a pose archive instead of pose-*.mol2 files (see posestore.py)
+        self.pose_archive = self.get_value_yesno_option(config, 'DOCKING', 'pose_archive')
+
+    def set_cache_options(self, config):
+        """set options for the cache of receptor files shared between runs"""
+
+        if config.has_option('DOCKING', 'cache_dir'):
+            self.cache_dir = os.path.abspath(os.path.expanduser(config.get('DOCKING', 'cache_dir')))
+        else:
+            self.cache_dir = None
+        # maximum size of the cache in MB (0 means no limit)
+        self.cache_max_size = self.get_value_integer_option(config, 'DOCKING', 'cache_max_size')
+        # reuse docking results obtained with the same inputs
+        self.cache_results = self.get_value_yesno_option(config, 'DOCKING', 'cache_results', default=True)
+
+    def set_filter_options(self, config):
+        """set options of the filters applied to the poses of each instance (FILTERING section)"""
+
+        section = 'FILTERING'
+        self.filter_options = dict(default_filter_options)
+        self.filter_options['box'] = self.get_value_yesno_option(config, section, 'box', default=True)
+
+        if config.has_section(section):
+            instances = [instance for instance, program, options in self.instances]
+            for key, value in config.items(section):
+                # max_score.<instance> sets the score threshold of a single instance
+                if key in ['max_extent', 'clash_distance', 'max_score'] or (key.startswith('max_score.') and key[10:] in instances):
+                    try:
+                        self.filter_options[key] = float(value)
+                    except ValueError:
+                        raise ValueError("option %s in section %s should be a number!"%(key, section))
+                elif key != 'box':
+                    raise ValueError("option %s in section %s not recognized!"%(key, section))
 
     def set_minimization_options(self, config):
         """set options for minimization"""
@@ -214,6 +275,30 @@ class RescoringSetup(ConfigSetup):
 
         if self.is_rescoring:
             super(RescoringSetup, self).__init__('rescoring', config)
+            self.nworkers = self.get_value_integer_option(config, 'RESCORING', 'nworkers', default=1)
+            # poses closer than cluster_rmsd (heavy-atom RMSD in A) are rescored only once (0: no clustering)
+            self.cluster_rmsd = self.get_value_float_option(config, 'RESCORING', 'cluster_rmsd', default=0.0)
+
+class LicenseSetup(object):
+    """set number of license tokens available per vendor (LICENSE section)"""
+
+    def __init__(self, config):
+
+        section = 'LICENSE'
+        self.tokens = {}
+        self.token_dir = None
+
+        if config.has_section(section):
+            for key, value in config.items(section):
+                if key == 'token_dir':
+                    self.token_dir = os.path.abspath(os.path.expanduser(value))
+                elif key in license.vendors:
+                    try:
+                        self.tokens[key] = int(value)
+                    except ValueError:
+                        raise ValueError("option %s in section %s should be an integer!"%(key, section))
+                else:
+                    raise ValueError("Option %s not recognized in section %s!"%(key, section))
 
 class ScoringSetup(ConfigSetup):
     pass
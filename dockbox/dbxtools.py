@@ -4,14 +4,22 @@ import math
 import numpy as np
 import nwalign as nw
 
-from mdkit.utility import mol2
+from collections import OrderedDict
+
 from dockbox import pyqcprot
+from dockbox import posestore
+from dockbox import cache
+from dockbox import parallel
 
 # prefix to identify ligand, target and isomer directories
 ligdir_prefix = 'lig'
 tardir_prefix = 'target'
 isodir_prefix = 'isomer'
 
+# heavy-atom coordinates of the poses last used (absolute path, modification time) -> array
+coords_cache = OrderedDict()
+coords_cache_size = 4096
+
 residues_3_to_1 = {'ALA': 'A',
 'ARG': 'R',
 'ASN': 'N',
@@ -43,144 +51,248 @@ equivalent_residues = {'CYM': 'CYS',
 'HIE': 'HIS',
 'HIP': 'HIS'}
 
-def get_total_residue_number(filename):
-    indices = []
-    nresidues = 0
-    with open(filename, 'r') as pdbf:
-        for line in pdbf:
-            if line.startswith('ATOM'):
-                resnum = line[22:26].strip()
-                if resnum not in indices:
-                    indices.append(resnum)
-                    nresidues += 1
-    return nresidues
+# backbone atoms used to superimpose targets
+backbone_atoms = ['CA', 'C', 'N', 'O']
 
-def get_sequence_from_PDB(filename):
+# receptors already parsed (absolute path, modification time) -> dict (see read_receptor)
+receptors = {}
+
+def read_receptor(filename):
+    """Read the ATOM records of a PDB file in a single pass (once per file), returns a dict with the number of residues,
+    the sequence and the numbers of its (standard) residues and the residue numbers, types (index in backbone_atoms)
+    and coordinates of the backbone atoms"""
+
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key in receptors:
+        return receptors[key]
+
+    residues = set()
     indices = []
+    indices_set = set()
     sequence = ''
+    resnums = []
+    atoms = []
+    coords = []
 
     with open(filename, 'r') as pdbf:
         for line in pdbf:
             if line.startswith('ATOM'):
                 resnum = line[22:26].strip()
                 resname = line[17:20].strip()
+                atomname = line[12:16].strip()
                 if resname in equivalent_residues:
                     resname = equivalent_residues[resname]
+                residues.add(resnum)
 
-                if resnum not in indices and resname in residues_3_to_1:
+                if resnum not in indices_set and resname in residues_3_to_1:
                     sequence += residues_3_to_1[resname]
                     indices.append(resnum)
-    return sequence, indices
+                    indices_set.add(resnum)
 
-def get_residues_coordinates(filename, indices):
-    indices_new = []
-    coords = []
+                if atomname in backbone_atoms:
+                    resnums.append(resnum)
+                    atoms.append(backbone_atoms.index(atomname))
+                    coords.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
 
-    with open(filename, 'r') as pdbf:
-        for line in pdbf:
-            if line.startswith('ATOM'):
-                resnum = line[22:26].strip()
-                resname = line[17:20].strip()
-                atomname = line[12:16].strip()
+    receptors[key] = {'nresidues': len(residues), 'sequence': sequence, 'indices': indices, \
+        'resnums': np.array(resnums, dtype=object), 'atoms': np.array(atoms, dtype=int), 'coords': np.array(coords).reshape((-1, 3))}
+    return receptors[key]
 
-                if resnum not in indices_new and resnum in indices:
-                    coords.append([])
-                    indices_new.append(resnum)
-                #if resnum in indices and atomname[0] != 'H':
-                if resnum in indices and atomname in ['CA', 'C', 'N', 'O']:
-                    x = float(line[30:38])
-                    y = float(line[38:46])
-                    z = float(line[46:54])
-                    coords[-1].append([atomname, x, y, z])
+def get_total_residue_number(filename):
+    return read_receptor(filename)['nresidues']
+
+def get_sequence_from_PDB(filename):
+    receptor = read_receptor(filename)
+    return receptor['sequence'], list(receptor['indices'])
 
-    return coords, indices_new
+def get_backbone_atoms(receptor, indices):
+    """Get key (position of the residue in indices and atom name) and row of the backbone atoms of the residues
+    of receptor numbered as indices, sorted by residue"""
+
+    positions = dict((resnum, idx) for idx, resnum in enumerate(indices))
+    rows = np.flatnonzero(np.in1d(receptor['resnums'], list(indices)))
+    residues = np.array([positions[resnum] for resnum in receptor['resnums'][rows]], dtype=int)
+
+    order = np.argsort(residues, kind='mergesort')
+    return residues[order]*len(backbone_atoms) + receptor['atoms'][rows[order]], rows[order]
+
+def get_heavy_atom_coordinates(filename):
+    """Get coordinates of the non-hydrogen atoms of a pose (kept in a LRU cache, the file is read again if modified)"""
+
+    key = (os.path.abspath(filename), posestore.get_pose_mtime(filename))
+    if key in coords_cache:
+        coords = coords_cache.pop(key)
+    else:
+        coords = posestore.get_coordinates(filename, keep_h=False)
+        coords.flags.writeable = False
+        if len(coords_cache) >= coords_cache_size:
+            coords_cache.popitem(last=False)
+    coords_cache[key] = coords
+    return coords
+
+def is_missing(file):
+    return isinstance(file, float) and math.isnan(file)
 
 def compute_rmsd(file1, file2, rotmat=np.eye(3), trans1=np.zeros(3), trans2=np.zeros(3)):
     """Compute RMSD between 2 poses"""
 
-    for file in [file1, file2]:
-        if isinstance(file, float) and math.isnan(file):
-            return float('nan')
+    if is_missing(file1) or is_missing(file2):
+        return float('nan')
 
-    # load coordinates of first pose (non-hydrogen atoms)
-    coords1 = mol2.get_coordinates(file1, keep_h=False)
-    coords1 = np.array(coords1)
+    # load coordinates of the poses (non-hydrogen atoms, pose files can be stored in a pose archive)
+    coords1 = get_heavy_atom_coordinates(file1)
+    coords2 = get_heavy_atom_coordinates(file2)
     natoms = coords1.shape[0]
 
-    coords1_rot = np.empty_like(coords1)
-    for idx in range(natoms):
-        coords1t = coords1[idx,:] + trans1
-        coords1t = coords1t[:,np.newaxis]
-        coords1_rot[idx,:] = np.dot(rotmat, coords1t).flatten() - trans2
-
-    # load coordinates of second pose (non-hydrogen atoms)
-    coords2 = mol2.get_coordinates(file2, keep_h=False)
-    coords2 = np.array(coords2)
+    coords1_rot = np.dot(coords1 + trans1, np.transpose(rotmat)) - trans2
 
     rmsd = np.sqrt(np.sum((coords1_rot-coords2)**2)/natoms)
     return rmsd
 
+def compute_consensus_rmsd(files, transforms=None):
+    """Compute RMSD between the poses of every pair of columns of files (e.g., best poses of each program for each ligand),
+    NaN when any file of the pair is missing or when the poses of a pair that does not involve the first column have
+    different numbers of non-hydrogen atoms. Poses of each column but the first can be superimposed onto the first one
+    with one rigid transform per row (transforms[idx-1] for column idx: rotations of shape (nrows, 3, 3), translations
+    trans1 and trans2 of shape (nrows, 3)). Returns a dict (idx, jdx) -> RMSD of each row (idx < jdx)"""
+
+    ncolumns = len(files)
+    nrows = len(files[0])
+
+    # rows are grouped by ligand topology (number of non-hydrogen atoms of each pose, 0 if missing), coordinates of
+    # each column of a group being loaded in one array
+    groups = {}
+    for row in range(nrows):
+        coords_row = [None if is_missing(column[row]) else get_heavy_atom_coordinates(column[row]) for column in files]
+        natoms = tuple(0 if coords is None else coords.shape[0] for coords in coords_row)
+        if natoms[0] and any(natoms_pose and natoms_pose != natoms[0] for natoms_pose in natoms[1:]):
+            raise ValueError("Poses %s do not have the same number of non-hydrogen atoms!"%', '.join(str(column[row]) \
+for column in files if not is_missing(column[row])))
+        elif any(natoms):
+            groups.setdefault(natoms, []).append((row, coords_row))
+
+    rmsd = dict(((idx, jdx), np.full(nrows, np.nan)) for idx in range(ncolumns) for jdx in range(idx+1, ncolumns))
+    for natoms, items in groups.iteritems():
+        rows = np.array([row for row, coords_row in items])
+        coords = [np.array([coords_row[idx] for row, coords_row in items]) if natoms[idx] else None for idx in range(ncolumns)]
+
+        if transforms is not None:
+            for idx, (rotmats, trans1, trans2) in enumerate(transforms):
+                if coords[idx+1] is not None:
+                    coords_t = coords[idx+1] + np.asarray(trans1)[rows][:,np.newaxis,:]
+                    coords[idx+1] = np.einsum('pij,pnj->pni', np.asarray(rotmats)[rows], coords_t) - np.asarray(trans2)[rows][:,np.newaxis,:]
+
+        for idx, jdx in rmsd:
+            if natoms[idx] and natoms[idx] == natoms[jdx]:
+                rmsd[(idx, jdx)][rows] = np.sqrt(np.sum((coords[idx]-coords[jdx])**2, axis=(1, 2))/natoms[idx])
+    return rmsd
+
+def compute_rmsd_matrix(coords):
+    """Compute RMSD (without fitting) between every pair of poses given as an array of shape (nposes, natoms, 3)"""
+
+    nposes, natoms = coords.shape[:2]
+    coords = coords.reshape((nposes, -1))
+    # centering reduces round-off errors of the expansion of the squared distances
+    coords = coords - coords.mean()
+
+    sqnorms = np.sum(coords**2, axis=1)
+    msd = (sqnorms[:,np.newaxis] + sqnorms[np.newaxis,:] - 2*np.dot(coords, coords.T))/natoms
+    return np.sqrt(np.maximum(msd, 0.0))
+
+def cluster_poses(mol2files, cutoff):
+    """Group poses within cutoff (heavy-atom RMSD) of a representative, poses are taken in order and become
+    representatives if no representative is close enough. Returns the indices of the representatives and the cluster
+    of each pose (index in the list of representatives)"""
+
+    coords = [posestore.get_coordinates(filename, keep_h=False) for filename in mol2files]
+
+    # only poses with the same number of atoms can be compared
+    groups = {}
+    for idx, coords_pose in enumerate(coords):
+        groups.setdefault(coords_pose.shape, []).append(idx)
+
+    rmsd = {}
+    position = {} # position of each pose in its group
+    for shape, indices in groups.iteritems():
+        rmsd[shape] = compute_rmsd_matrix(np.array([coords[idx] for idx in indices]))
+        for jdx, idx in enumerate(indices):
+            position[idx] = jdx
+
+    representatives = []
+    clusters = np.zeros(len(mol2files), dtype=int)
+    clusters_group = dict((shape, []) for shape in groups)
+    for idx, coords_pose in enumerate(coords):
+        shape = coords_pose.shape
+
+        candidates = clusters_group[shape]
+        if candidates:
+            rmsd_candidates = rmsd[shape][position[idx], [position[representatives[cluster]] for cluster in candidates]]
+            closest = np.argmin(rmsd_candidates)
+            if rmsd_candidates[closest] < cutoff:
+                clusters[idx] = candidates[closest]
+                continue
+
+        clusters[idx] = len(representatives)
+        clusters_group[shape].append(len(representatives))
+        representatives.append(idx)
+
+    return representatives, clusters
+
 def get_rmsd_rotation_and_translations(file1, file2):
 
-    nres1 = get_total_residue_number(file1)
-    nres2 = get_total_residue_number(file2)
+    receptor1 = read_receptor(file1)
+    receptor2 = read_receptor(file2)
+
+    nres1 = receptor1['nresidues']
+    nres2 = receptor2['nresidues']
 
-    seq1, ind1 = get_sequence_from_PDB(file1)
-    seq2, ind2 = get_sequence_from_PDB(file2)
+    seq1, ind1 = receptor1['sequence'], receptor1['indices']
+    seq2, ind2 = receptor2['sequence'], receptor2['indices']
 
-    alignment = nw.global_align(seq1, seq2)
+    # every residue is kept when the sequences are identical (no alignment needed)
+    if seq1 != seq2:
+        alignment = nw.global_align(seq1, seq2)
 
-    nalign = len(alignment[0])
-    nresidues_min = min(len(seq1), len(seq2))
+        nalign = len(alignment[0])
+        nresidues_min = min(len(seq1), len(seq2))
 
-    ind1new = []
-    ind2new = []
-    idx1, idx2 = 0, 0
+        ind1new = []
+        ind2new = []
+        idx1, idx2 = 0, 0
 
-    for idx in range(nalign):
-        if (idx < nresidues_min) and seq1[idx] == seq2[idx] and seq1[idx] != '-':
-            ind1new.append(ind1[idx1])
-            ind2new.append(ind2[idx2])
-        if (idx < len(seq1)) and seq1[idx] != '-':
-            idx1 += 1
-        if (idx < len(seq2)) and seq2[idx] != '-':
-            idx2 += 1
+        for idx in range(nalign):
+            if (idx < nresidues_min) and seq1[idx] == seq2[idx] and seq1[idx] != '-':
+                ind1new.append(ind1[idx1])
+                ind2new.append(ind2[idx2])
+            if (idx < len(seq1)) and seq1[idx] != '-':
+                idx1 += 1
+            if (idx < len(seq2)) and seq2[idx] != '-':
+                idx2 += 1
 
-    ind1 = ind1new
-    ind2 = ind2new
+        ind1 = ind1new
+        ind2 = ind2new
 
     #TODO: add a threshold for the number of residues considered
     frac1 = len(ind1)*100.0/nres1
     frac2 = len(ind2)*100.0/nres2
 
-    # get coordinates of specific residues 
-    coords1, ind1 = get_residues_coordinates(file1, ind1)
-    coords2, ind2 = get_residues_coordinates(file2, ind2)
-
-    new_coords1 = []
-    new_coords2 = []
+    # get backbone atoms of the aligned residues
+    keys1, rows1 = get_backbone_atoms(receptor1, ind1)
+    keys2, rows2 = get_backbone_atoms(receptor2, ind2)
 
     # check if there is consistency in atom names
-    nresidues1 = len(coords1)
-    for idx in range(nresidues1):
-        coords1_res = coords1[idx]
-        coords2_res = coords2[idx]
-
-        atomnames1 = [item[0] for item in coords1_res]
-        atomnames2 = [item[0] for item in coords2_res]
-        if set(atomnames1) != set(atomnames2):
-            sys.exit("Inconsistency found in residue %s in file %s and residue %s in file %s! Missing atom suspected..."%(ind1[idx],file1,ind2[idx],file2))
-
-        # create new coordinates
-        for an1, x1, y1, z1 in coords1_res:
-            for an2, x2, y2, z2 in coords2_res:
-                if an1 == an2:
-                    new_coords1.append([x1, y1, z1])
-                    new_coords2.append([x2, y2, z2])
-                    break
-
-    new_coords1 = np.array(new_coords1).T
-    new_coords2 = np.array(new_coords2).T
+    inconsistent = np.setxor1d(keys1, keys2)
+    if len(inconsistent):
+        idx = inconsistent[0] // len(backbone_atoms)
+        sys.exit("Inconsistency found in residue %s in file %s and residue %s in file %s! Missing atom suspected..."%(ind1[idx],file1,ind2[idx],file2))
+
+    # match each atom of the first file with the first atom of the same residue and name in the second file
+    keys2_unique, first2 = np.unique(keys2, return_index=True)
+    new_coords1 = receptor1['coords'][rows1]
+    new_coords2 = receptor2['coords'][rows2[first2[np.searchsorted(keys2_unique, keys1)]]]
+
+    new_coords1 = np.array(new_coords1.T)
+    new_coords2 = np.array(new_coords2.T)
 
     rotation = np.zeros(9)
     trans1 = -new_coords1[:,0]
@@ -194,22 +306,78 @@ def get_rmsd_rotation_and_translations(file1, file2):
 
     return rotation, trans1, trans2
 
-def get_rmsd_rotation_and_translations_all_targets(files_r):
-    rmsd_rot_trans = {}
+def get_transform(files):
+    """Superimpose 2 targets (run in worker processes), returns the error message if the targets are inconsistent"""
 
-    for key1 in files_r:
-        rmsd_rot_trans[key1] = {}
+    try:
+        return get_rmsd_rotation_and_translations(*files)
+    except SystemExit as e:
+        return str(e)
 
-        for key2 in files_r:
-            if key1 == key2:
-                rotation = np.eye(3)
-                trans1 = np.zeros(3)
-                trans2 = np.zeros(3)
-            else:
-                file1 = files_r[key1]
-                file2 = files_r[key2]
-                rotation, trans1, trans2 = get_rmsd_rotation_and_translations(file1, file2)
-            rmsd_rot_trans[key1][key2] = [rotation, trans1, trans2]
+def invert_transform(rotation, trans1, trans2):
+    """Get the transform superimposing the second target onto the first one"""
+    return np.array(rotation.T), trans2, trans1
+
+def get_rmsd_rotation_and_translations_all_targets(files_r, pairs=None, cachedir=None, nprocs=1):
+    """Get the transforms superimposing targets onto each other for the pairs of target IDs specified (every pair if None)
+
+    The transform of each pair of receptor files is computed once (the reverse pair being obtained by inversion) using
+    nprocs processes. Transforms are stored in cachedir (if specified) for the next runs on the same receptor files."""
+
+    if pairs is None:
+        pairs = [(key1, key2) for key1 in files_r for key2 in files_r]
+
+    if cachedir:
+        transform_cache = cache.TransformCache(cachedir)
+    else:
+        transform_cache = None
+
+    # transforms are identified by the content of the receptor files
+    hashes = {}
+    for key1, key2 in pairs:
+        for key in [key1, key2]:
+            if key not in hashes:
+                hashes[key] = cache.get_file_hash(files_r[key])
+
+    transforms = {}
+    jobs = []
+    for key1, key2 in pairs:
+        hash1, hash2 = hashes[key1], hashes[key2]
+        if (hash1, hash2) in transforms or (hash2, hash1) in transforms:
+            continue
+        if hash1 == hash2:
+            transforms[(hash1, hash2)] = (np.eye(3), np.zeros(3), np.zeros(3))
+            continue
+
+        if transform_cache:
+            transform = transform_cache.fetch_transform(transform_cache.get_key(files_r[key1], files_r[key2]))
+            if transform is not None:
+                transforms[(hash1, hash2)] = transform
+                continue
+            transform = transform_cache.fetch_transform(transform_cache.get_key(files_r[key2], files_r[key1]))
+            if transform is not None:
+                transforms[(hash2, hash1)] = transform
+                continue
+
+        transforms[(hash1, hash2)] = None
+        jobs.append((key1, key2))
+
+    results = parallel.run_jobs(get_transform, [(files_r[key1], files_r[key2]) for key1, key2 in jobs], nprocs=nprocs)
+    for (key1, key2), transform in zip(jobs, results):
+        if isinstance(transform, basestring):
+            sys.exit(transform)
+        transforms[(hashes[key1], hashes[key2])] = transform
+        if transform_cache:
+            transform_cache.store_transform(transform_cache.get_key(files_r[key1], files_r[key2]), transform)
+
+    rmsd_rot_trans = {}
+    for key1, key2 in pairs:
+        hash1, hash2 = hashes[key1], hashes[key2]
+        if (hash1, hash2) in transforms:
+            transform = transforms[(hash1, hash2)]
+        else:
+            transform = invert_transform(*transforms[(hash2, hash1)])
+        rmsd_rot_trans.setdefault(key1, {})[key2] = list(transform)
 
     return rmsd_rot_trans
 
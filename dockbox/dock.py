@@ -1,9 +1,9 @@
 import os
 import sys
 import method
+import tracing
 
 import shutil
-import subprocess
 from glob import glob
 
 from mdkit.amber import ambertools
@@ -35,6 +35,15 @@ class Dock(method.DockingMethod):
         else:
             self.options['dockdir'] = 'dock.' + self.options['site']
 
+    def get_receptor_files(self):
+        if self.options['grid_dir'] is None:
+            return ['target.mol2', 'target_noH.ms']
+        else:
+            return []
+
+    def get_receptor_options(self):
+        return {'probe_radius': self.options['probe_radius']}
+
     def write_rescoring_script(self, filename, file_r, files_l):
         """Rescore using DOCK6 grid scoring function"""
 
@@ -60,7 +69,8 @@ class Dock(method.DockingMethod):
                     mol2.Writer().write('pose-%i.mol2'%(idx+1), struct)
                 else:
                     shutil.copyfile(file_l, 'pose-%i.mol2'%(idx+1))
-            subprocess.check_output("cat pose-%i.mol2 >> %s"%(idx+1, file_all_poses), shell=True)
+            with open('pose-%i.mol2'%(idx+1), 'r') as pf, open(file_all_poses, 'a') as af:
+                shutil.copyfileobj(pf, af)
             if idx > 0:
                 os.remove('pose-%i.mol2'%(idx+1))
 
@@ -71,7 +81,10 @@ set -e
 python prepare_ligand_dock.py pose-1.mol2 pose-1-centered.mol2 %(center)s\n"""%locals()
 
         if self.options['grid_dir'] is None:
-            script += """\n# remove hydrogens from target
+            script += """\n# prepare receptor files (unless already taken from the cache)
+if [ ! -f target.mol2 ] || [ ! -f target_noH.ms ]; then
+
+# remove hydrogens from target
 echo "delete element.H
 write format pdb #0 target_noH.pdb" > removeH.cmd
 chimera --nogui %(file_r)s removeH.cmd
@@ -90,6 +103,7 @@ chimera --nogui %(file_r)s dockprep.py
 
 # generating receptor surface
 dms target_noH.pdb -n -w %(probe_radius)s -v -o target_noH.ms
+fi
 
 # generating spheres
 echo "target_noH.ms
@@ -211,15 +225,22 @@ dock6 -i dock6.in > dock.out\n"""%locals()
             ambertools.run_antechamber(file_l, 'ligand-ref.mol2', at='sybyl', c=self.options['charge_method'], version=amber_version)
         else:
             shutil.copyfile(file_l, 'ligand-ref.mol2')
+        stage_functions = tracing.script_functions
 
         script ="""#!/bin/bash
 set -e
+%(stage_functions)s
 
 # shift ligand coordinates
+dbx_stage ligand_preparation
 python prepare_ligand_dock.py ligand-ref.mol2 ligand-ref-centered.mol2 %(center)s\n"""%locals()
 
         if self.options['grid_dir'] is None:
-            script += """\n# remove hydrogens from target
+            script += """\n# prepare receptor files (unless already taken from the cache)
+dbx_stage receptor_preparation
+if [ ! -f target.mol2 ] || [ ! -f target_noH.ms ]; then
+
+# remove hydrogens from target
 echo "delete element.H
 write format pdb #0 target_noH.pdb" > removeH.cmd
 chimera --nogui %(file_r)s removeH.cmd
@@ -238,8 +259,10 @@ chimera --nogui %(file_r)s dockprep.py
 
 # generating receptor surface
 dms target_noH.pdb -n -w %(probe_radius)s -v -o target_noH.ms
+fi
 
 # generating spheres
+dbx_stage grid_generation
 echo "target_noH.ms
 R
 X
@@ -321,6 +344,7 @@ flexfile=`python -c "print '/'.join('$dock6path'.split('/')[:-2]) + '/parameters
 flexdfile=`python -c "print '/'.join('$dock6path'.split('/')[:-2]) + '/parameters/flex_drive.tbl'"`\n"""
 
         script += """\n# flexible docking using grid score as primary score and no secondary score
+dbx_stage docking
 echo "ligand_atom_file ligand-ref-centered.mol2
 limit_max_ligands no
 skip_molecule no
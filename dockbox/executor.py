@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import fcntl
+import stat
+import shutil
+import subprocess
+from glob import glob
+
+import parallel
+
+known_executors = ['serial', 'pool', 'array']
+
+class SerialExecutor(object):
+    """Run jobs one after the other in the current process"""
+
+    # jobs are done when run returns
+    is_deferred = False
+
+    def run(self, func, jobs):
+        return map(func, jobs)
+
+    def close(self):
+        pass
+
+class PoolExecutor(SerialExecutor):
+    """Run jobs in a pool of nprocs local processes"""
+
+    def __init__(self, nprocs=0):
+        self.nprocs = nprocs
+
+    def run(self, func, jobs):
+        return parallel.run_jobs(func, jobs, nprocs=self.nprocs)
+
+class ArrayExecutor(PoolExecutor):
+    """Export docking scripts as the tasks of a job array for batch schedulers (SLURM, SGE, PBS)
+
+    Scripts are only prepared by rundbx. Tasks are listed in a manifest and grouped by ligand folder;
+    the last task of a group to finish runs the command of the group (extraction, finalize and rescoring
+    through rundbx -skip_docking). A local runner (run_array_local.sh) can run the tasks without scheduler."""
+
+    # jobs only prepare the scripts, docking is done when the tasks are run
+    is_deferred = True
+
+    def __init__(self, arraydir='dbx_array', nprocs=1):
+
+        super(ArrayExecutor, self).__init__(nprocs=nprocs)
+        self.arraydir = os.path.abspath(arraydir)
+
+        self.tasks = []
+        self.groups = {}
+
+    def add_task(self, workdir, script, logfile, group):
+        self.tasks.append({'workdir': workdir, 'script': script, 'logfile': logfile, 'group': group})
+
+    def add_group(self, group, command):
+        self.groups[group] = {'command': command, 'ntasks': len([task for task in self.tasks if task['group'] == group])}
+
+    def close(self):
+        """Write manifest, submission script and local runner"""
+
+        if not self.tasks:
+            return
+
+        if not os.path.isdir(self.arraydir):
+            os.makedirs(self.arraydir)
+        if not os.path.isdir(self.arraydir + '/logs'):
+            os.mkdir(self.arraydir + '/logs')
+
+        # remove counts of tasks done left by a previous array
+        for filename in glob(self.arraydir + '/done-*'):
+            os.remove(filename)
+
+        manifest = self.arraydir + '/manifest.json'
+        with open(manifest, 'w') as mf:
+            json.dump({'tasks': self.tasks, 'groups': self.groups}, mf, indent=1)
+
+        exe = os.path.abspath(__file__)
+        if exe[-1] == 'c':
+            exe = exe[:-1] # get .py from .pyc
+        python = sys.executable
+        arraydir = self.arraydir
+        ntasks = len(self.tasks)
+
+        # headers of each scheduler are ignored by the others
+        script = """#!/bin/bash
+#SBATCH --job-name=dbx
+#SBATCH --array=1-%(ntasks)i
+#SBATCH --output=%(arraydir)s/logs/task-%%a.out
+#$ -N dbx
+#$ -t 1-%(ntasks)i
+#$ -o %(arraydir)s/logs
+#$ -j y
+#PBS -N dbx
+#PBS -J 1-%(ntasks)i
+#PBS -o %(arraydir)s/logs
+#PBS -j oe
+
+# submit with: sbatch submit_array.sh (SLURM), qsub submit_array.sh (SGE, PBS)
+taskid=${SLURM_ARRAY_TASK_ID:-${SGE_TASK_ID:-${PBS_ARRAY_INDEX:-${PBS_ARRAYID:-$1}}}}
+
+%(python)s %(exe)s task %(arraydir)s/manifest.json $taskid\n"""%locals()
+        self.write_script('submit_array.sh', script)
+
+        script = """#!/bin/bash
+# run every task of the job array on the local machine: run_array_local.sh [NPROCS]
+
+%(python)s %(exe)s local %(arraydir)s/manifest.json ${1:-1}\n"""%locals()
+        self.write_script('run_array_local.sh', script)
+
+        print "Job array of %i tasks written in %s (submit_array.sh)"%(ntasks, self.arraydir)
+
+    def write_script(self, filename, script):
+
+        filename = os.path.join(self.arraydir, filename)
+        with open(filename, 'w') as ff:
+            ff.write(script)
+        os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IXUSR)
+
+def run_task(manifest, taskid):
+    """Run task taskid (starting from 1) of the job array, returns the exit status of the script"""
+
+    with open(manifest, 'r') as mf:
+        content = json.load(mf)
+    task = content['tasks'][taskid-1]
+
+    curdir = os.getcwd()
+    os.chdir(task['workdir'])
+    try:
+        status = subprocess.call('./' + task['script'] + ' &> ' + task['logfile'], shell=True, executable='/bin/bash')
+        if status == 0:
+            # docking stage completed, its signature is the one of the script (see DockingMethod.get_stage_signatures)
+            shutil.copyfile('.dbx_script', '.dbx_docking')
+        else:
+            print "Error: task %i failed, check %s file for more details!"%(taskid, task['workdir']+'/'+task['logfile'])
+    finally:
+        os.chdir(curdir)
+
+    # count tasks done in the group, the last one runs the command of the group
+    group = task['group']
+    countfile = os.path.join(os.path.dirname(os.path.abspath(manifest)), 'done-%i'%(sorted(content['groups']).index(group)+1))
+    with open(countfile + '.lock', 'a') as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            with open(countfile, 'a') as cf:
+                cf.write('%i\n'%taskid)
+            with open(countfile, 'r') as cf:
+                ndone = len(set(cf.read().split()))
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
+    if ndone == content['groups'][group]['ntasks']:
+        print "All tasks of %s done, finalizing..."%group
+        sys.stdout.flush()
+        subprocess.call(content['groups'][group]['command'], shell=True, executable='/bin/bash', cwd=group)
+    return status
+
+def run_task_job(job):
+    return run_task(*job)
+
+def run_local(manifest, nprocs=1):
+    """Run every task of the job array locally (stand-in for a batch scheduler)"""
+
+    with open(manifest, 'r') as mf:
+        ntasks = len(json.load(mf)['tasks'])
+    statuses = parallel.run_jobs(run_task_job, [(manifest, idx+1) for idx in range(ntasks)], nprocs=nprocs)
+    return int(any(statuses))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[1] not in ['task', 'local']:
+        sys.exit("usage: python executor.py task MANIFEST TASKID | local MANIFEST NPROCS")
+    if sys.argv[1] == 'task':
+        sys.exit(run_task(sys.argv[2], int(sys.argv[3])))
+    else:
+        sys.exit(run_local(sys.argv[2], int(sys.argv[3])))
@@ -2,11 +2,12 @@ import os
 import sys
 import glob
 import shutil
-import subprocess
 import numpy as np
 
 import method
 import license
+import runner
+import tracing
 
 from mdkit.utility import reader
 from mdkit.utility import mol2
@@ -50,6 +51,12 @@ class Glide(method.DockingMethod):
         else:
             raise ValueError("Value for use_prepwizard non recognized")
             
+    def get_receptor_files(self):
+        return ['target.mae']
+
+    def get_receptor_options(self):
+        return {'use_prepwizard': self.use_prepwizard}
+
     def write_docking_script(self, filename, file_r, file_l):
         """ Write docking script for glide """
         locals().update(self.options)
@@ -65,16 +72,26 @@ class Glide(method.DockingMethod):
         glide_dock_cmd = license.wrap_command("glide dock.in", 'schrodinger')
 
         tmpdirline = self.tmpdirline
+        stage_functions = tracing.script_functions
     
         # write glide script
         with open(filename, 'w') as file:
             script ="""#!/bin/bash
 %(tmpdirline)s
+%(stage_functions)s
 
-# (A) Prepare receptor
+# convert ligand to maestro format in the background (while the receptor and the grid wait for their licenses)
+structconvert -imol2 %(file_l)s -omae lig.mae &
+ligprep_pid=$!
+
+# (A) Prepare receptor (unless already taken from the cache)
+dbx_stage receptor_preparation
+if [ ! -f target.mae ]; then
 %(prepwizard_cmd)s
+fi
 
 # (B) Prepare grid
+dbx_stage grid_generation
 echo "USECOMPMAE YES
 INNERBOX %(innerbox)s
 ACTXRANGE %(actxrange)s
@@ -87,10 +104,12 @@ GRIDFILE grid.zip
 RECEP_FILE target.mae" > grid.in
 %(glide_grid_cmd)s
 
-# (C) convert ligand to maestro format
-structconvert -imol2 %(file_l)s -omae lig.mae
+# (C) wait for the conversion of the ligand
+dbx_stage ligand_preparation
+wait $ligprep_pid
 
 # (D) perform docking
+dbx_stage docking
 echo "WRITEREPT YES
 USECOMPMAE YES
 DOCKING_METHOD confgen
@@ -107,10 +126,10 @@ PRECISION %(precision)s" > dock.in
 
         if os.path.exists('dock_pv.maegz'):
             # (1) cmd to extract results
-            subprocess.check_output('glide_sort -r sort.rept dock_pv.maegz -o dock_sorted.mae', shell=True, executable='/bin/bash')
+            runner.check_output('glide_sort -r sort.rept dock_pv.maegz -o dock_sorted.mae')
 
             # (2) convert to .mol2
-            subprocess.check_output('mol2convert -n 2: -imae dock_sorted.mae -omol2 dock_sorted.mol2', shell=True, executable='/bin/bash')
+            runner.check_output('mol2convert -n 2: -imae dock_sorted.mae -omol2 dock_sorted.mol2')
 
             if os.path.exists('dock_sorted.mol2'):
                 ligname = reader.open(input_file_l).ligname
@@ -157,8 +176,14 @@ PRECISION %(precision)s" > dock.in
 %(tmpdirline)s
 cat %(files_l_joined)s > lig.mol2
 
-# (A) Prepare receptor
+# convert ligands to maestro format in the background (while the receptor and the grid wait for their licenses)
+structconvert -imol2 lig.mol2 -omae lig.mae &
+ligprep_pid=$!
+
+# (A) Prepare receptor (unless already taken from the cache)
+if [ ! -f target.mae ]; then
 %(prepwizard_cmd)s
+fi
 
 # (B) Prepare grid
 echo "USECOMPMAE YES
@@ -174,8 +199,8 @@ RECEP_FILE target.mae" > grid.in
 %(glide_grid_cmd)s
 
 
-# (C) convert ligand to maestro format
-structconvert -imol2 lig.mol2 -omae lig.mae
+# (C) wait for the conversion of the ligands
+wait $ligprep_pid
 
 # (D) perform rescoring
 echo "WRITEREPT YES
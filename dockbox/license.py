@@ -1,9 +1,38 @@
 import sys
 import os
 import time
+import json
+import fcntl
+import pipes
+import random
+import socket
+import threading
 import subprocess
 
-def wrap_command(cmd, prgm):
+import cache
+import runner
+
+# vendors whose commands are run with tokens
+vendors = ['moe', 'gold', 'schrodinger']
+
+license_error_message = 'Licensed number of users already reached'
+
+# environment variables used to pass the token settings to the docking scripts
+tokens_env = 'DBX_LICENSE_TOKENS'
+token_dir_env = 'DBX_LICENSE_DIR'
+
+default_token_dir = os.path.join(os.path.expanduser('~'), '.dockbox', 'licenses')
+
+# backoff after a license refusal (in sec.), doubled after each consecutive refusal
+min_backoff = 10
+max_backoff = 600
+
+# time after which the token of a holder which stopped renewing its lease is reclaimed (in sec.)
+default_lease_time = 300
+
+def wrap_command(cmd, prgm, logfile=None):
+    """Wrap command so that it is run with a license token of program prgm (and retried if the license is refused),
+    a different logfile should be given to MOE commands run at the same time in the same folder"""
 
     exe = os.path.abspath(__file__)
     if exe[-1] == 'c':
@@ -13,23 +42,10 @@ def wrap_command(cmd, prgm):
     exe_cmd = cmd_s[0]
 
     if prgm == 'moe':
-        logfile = 'moebatch.log'
-        # write eval command until license is found
-        newcmd = """while true; do
-  %(cmd)s &> %(logfile)s
-  status=`python %(exe)s %(prgm)s %(logfile)s`
-  if [ "$status" == "0" ]; then break; fi
-  sleep 10s
-done"""% locals()
+        logfile = logfile or 'moebatch.log'
 
     elif prgm == 'gold':
         logfile = 'gold.err'
-        newcmd = """while true; do
-  %(cmd)s > /dev/null
-  status=`python %(exe)s %(prgm)s %(logfile)s`
-  if [ "$status" == "0" ]; then break; fi
-  sleep 10s
-done"""% locals()
 
     elif prgm == 'schrodinger':
         if exe_cmd == 'glide':
@@ -43,48 +59,355 @@ done"""% locals()
         splitext_0 = os.path.splitext(filename1)[0]
         suffix = os.path.basename(splitext_0)
         logfile = suffix + '.log'
-        newcmd = """while true; do
-  output=`%(cmd)s`
-  jobid=`echo "$output" | sed -n -e 's/^.*JobId: //p'`
-  status=`python %(exe)s %(prgm)s %(logfile)s $jobid`
-  if [ "$status" == "0" ]; then break; fi
-  sleep 10s
-done"""% locals()
 
+    cmd = pipes.quote(cmd)
+    newcmd = "python %(exe)s run %(prgm)s %(logfile)s %(cmd)s"% locals()
     return newcmd
 
-def check_schrodinger_license(logfile, jobid):
-    """Check if schrodinger exe had license issues, design to avoid retry every 60 sec"""
+def get_token_limits():
+    """Get number of tokens available for each vendor (vendors without tokens set are not limited)"""
 
-    status = 0
-    is_job_done = False
-    is_job_killed = False
+    limits = {}
+    value = os.environ.get(tokens_env)
+    if value:
+        for item in value.split(','):
+            vendor, ntokens = item.split('=')
+            limits[vendor.strip()] = int(ntokens)
+    return limits
+
+def set_environment(tokens, token_dir=None):
+    """Pass token settings to the scripts and commands run from the current process"""
+
+    os.environ[tokens_env] = ','.join(['%s=%i'%(vendor, ntokens) for vendor, ntokens in sorted(tokens.iteritems())])
+    if token_dir:
+        os.environ[token_dir_env] = token_dir
+
+def get_token_dir(token_dir=None):
+    """Get folder where the state of the tokens is stored (created if needed)"""
+
+    if token_dir is None:
+        token_dir = os.environ.get(token_dir_env, default_token_dir)
+    if not os.path.isdir(token_dir):
+        try:
+            os.makedirs(token_dir)
+        except OSError:
+            if not os.path.isdir(token_dir):
+                raise
+    return token_dir
+
+class TokenPool(object):
+    """Pool of license tokens of one vendor shared by every process using the same token folder
+
+    The state of the pool (holders of the tokens with the time their lease was last renewed and backoff
+    after a license refusal) is stored in a JSON file modified under an exclusive lock. Holders renew
+    their lease while their command is running; tokens whose lease expired are reclaimed whatever the
+    host of the holder (e.g., node crash) and tokens of dead processes of the current host are reclaimed
+    right away. Times are taken from the clock of the file system of the token folder so that the
+    clocks of the hosts do not need to be synchronized."""
+
+    def __init__(self, vendor, ntokens=None, token_dir=None, poll_interval=1.0, lease_time=default_lease_time):
+
+        self.vendor = vendor
+        if ntokens is None:
+            ntokens = get_token_limits().get(vendor, 0)
+        self.ntokens = ntokens # 0 means no limit
+
+        self.token_dir = get_token_dir(token_dir)
+        self.statefile = os.path.join(self.token_dir, vendor + '.json')
+        self.lockfile = os.path.join(self.token_dir, vendor + '.lock')
+        self.poll_interval = poll_interval
+        self.lease_time = lease_time
+
+        self.holder = '%s:%i'%(socket.gethostname(), os.getpid())
+        # current time of the file system, set each time the state is updated
+        self.now = None
+        self.renewal = None
+
+    def update_state(self, func):
+        """Apply func on the state of the pool under lock, returns the output of func"""
+
+        with open(self.lockfile, 'a') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                self.now = cache.get_shared_time(self.lockfile)
+                state = {'holders': {}, 'backoff': 0, 'backoff_until': 0}
+                if os.path.isfile(self.statefile):
+                    with open(self.statefile, 'r') as sf:
+                        try:
+                            state.update(json.load(sf))
+                        except ValueError:
+                            pass
+                if isinstance(state['holders'], list):
+                    # state written by earlier versions (holders without lease)
+                    state['holders'] = dict((holder, self.now) for holder in state['holders'])
+                self.reclaim_tokens(state)
+
+                output = func(state)
+
+                with open(self.statefile + '.tmp', 'w') as sf:
+                    json.dump(state, sf)
+                os.rename(self.statefile + '.tmp', self.statefile)
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+        return output
+
+    def reclaim_tokens(self, state):
+
+        hostname = socket.gethostname()
+        holders = {}
+        for holder, renewed in state['holders'].iteritems():
+            if self.now - renewed > self.lease_time:
+                # lease expired (holder dead or unreachable)
+                continue
+            host, pid = holder.rsplit(':', 1)
+            if host == hostname:
+                try:
+                    os.kill(int(pid), 0)
+                except OSError:
+                    # process does not exist anymore
+                    continue
+            holders[holder] = renewed
+        state['holders'] = holders
+
+    def try_acquire(self, state):
+
+        if self.now < state['backoff_until']:
+            return False
+        if self.ntokens > 0 and len(state['holders']) >= self.ntokens:
+            return False
+        state['holders'][self.holder] = self.now
+        return True
+
+    def renew(self, state):
+        # a holder whose lease expired (e.g., host suspended) takes its token back
+        state['holders'][self.holder] = self.now
+
+    def acquire(self):
+        """Wait until a token is free and take it"""
+
+        while not self.update_state(self.try_acquire):
+            # jitter avoids waiting processes to poll all at the same time
+            time.sleep(self.poll_interval*(0.5 + random.random()))
+
+    def release(self, state=None):
+
+        if state is None:
+            return self.update_state(self.release)
+        state['holders'].pop(self.holder, None)
+
+    def start_renewal(self):
+        """Renew the lease of the token in a background thread (ten times per lease time) until stop_renewal is called"""
+
+        stop = threading.Event()
+        thread = threading.Thread(target=self.renew_lease, args=(stop,))
+        thread.daemon = True
+        thread.start()
+        self.renewal = (stop, thread)
+
+    def renew_lease(self, stop):
+        while not stop.wait(self.lease_time/10.0):
+            self.update_state(self.renew)
+
+    def stop_renewal(self):
+        # should not be called under the lock of the pool, the thread may be waiting for it
+        if self.renewal is not None:
+            stop, thread = self.renewal
+            stop.set()
+            thread.join()
+            self.renewal = None
+
+    def release_after_success(self, state):
+        self.release(state)
+        # license was granted, reduce backoff for the next refusals
+        state['backoff'] = state['backoff']/2
+
+    def release_after_refusal(self, state):
+        """Release token and make every process of the pool wait before the next attempt"""
 
+        self.release(state)
+        state['backoff'] = min(max(2*state['backoff'], min_backoff), max_backoff)
+        # the first refusal sets the backoff of the pool, others only extend it if needed
+        backoff_until = self.now + state['backoff']*(0.75 + 0.5*random.random())
+        state['backoff_until'] = max(state['backoff_until'], backoff_until)
+
+def run_command(prgm, logfile, cmd, token_pool=None):
+    """Run cmd with a token of prgm, the command is run again if the license is refused"""
+
+    if token_pool is None:
+        token_pool = TokenPool(prgm)
+
+    wait_time = 0.0
+    nattempts = 0
     while True:
-        # (A) check if the job is still running
-        output = subprocess.check_output('jobcontrol -list', shell=True, executable='/bin/bash')
-        if jobid in output:
-            time.sleep(2) # sleep for 2 sec
-        else:
-            is_job_done = True # the job is done
-        # (B) check if the job has license issues
-        if not is_job_killed:
-            with open(logfile) as logf:
-                for line in logf:
-                    if 'Licensed number of users already reached' in line:
-                        output = subprocess.check_output('jobcontrol -killnooutput %s'%jobid, shell=True, executable='/bin/bash')
+        t0 = time.time()
+        token_pool.acquire()
+        t1 = time.time()
+        nattempts += 1
+        token_pool.start_renewal()
+        try:
+            if prgm == 'moe':
+                runner.call(cmd + ' &> ' + logfile, resources={'cores': 1, 'moe': 1})
+                status = check_moe_license(logfile)
+            elif prgm == 'gold':
+                runner.call(cmd + ' > /dev/null', resources={'cores': 1, 'gold': 1})
+                status = check_gold_license(logfile)
+            elif prgm == 'schrodinger':
+                # Schrodinger's commands return once the job is submitted, the token is held until the job is done
+                output = runner.run(cmd, resources={'schrodinger': 1}, stdout=subprocess.PIPE)[1]
+                jobid = None
+                for line in output.splitlines():
+                    if 'JobId: ' in line:
+                        jobid = line.split('JobId: ')[-1].strip()
+                if jobid:
+                    # the monitor is created right after the submission (see SchrodingerMonitor.submit_time)
+                    status = SchrodingerMonitor(logfile, jobid, token_dir=token_pool.token_dir).wait()
+                else:
+                    status = 0
+            else:
+                raise ValueError("Program %s not recognized!"%prgm)
+        except:
+            token_pool.stop_renewal()
+            token_pool.release()
+            raise
+        token_pool.stop_renewal()
+        t2 = time.time()
+
+        if status == 0:
+            token_pool.update_state(token_pool.release_after_success)
+            # time spent waiting for a license (including refused runs) vs. actual computation
+            write_license_times(prgm, cmd, nattempts, wait_time + t1 - t0, t2 - t1)
+            return status
+        token_pool.update_state(token_pool.release_after_refusal)
+        wait_time += t2 - t0
+
+def write_license_times(prgm, cmd, nattempts, wait_time, compute_time, filename='license_times.csv'):
+    """Append times of a licensed command to filename (in the current directory)"""
+
+    is_new = not os.path.isfile(filename)
+    with open(filename, 'a') as tf:
+        if is_new:
+            tf.write('program,command,attempts,wait_time,compute_time\n')
+        tf.write('%s,"%s",%i,%.1f,%.1f\n'%(prgm, cmd.replace('"', "'"), nattempts, wait_time, compute_time))
+
+class JobStatusCache(object):
+    """Output of jobcontrol -list shared by every monitor using the same folder
+
+    jobcontrol -list is run at most once per max_age seconds whatever the number of jobs monitored
+    (more often only if a monitor needs a list more recent than the submission of its job)"""
+
+    def __init__(self, token_dir, max_age=2.0):
+        self.cachefile = os.path.join(token_dir, 'jobcontrol.json')
+        self.lockfile = os.path.join(token_dir, 'jobcontrol.lock')
+        self.max_age = max_age
+
+    def get_time(self):
+        """Get current time of the clock used for the lists (file system of the folder, shared by every host)"""
+        return cache.get_shared_time(self.lockfile)
+
+    def get_job_list(self, min_time=0):
+        """Get output of jobcontrol -list, run again if older than max_age seconds or made before min_time"""
+
+        with open(self.lockfile, 'a') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                now = self.get_time()
+                job_list = None
+                if os.path.isfile(self.cachefile):
+                    with open(self.cachefile, 'r') as cf:
+                        try:
+                            job_list = json.load(cf)
+                        except ValueError:
+                            pass
+                if job_list is None or now - job_list['time'] > self.max_age or job_list['time'] <= min_time:
+                    # status of every active job in a single call (time taken before the call so that
+                    # jobs submitted while the call is running are never considered listed)
+                    output = runner.check_output('jobcontrol -list')
+                    job_list = {'time': now, 'output': output}
+                    with open(self.cachefile + '.tmp', 'w') as cf:
+                        json.dump(job_list, cf)
+                    os.rename(self.cachefile + '.tmp', self.cachefile)
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+        return job_list['output']
+
+class SchrodingerMonitor(object):
+    """Wait for a Schrodinger job and kill it if its license is refused
+
+    New lines of the log file are read from the offset reached at the previous check. The status of
+    the job comes from a JobStatusCache shared between monitors; a job missing from a list made after
+    its submission is done. The interval between checks is doubled after each check (from min_interval
+    up to max_interval) and reset to min_interval whenever new lines are written in the log file."""
+
+    def __init__(self, logfile, jobid, token_dir=None, min_interval=2.0, max_interval=10.0, submit_time=None):
+
+        self.logfile = logfile
+        self.jobid = jobid
+        self.offset = 0
+
+        if token_dir is None:
+            token_dir = get_token_dir()
+        self.status_cache = JobStatusCache(token_dir, max_age=min_interval)
+        # a job missing from a list made before its submission is not done
+        if submit_time is None:
+            submit_time = self.status_cache.get_time()
+        self.submit_time = submit_time
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def read_new_lines(self):
+        """Read lines added to the log file since the last call"""
+
+        if not os.path.exists(self.logfile):
+            return []
+
+        with open(self.logfile, 'r') as logf:
+            logf.seek(self.offset)
+            content = logf.read()
+        # an incomplete last line is read again next time
+        end = content.rfind('\n') + 1
+        self.offset += end
+        return content[:end].splitlines()
+
+    def is_running(self):
+        return self.jobid in self.status_cache.get_job_list(min_time=self.submit_time)
+
+    def wait(self):
+        """Wait for the job to be done, returns 1 if the license was refused, 0 otherwise"""
+
+        status = 0
+        interval = self.min_interval
+        while True:
+            is_job_done = not self.is_running()
+
+            lines = []
+            if status == 0:
+                lines = self.read_new_lines()
+                for line in lines:
+                    if license_error_message in line:
+                        runner.check_output('jobcontrol -killnooutput %s'%self.jobid)
                         status = 1
-                        is_job_killed = True
-        if is_job_done:
-            break
-    return status
+                        break
+
+            if is_job_done:
+                break
+            time.sleep(interval)
+            if lines:
+                # log file changed, check again soon
+                interval = self.min_interval
+            else:
+                interval = min(2*interval, self.max_interval)
+        return status
+
+def check_schrodinger_license(logfile, jobid):
+    """Check if schrodinger exe had license issues (waits for the job to be done)"""
+    return SchrodingerMonitor(logfile, jobid).wait()
 
 def check_moe_license(logfile):
 
     status = 0
     with open(logfile) as logf:
         for line in logf:
-            if 'Licensed number of users already reached' in line:
+            if license_error_message in line:
                 status = 1
     return status
 
@@ -94,10 +417,58 @@ def check_gold_license(logfile):
     if os.path.exists(logfile):
         with open(logfile) as logf:
             for line in logf:
-                if 'Licensed number of users already reached' in line:
+                if license_error_message in line:
                     status = 1
     return status
 
+class FakeLicenseServer(object):
+    """Local license counter standing in for a license server (for tests)
+
+    Each run of a fake licensed program takes a seat for some time; when every seat is taken,
+    the run is refused with the same message as the actual license servers."""
+
+    def __init__(self, counterfile, nseats):
+        self.counterfile = counterfile
+        self.nseats = nseats
+
+    def update(self, shift):
+        """Shift the number of seats taken, returns False if no seat is free"""
+
+        with open(self.counterfile + '.lock', 'a') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                taken = 0
+                if os.path.isfile(self.counterfile):
+                    with open(self.counterfile, 'r') as cf:
+                        taken = int(cf.read() or 0)
+                if taken + shift > self.nseats:
+                    is_granted = False
+                else:
+                    taken = max(taken + shift, 0)
+                    is_granted = True
+                with open(self.counterfile, 'w') as cf:
+                    cf.write(str(taken))
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+        return is_granted
+
+    def run(self, duration, logfile=None):
+        """Simulate a licensed run of duration seconds, returns 0 if the license was granted"""
+
+        if not self.update(1):
+            message = 'Error: %s.\n'%license_error_message
+            if logfile:
+                with open(logfile, 'a') as logf:
+                    logf.write(message)
+            else:
+                sys.stdout.write(message)
+            return 1
+        try:
+            time.sleep(duration)
+        finally:
+            self.update(-1)
+        return 0
+
 def run(args):
 
     if len(args) < 2:
@@ -107,6 +478,16 @@ def run(args):
     prgm = args[1]
     status = 0
 
+    if prgm == 'run':
+        # run command with a license token: run <program> <logfile> <command>
+        return run_command(args[2], args[3], args[4])
+    elif prgm == 'fake':
+        # fake licensed program: fake <counterfile> <nseats> <duration> [<logfile>]
+        server = FakeLicenseServer(args[2], int(args[3]))
+        if len(args) > 5:
+            return server.run(float(args[4]), logfile=args[5])
+        return server.run(float(args[4]))
+
     # second argument should be the log file where to look for warning/error messages
     logfile = args[2]
 
@@ -122,4 +503,6 @@ def run(args):
 
 if __name__ == '__main__':
     status = run(sys.argv)
+    if sys.argv[1] in ['run', 'fake']:
+        sys.exit(status)
     print(status)
@@ -9,10 +9,54 @@ from glob import glob
 from mdkit.amber import minimization
 from mdkit.utility import mol2
 
+import cache
 import configure
+import parallel
+import posefilter
+import runner
+import tracing
+
+def run_rescoring_worker(args):
+    """Rescore a subset of poses within a worker directory (can be called from a worker process)"""
+
+    scoring_method, file_r, files_l, workdir, receptor_cache = args
+
+    curdir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        scoring_method.rescore_poses(file_r, files_l, 'score.out', receptor_cache=receptor_cache)
+    finally:
+        os.chdir(curdir)
+
+def read_stage_signature(marker):
+    """Read signature stored in a stage marker (None if the stage is not completed)"""
+
+    if os.path.isfile(marker):
+        with open(marker, 'r') as mf:
+            return mf.read().strip()
+
+def read_scores(file_s):
+    """Read the scores of a score file (one per line, empty if the file does not exist)"""
+
+    if not os.path.isfile(file_s):
+        return []
+    with open(file_s, 'r') as sf:
+        return [line.strip() for line in sf if line.strip()]
+
+def write_scores(file_s, scores):
+    with open(file_s, 'w') as sf:
+        for score in scores:
+            sf.write(score+'\n')
+
+def write_stage_signature(marker, signature):
+    with open(marker, 'w') as mf:
+        mf.write(signature + '\n')
 
 class DockingMethod(object):
 
+    # messages in the log file of a failed run indicating that the run would fail again with the same inputs
+    deterministic_failures = []
+
     def __init__(self, instance, site, options):
         """Initialize docking instance"""
 
@@ -22,26 +66,30 @@ class DockingMethod(object):
 
         self.program = self.__class__.__name__.lower()
 
-    def run_docking(self, file_r, file_l, minimize_options=None, cleanup=0, prepare_only=False, skip_docking=False):
+    def run_docking(self, file_r, file_l, minimize_options=None, filter_options=None, cleanup=0, prepare_only=False, skip_docking=False, receptor_cache=None, result_cache=None, resume=False):
         """Run docking one (file per ligand and receptor)"""
 
         curdir = os.getcwd()
-        # find name for docking directory
-        if 'name' in self.options:
-            dockdir = self.options['name']
-        else:
-            dockdir = self.instance
-
-        if self.site[0]:
-            dockdir += '.' + self.site[0]
+        dockdir = self.get_dockdir()
+        filter_options = self.get_filter_options(filter_options)
+        self.stage_signatures = self.get_stage_signatures(file_r, file_l, minimize_options, filter_options)
 
         if not skip_docking:
-            # create directory for docking (remove directory if exists)
-            shutil.rmtree(dockdir, ignore_errors=True)
-            os.mkdir(dockdir)
+            if resume and self.is_resumable(dockdir):
+                print "Resuming docking with %s from completed stages..."%self.program.capitalize()
+            else:
+                # create directory for docking (remove directory if exists)
+                shutil.rmtree(dockdir, ignore_errors=True)
+                os.mkdir(dockdir)
+                resume = False
         os.chdir(dockdir)
 
         if not skip_docking:
+            if resume and self.is_stage_done('filter'):
+                os.chdir(curdir)
+                print "Docking with %s already done."%self.program.capitalize()
+                return
+
             print "Starting docking with %s..."%self.program.capitalize()
             print "The following options will be used:"
             options_info = ""
@@ -49,33 +97,76 @@ class DockingMethod(object):
                 options_info += str(key) + ': ' + str(value) + ', '
             print options_info[:-2]
 
+            # restore results of a previous run done with the same inputs
+            result_key = None
+            if result_cache is not None and not prepare_only:
+                result_key = result_cache.get_key(file_r, file_l, self.program, self.site, self.options, minimize_options, filter_options)
+                with tracing.span('cache_lookup', category=self.program):
+                    is_restored = not resume and self.restore_results(result_cache, result_key, dockdir)
+                if is_restored:
+                    os.chdir(curdir)
+                    return
+
             # (A) run docking
             script_name = "run_" + self.program + ".sh"
-            self.write_docking_script(script_name, file_r, file_l)
-            os.chmod(script_name, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IXUSR)
+            if not (resume and self.is_stage_done('script')):
+                with tracing.span('script', category=self.program):
+                    self.write_docking_script(script_name, file_r, file_l)
+                os.chmod(script_name, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IXUSR)
+                self.set_stage_done('script')
+
+            # link receptor files prepared in previous runs
+            is_receptor_cached = self.fetch_receptor_files(receptor_cache, file_r)
 
             if prepare_only:
                 return
-            try:
-                # try running docking procedure
-                subprocess.check_output('./' + script_name + " &> " + self.program + ".log", shell=True, executable='/bin/bash')
-            except subprocess.CalledProcessError as e:
-                print e
-                print "Error: check %s file for more details!"%(dockdir+'/'+self.program+'.log')
-                os.chdir(curdir)
-                return
+
+            if not (resume and self.is_stage_done('docking')):
+                tracing.reset_script_stages()
+                try:
+                    # try running docking procedure
+                    with tracing.span('run_script', category=self.program):
+                        runner.check_output('./' + script_name + " &> " + self.program + ".log")
+                        tracing.add_script_stages(category=self.program)
+                except subprocess.CalledProcessError as e:
+                    tracing.add_script_stages(category=self.program)
+                    print e
+                    print "Error: check %s file for more details!"%(dockdir+'/'+self.program+'.log')
+                    if result_key and self.is_deterministic_failure(self.program+'.log'):
+                        result_cache.store_failure(result_key, self.program+'.log')
+                    os.chdir(curdir)
+                    return
+                self.set_stage_done('docking')
+
+                if not is_receptor_cached:
+                    self.store_receptor_files(receptor_cache, file_r)
 
         if prepare_only:
             return
 
         # (B) extract docking results
-        self.extract_docking_results('score.out', file_r, file_l)
+        if not (resume and self.is_stage_done('extraction')):
+            with tracing.span('extraction', category=self.program):
+                self.remove_results()
+                self.extract_docking_results('score.out', file_r, file_l)
+            self.set_stage_done('extraction')
 
         # (C) cleanup poses (minimization, remove out-of-box poses)
-        if minimize_options['minimization']:
-            self.backup_files('origin')
-            self.minimize_extracted_poses(file_r, 'score.out', cleanup=cleanup, **minimize_options)
-        self.remove_out_of_range_poses('score.out')
+        if minimize_options['minimization'] and not (resume and self.is_stage_done('minimization')):
+            with tracing.span('minimization', category=self.program):
+                self.start_stage(resume)
+                self.backup_files('origin')
+                self.minimize_extracted_poses(file_r, 'score.out', cleanup=cleanup, **minimize_options)
+            self.end_stage('minimization')
+
+        if not (resume and self.is_stage_done('filter')):
+            with tracing.span('filter', category=self.program):
+                self.start_stage(resume)
+                self.filter_poses('score.out', **filter_options)
+            self.end_stage('filter')
+
+        if not skip_docking and result_key:
+            self.store_results(result_cache, result_key)
 
         # (D) remove intermediate files if required
         if cleanup >= 1:
@@ -84,28 +175,54 @@ class DockingMethod(object):
         os.chdir(curdir)
         print "Docking with %s done."%self.program.capitalize()
 
-    def run_rescoring(self, file_r, files_l):
-        """Rescore multiple ligands on one receptor"""
+    def run_rescoring(self, file_r, files_l, workdir='.', nworkers=1, receptor_cache=None, signature=None, resume=False):
+        """Rescore multiple ligands on one receptor (signature identifies the poses and options rescored)"""
 
         curdir = os.getcwd()
         # get name of rescoring from instance
         rescordir = self.instance
         if self.site[0]:
             rescordir += '.' + self.site[0]
+        rescordir = os.path.join(workdir, rescordir)
+
+        marker = os.path.join(rescordir, self.get_stage_marker('rescoring'))
+        if resume and signature and os.path.isfile(rescordir + '/score.out') and read_stage_signature(marker) == signature:
+            print "Rescoring with %s already done."%self.program.capitalize()
+            return rescordir + '/score.out'
 
         # overwrite previous directory if exists
         shutil.rmtree(rescordir, ignore_errors=True)
         os.mkdir(rescordir)
 
-        # change directory
+        # change directory (scripts and outputs of every program are written in the current directory)
         os.chdir(rescordir)
+        try:
+            mol2files = files_l
+            if self.program in configure.single_run_scoring_programs or (self.program == 'colvar' and self.options['type'] == 'sasa'):
+                # if the program rescores in one run, provides a list of files
+                mol2files = [mol2files]
+
+            if mol2files:
+                nworkers = min(parallel.get_nprocs(nworkers), len(mol2files))
+                if nworkers > 1:
+                    self.rescore_poses_in_workers(file_r, mol2files, 'score.out', nworkers, receptor_cache=receptor_cache)
+                else:
+                    self.rescore_poses(file_r, mol2files, 'score.out', receptor_cache=receptor_cache)
+            else:
+                # if no files provided, create an empty score.out file
+                open('score.out', 'w').close()
 
-        mol2files = files_l
-        if self.program in configure.single_run_scoring_programs or (self.program == 'colvar' and self.options['type'] == 'sasa'):
-            # if the program rescores in one run, provides a list of files
-            mol2files = [mol2files]
+            if signature:
+                write_stage_signature(self.get_stage_marker('rescoring'), signature)
 
-        if mol2files:
+        finally:
+            os.chdir(curdir)
+        return rescordir + '/score.out'
+
+    def rescore_poses(self, file_r, mol2files, file_s, receptor_cache=None):
+        """Rescore poses one after the other in the current directory"""
+
+        with tracing.span('rescoring', category=self.program):
             # iterate over all the poses
             for idx, file_l in enumerate(mol2files):
                 # (A) write script
@@ -114,8 +231,11 @@ class DockingMethod(object):
                 os.chmod(script_name, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IXUSR)
 
                 # (B) run scoring method
+                is_receptor_cached = self.fetch_receptor_files(receptor_cache, file_r)
                 try:
-                    subprocess.check_output('./' + script_name + ' &> ' + self.program + '.log', shell=True, executable='/bin/bash')
+                    runner.check_output('./' + script_name + ' &> ' + self.program + '.log')
+                    if not is_receptor_cached:
+                        self.store_receptor_files(receptor_cache, file_r)
                 except subprocess.CalledProcessError as e:
                     print e.output
                     pass
@@ -123,15 +243,202 @@ class DockingMethod(object):
                 # (C) extract rescoring results
                 if self.program in configure.single_run_scoring_programs:
                     nligands = len(file_l)
-                    self.extract_rescoring_results('score.out', nligands=nligands)
+                    self.extract_rescoring_results(file_s, nligands=nligands)
                 else:
-                    self.extract_rescoring_results('score.out')
+                    nscores = len(read_scores(file_s))
+                    self.extract_rescoring_results(file_s)
+                    # exactly one score per pose so that a failed pose does not shift the scores of the next ones
+                    scores = read_scores(file_s)
+                    if len(scores) == nscores:
+                        print "Warning: no score found for pose %s, score set to NaN!"%file_l
+                        write_scores(file_s, scores + ['NaN'])
+                    elif len(scores) > nscores + 1:
+                        print "Warning: %i scores found for pose %s, only the first one is kept!"%(len(scores)-nscores, file_l)
+                        write_scores(file_s, scores[:nscores+1])
+
+    def rescore_poses_in_workers(self, file_r, mol2files, file_s, nworkers, receptor_cache=None):
+        """Split poses among worker directories rescored in parallel, scores are merged in the original order"""
+
+        # split poses into contiguous chunks of (almost) equal sizes
+        nfiles = len(mol2files)
+        chunks = []
+        first = 0
+        for idx in range(nworkers):
+            last = first + nfiles/nworkers + int(idx < nfiles%nworkers)
+            chunks.append(mol2files[first:last])
+            first = last
+
+        jobs = []
+        workdirs = []
+        for idx, chunk in enumerate(chunks):
+            workdir = 'worker-%i'%(idx+1)
+            os.mkdir(workdir)
+            workdirs.append(workdir)
+            jobs.append((self, file_r, chunk, os.path.abspath(workdir), receptor_cache))
+
+        parallel.run_jobs(run_rescoring_worker, jobs, nprocs=nworkers)
+
+        # merge scores of every worker (each pose has exactly one score unless the worker failed)
+        scores = []
+        for workdir, chunk in zip(workdirs, chunks):
+            scores_worker = read_scores(workdir+'/'+file_s)
+            if len(scores_worker) != len(chunk):
+                raise ValueError("%i scores found in %s/%s for %i poses, rescoring worker failed!"%(len(scores_worker), \
+os.path.abspath(workdir), file_s, len(chunk)))
+            scores.extend(scores_worker)
+        write_scores(file_s, scores)
+
+        # worker folders hold copies of the scripts and files of every pose
+        for workdir in workdirs:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def get_dockdir(self):
+        """Get name of docking directory"""
+
+        if 'name' in self.options:
+            dockdir = self.options['name']
         else:
-            # if no files provided, create an empty score.out file
-            open('score.out', 'w').close()
+            dockdir = self.instance
 
-        os.chdir(curdir)
-        return rescordir + '/score.out'
+        if self.site[0]:
+            dockdir += '.' + self.site[0]
+        return dockdir
+
+    def is_resumable(self, dockdir):
+        """Check if docking can be resumed in dockdir from the stages already completed"""
+
+        if not os.path.isdir(dockdir):
+            return False
+
+        # the log file is created as soon as the docking script is launched; if docking
+        # was interrupted, the folder may contain incomplete files and docking is restarted
+        if self.is_stage_done('docking', dockdir=dockdir):
+            return True
+        return self.is_stage_done('script', dockdir=dockdir) and \
+            not os.path.exists(os.path.join(dockdir, self.program + '.log'))
+
+    def get_stage_signatures(self, file_r, file_l, minimize_options, filter_options):
+        """Get signatures of the docking stages (a completed stage is run again if its signature changed)"""
+
+        signature = cache.get_hash(cache.get_file_hash(file_r), cache.get_file_hash(file_l), self.program, self.site, self.options)
+        # poses are modified in place, they are extracted again whenever minimization or filter options change
+        signature_poses = cache.get_hash(signature, minimize_options, filter_options)
+        return {'script': signature, 'docking': signature, 'extraction': signature_poses, 'minimization': signature_poses, 'filter': signature_poses}
+
+    def get_stage_marker(self, stage):
+        return '.dbx_' + stage
+
+    def is_stage_done(self, stage, dockdir='.'):
+        return read_stage_signature(os.path.join(dockdir, self.get_stage_marker(stage))) == self.stage_signatures[stage]
+
+    def set_stage_done(self, stage):
+        write_stage_signature(self.get_stage_marker(stage), self.stage_signatures[stage])
+
+    def start_stage(self, resume):
+        """Save output mol2files and score file before a stage modifying them in place (restore them first if resuming)"""
+
+        backupdir = self.get_stage_marker('backup')
+        if resume and os.path.isdir(backupdir):
+            # restore files as they were before the interrupted stage
+            self.remove_results()
+            for filename in os.listdir(backupdir):
+                shutil.copyfile(os.path.join(backupdir, filename), filename)
+
+        # the backup is written in a temporary folder so that an incomplete backup is never restored
+        shutil.rmtree(backupdir + '.tmp', ignore_errors=True)
+        os.mkdir(backupdir + '.tmp')
+        for filename in self.get_output_mol2files() + glob('score.out'):
+            shutil.copyfile(filename, os.path.join(backupdir + '.tmp', filename))
+        shutil.rmtree(backupdir, ignore_errors=True)
+        os.rename(backupdir + '.tmp', backupdir)
+
+    def end_stage(self, stage):
+        # the backup is removed first; if interrupted in between, the stage is simply done again
+        shutil.rmtree(self.get_stage_marker('backup'), ignore_errors=True)
+        self.set_stage_done(stage)
+
+    def remove_results(self):
+        """Remove output mol2files and score file"""
+        for filename in self.get_output_mol2files() + glob('score.out'):
+            os.remove(filename)
+
+    def restore_results(self, result_cache, result_key, dockdir):
+        """Link results of a previous run in the current directory, returns True if they were found"""
+
+        filenames = result_cache.fetch_results(result_key)
+        if filenames is None:
+            return False
+
+        if result_cache.failure_file in filenames:
+            os.rename(result_cache.failure_file, self.program + '.log')
+            print "Error: docking with %s already failed with the same inputs, check %s file for more details!"%(self.program.capitalize(), dockdir+'/'+self.program+'.log')
+        else:
+            for stage in ['script', 'docking', 'extraction', 'minimization', 'filter']:
+                self.set_stage_done(stage)
+            print "Docking with %s done (results restored from cache)."%self.program.capitalize()
+        return True
+
+    def store_results(self, result_cache, result_key):
+        """Store output mol2files and score file of the current directory in the cache"""
+
+        filenames = self.get_output_mol2files()
+        if os.path.isfile('score.out'):
+            filenames.append('score.out')
+        result_cache.store(result_key, filenames)
+
+    def is_deterministic_failure(self, logfile):
+        """Check if a failed run would fail again with the same inputs"""
+
+        if not self.deterministic_failures or not os.path.isfile(logfile):
+            return False
+
+        with open(logfile, 'r') as lf:
+            content = lf.read()
+        return any(message in content for message in self.deterministic_failures)
+
+    def get_filter_options(self, filter_options):
+        """Get options of the pose filters for the current instance (max_score.<instance> overrides max_score)"""
+
+        if filter_options is None:
+            filter_options = configure.default_filter_options
+
+        options = {}
+        for key in configure.default_filter_options:
+            options[key] = filter_options.get(key, configure.default_filter_options[key])
+        options['max_score'] = filter_options.get('max_score.' + self.instance, options['max_score'])
+        return options
+
+    def get_receptor_files(self):
+        """Files prepared from the receptor only, i.e., which can be reused for any ligand"""
+        return []
+
+    def get_receptor_options(self):
+        """Options used to prepare the receptor files"""
+        return {}
+
+    def fetch_receptor_files(self, receptor_cache, file_r):
+        """Link receptor files from the cache in the current directory, returns True if the files are available"""
+
+        filenames = self.get_receptor_files()
+        if receptor_cache is None or not filenames:
+            return False
+
+        if all(os.path.isfile(filename) for filename in filenames):
+            return True
+
+        key = receptor_cache.get_key(file_r, filenames, self.get_receptor_options())
+        return receptor_cache.fetch(key, filenames)
+
+    def store_receptor_files(self, receptor_cache, file_r):
+        """Store receptor files of the current directory in the cache"""
+
+        filenames = self.get_receptor_files()
+        if receptor_cache is None or not filenames:
+            return
+
+        if all(os.path.isfile(filename) for filename in filenames):
+            key = receptor_cache.get_key(file_r, filenames, self.get_receptor_options())
+            receptor_cache.store(key, filenames)
 
     def get_output_mol2files(self):
         """Get output mol2files sorted by pose ranking after docking"""
@@ -167,9 +474,11 @@ class DockingMethod(object):
             if nligands:
                 # consistency check
                 assert nligands == idx+1, "number of ligand mol2files should be equal to number of lines in score.out"
-            with open(file_s, 'w') as sf:
+            # the file is replaced at once so that it is never left partially written
+            with open(file_s + '.tmp', 'w') as sf:
                 for line in new_content:
                     sf.write(line)
+            os.rename(file_s + '.tmp', file_s)
 
     def minimize_extracted_poses(self, file_r, file_s, cleanup=0, **minimize_options):
         """Perform AMBER minimization on extracted poses"""
@@ -203,36 +512,32 @@ ncyc=minimize_options['ncyc'], maxcyc=minimize_options['maxcyc'], cut=minimize_o
             # if cleanup is more than 1, remove EM directory
             shutil.rmtree('em', ignore_errors=True)
 
-    def remove_out_of_range_poses(self, file_s):
-        """Get rid of poses which were predicted outside the box"""
+    def filter_poses(self, file_s, **filter_options):
+        """Remove poses rejected by the pose filters (box, extent, clash, score) together with their scores"""
 
         mol2files = self.get_output_mol2files()
         if mol2files:
-            sitename, center, boxsize = self.site
-            # get values of docking box center and boxsize
-            center = map(float, center.split(','))
-            boxsize = map(float, boxsize.split(','))
- 
-            out_of_range_idxs = []
-            for jdx, filename in enumerate(mol2files):
-                is_out = False
-                for coord in mol2.get_coordinates(filename):
-                    for idx, value in enumerate(coord):
-                        # check if the pose is out of the box
-                        if abs(value - center[idx]) > boxsize[idx]*1./2:
-                            is_out = True
-                            break
-                    if is_out:
-                        os.remove(filename)
-                        out_of_range_idxs.append(jdx)
-                        break
-            # remove scores of failed poses
-            self.remove_scores_from_scorefile(file_s, out_of_range_idxs, nligands=len(mol2files))
-
-            if out_of_range_idxs:
+            scores = []
+            if os.path.isfile(file_s):
+                with open(file_s, 'r') as sf:
+                    scores = [float(line) for line in sf if line.strip()]
+            if len(scores) != len(mol2files):
+                # scores are only used by the score filter
+                scores = [float('nan')]*len(mol2files)
+
+            kept, counts = posefilter.filter_poses(mol2files, scores, self.site, **filter_options)
+            rejected_idxs = [idx for idx in range(len(mol2files)) if not kept[idx]]
+
+            # remove rejected poses and their scores at once
+            for idx in rejected_idxs:
+                os.remove(mol2files[idx])
+            self.remove_scores_from_scorefile(file_s, rejected_idxs, nligands=len(mol2files))
+
+            if counts:
+                print "Pose filters: " + ', '.join("%s: %i rejected"%(name, count) for name, count in counts.iteritems())
+            if rejected_idxs:
                 # display warning message
-                out_of_range_mol2files = [mol2files[idx] for idx in out_of_range_idxs]
-                print "Warning: poses %s were found out of the box, poses were removed!"%(', '.join(out_of_range_mol2files))
+                print "Warning: poses %s were rejected by the pose filters, poses were removed!"%(', '.join(mol2files[idx] for idx in rejected_idxs))
 
     def cleanup(self):
         """Remove all intermediate files"""
@@ -257,7 +562,7 @@ class ScoringMethod(DockingMethod):
     def run_docking(self, file_r, file_l, minimize=False, cleanup=0, extract_only=False):
         pass
 
-    def remove_out_of_range_poses(self, file_s):
+    def filter_poses(self, file_s, **filter_options):
         pass
 
     def minimize_extracted_poses(self, file_r):
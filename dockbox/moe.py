@@ -2,9 +2,9 @@ import os
 import sys
 import glob
 import shutil
-import subprocess
 import method
 import license
+import runner
 
 from mdkit.utility import reader
 from mdkit.utility import mol2
@@ -238,16 +238,20 @@ endfunction;"""% locals()
     
     def extract_docking_results(self, file_s, input_file_r, input_file_l):
 
-        subprocess.check_output(license.wrap_command("moebatch -exec \"db_ExportTriposMOL2 ['dock.mdb', 'poses.mol2', 'mol', []]\"", 'moe'), shell=True, executable='/bin/bash')
+        # poses (.mol2) and scores (SDF) are exported at the same time, so are the waits for the license tokens
+        sdffile = 'ligand.sdf'
+        jobs = [runner.submit(license.wrap_command("moebatch -exec \"db_ExportTriposMOL2 ['dock.mdb', 'poses.mol2', 'mol', []]\"", 'moe'), \
+resources={'cores': 1, 'moe': 1}),
+            runner.submit(license.wrap_command("moebatch -exec \"db_ExportSD ['dock.mdb', '%s', ['mol','S'], []]\""%sdffile, 'moe', \
+logfile='moebatch_sd.log'), resources={'cores': 1, 'moe': 1})]
+        runner.check_jobs(jobs)
 
         if os.path.exists('poses.mol2'):
             ligname = reader.open(input_file_l).ligname
             mol2.update_mol2file('poses.mol2', 'pose-.mol2', ligname=ligname, multi=True)
             os.remove('poses.mol2')
 
-            # get SDF to extract scores
-            sdffile = 'ligand.sdf'
-            subprocess.check_output(license.wrap_command("moebatch -exec \"db_ExportSD ['dock.mdb', '%s', ['mol','S'], []]\""%sdffile, 'moe'), shell=True, executable='/bin/bash')
+            # get scores from SDF
             with open(sdffile, 'r') as sdff:
                 with open(file_s, 'w') as sf:
                     for line in sdff:
@@ -255,6 +259,8 @@ endfunction;"""% locals()
                             sf.write(sdff.next().strip()+'\n')
             os.remove(sdffile)
         else:
+            if os.path.exists(sdffile):
+                os.remove(sdffile)
             open(file_s, 'w').close()
     
     def write_rescoring_script(self, filename, file_r, file_l):
@@ -479,7 +485,8 @@ endfunction;" > moe_rescoring.svl
         else:
             # get SDF to extract scores
             sdffile = 'ligand.sdf'
-            subprocess.check_output(license.wrap_command("moebatch -exec \"db_ExportSD ['dock.mdb', '%s', ['mol','S'], []]\""%sdffile, 'moe'), shell=True, executable='/bin/bash')
+            runner.check_output(license.wrap_command("moebatch -exec \"db_ExportSD ['dock.mdb', '%s', ['mol','S'], []]\""%sdffile, 'moe'), \
+resources={'cores': 1, 'moe': 1})
             with open(file_s, 'a') as sf:
                 if os.path.exists(sdffile):
                     with open(sdffile, 'r') as sdff:
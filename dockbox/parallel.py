@@ -0,0 +1,51 @@
+import sys
+import multiprocessing
+import multiprocessing.pool
+
+class NoDaemonProcess(multiprocessing.Process):
+    """Process that can itself start child processes (e.g., nested pools)"""
+
+    def _get_daemon(self):
+        return False
+
+    def _set_daemon(self, value):
+        pass
+
+    daemon = property(_get_daemon, _set_daemon)
+
+class Pool(multiprocessing.pool.Pool):
+    Process = NoDaemonProcess
+
+def get_nprocs(nprocs):
+    """Get number of processes to be used (0 or negative values means all the cores available)"""
+
+    if nprocs is None:
+        return 1
+    nprocs = int(nprocs)
+    if nprocs <= 0:
+        return multiprocessing.cpu_count()
+    return nprocs
+
+def run_jobs(func, jobs, nprocs=1):
+    """Run func on each job of jobs using at most nprocs processes, results are returned in the same order as jobs
+
+    func should be defined at the module level so that it can be sent to the worker processes"""
+
+    nprocs = min(get_nprocs(nprocs), len(jobs))
+    if nprocs <= 1:
+        return map(func, jobs)
+
+    # flush stdout so that buffered messages are not duplicated in worker processes
+    sys.stdout.flush()
+
+    pool = Pool(processes=nprocs)
+    try:
+        # get is given a timeout so that the main process can be interrupted with Ctrl-C
+        results = pool.map_async(func, jobs, chunksize=1).get(9999999)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
@@ -0,0 +1,107 @@
+import numpy as np
+
+from collections import OrderedDict
+
+# filters applied to the poses of each instance, in the order they are reported
+known_filters = ['box', 'extent', 'clash', 'score']
+
+def is_bond_record(line_s):
+    """Check that a line of the BOND section (split) is a bond record (bond ID and indices of both atoms)"""
+    return len(line_s) >= 3 and all(field.isdigit() for field in line_s[:3])
+
+def read_pose(filename):
+    """Read coordinates, atom types and bonds (0-based atom indices) of a .mol2 file with one structure
+    (blank and comment lines are skipped, e.g., scores of the next pose left by the splitter in DOCK poses)"""
+
+    coords = []
+    types = []
+    bonds = []
+
+    section = None
+    with open(filename, 'r') as mol2f:
+        for line in mol2f:
+            if line.startswith('@<TRIPOS>'):
+                section = line.strip()[9:]
+            elif not line.strip() or line.startswith('#'):
+                continue
+            elif section == 'ATOM':
+                line_s = line.split()
+                coords.append(map(float, line_s[2:5]))
+                types.append(line_s[5])
+            elif section == 'BOND':
+                line_s = line.split()
+                if is_bond_record(line_s):
+                    bonds.append((int(line_s[1])-1, int(line_s[2])-1))
+    return coords, types, tuple(bonds)
+
+def get_excluded_pairs(natoms, bonds):
+    """Get mask of the pairs of atoms not checked for clashes (same atom, 1-2 and 1-3 pairs)"""
+
+    bonded = np.zeros((natoms, natoms), dtype=bool)
+    for idx, jdx in bonds:
+        bonded[idx, jdx] = bonded[jdx, idx] = True
+    angles = np.dot(bonded.astype(int), bonded.astype(int)) > 0
+    return bonded | angles | np.eye(natoms, dtype=bool)
+
+def check_poses(coords, types, bonds, site, box=True, max_extent=None, clash_distance=None):
+    """Check poses sharing the same topology (coords of shape (nposes, natoms, 3)) with geometric filters,
+    returns a boolean array (nposes,) of rejected poses per filter"""
+
+    rejected = {}
+    if box:
+        sitename, center, boxsize = site
+        center = np.array(map(float, center.split(',')))
+        boxsize = np.array(map(float, boxsize.split(',')))
+        # every atom should be inside the box
+        rejected['box'] = np.any(np.abs(coords - center) > boxsize*1./2, axis=(1, 2))
+
+    if max_extent is not None:
+        # largest dimension of the box enclosing each pose
+        rejected['extent'] = np.max(coords.max(axis=1) - coords.min(axis=1), axis=1) > max_extent
+
+    if clash_distance is not None:
+        # distances between the non-hydrogen atoms which are neither bonded nor in the same angle
+        heavy_atoms = np.array([type[0].lower() != 'h' for type in types], dtype=bool)
+        excluded = get_excluded_pairs(len(types), bonds)[np.ix_(heavy_atoms, heavy_atoms)]
+
+        coords_h = coords[:,heavy_atoms]
+        distances = np.sqrt(np.sum((coords_h[:,:,np.newaxis,:] - coords_h[:,np.newaxis,:,:])**2, axis=3))
+        distances[:,excluded] = np.inf
+        rejected['clash'] = np.any(distances < clash_distance, axis=(1, 2))
+    return rejected
+
+def filter_poses(mol2files, scores, site, box=True, max_extent=None, clash_distance=None, max_score=None):
+    """Apply filters to the poses of an instance (mol2files with their docking scores), returns a boolean array
+    of the poses kept and the number of poses rejected by each filter (a pose can be rejected by several filters)"""
+
+    nposes = len(mol2files)
+    rejected = OrderedDict()
+
+    # poses are loaded in one array per topology (usually one per instance)
+    groups = OrderedDict()
+    for idx, filename in enumerate(mol2files):
+        coords, types, bonds = read_pose(filename)
+        key = (tuple(types), bonds)
+        if key not in groups:
+            groups[key] = ([], [])
+        groups[key][0].append(idx)
+        groups[key][1].append(coords)
+
+    for (types, bonds), (indices, coords) in groups.iteritems():
+        rejected_group = check_poses(np.array(coords), types, bonds, site, box=box, max_extent=max_extent, clash_distance=clash_distance)
+        for name, values in rejected_group.iteritems():
+            if name not in rejected:
+                rejected[name] = np.zeros(nposes, dtype=bool)
+            rejected[name][indices] = values
+
+    if max_score is not None:
+        # lower scores are better, poses without score are kept
+        with np.errstate(invalid='ignore'):
+            rejected['score'] = np.array(scores, dtype=float) > max_score
+
+    kept = np.ones(nposes, dtype=bool)
+    for values in rejected.itervalues():
+        kept &= ~values
+
+    counts = OrderedDict((name, int(np.sum(rejected[name]))) for name in known_filters if name in rejected)
+    return kept, counts
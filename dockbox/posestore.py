@@ -0,0 +1,226 @@
+import os
+import re
+import shutil
+import numpy as np
+
+from collections import OrderedDict
+from mdkit.utility import mol2
+
+import posefilter
+
+# files of a pose archive, the poses of a poses folder are stored as:
+#  - topology.mol2: one .mol2 block for each topology (atoms and bonds) shared by the poses
+#  - coords.npy: coordinates of the atoms of every pose (float32, one row per atom)
+#  - index.npy: first row in coords.npy, number of atoms and topology of pose-N.mol2 (row N-1)
+topology_file = 'topology.mol2'
+coords_file = 'coords.npy'
+index_file = 'index.npy'
+
+# archives already opened (posedir, modification time of the index) -> PoseArchive, kept in a LRU cache since each
+# memory-mapped coords.npy keeps a file descriptor open
+archives = OrderedDict()
+archives_size = 64
+
+def read_mol2(filename):
+    """Read a .mol2 file with one structure, returns its lines (starting from the first section),
+    the coordinates of the atoms and the signature of its topology (atoms and bonds)"""
+
+    lines = []
+    coords = []
+    signature = []
+
+    section = None
+    with open(filename, 'r') as mol2f:
+        for line in mol2f:
+            if line.startswith('#'):
+                # comment lines (e.g., scores of the pose before the first section or scores of the next pose left
+                # at the end by the splitter) are not kept
+                continue
+            elif line.startswith('@<TRIPOS>'):
+                section = line.strip()[9:]
+            elif section == 'ATOM' and line.strip():
+                line_s = line.split()
+                coords.append(map(float, line_s[2:5]))
+                signature.append(tuple(line_s[:2] + line_s[5:]))
+            elif section == 'BOND' and posefilter.is_bond_record(line.split()):
+                signature.append(line.strip())
+            if section is not None:
+                lines.append(line)
+    return lines, coords, tuple(signature)
+
+def write_archive(posedir, mol2files):
+    """Store mol2files as a pose archive in posedir (mol2files[N-1] becoming pose N)"""
+
+    topologies = {}
+    blocks = []
+    coords = []
+    index = np.zeros((len(mol2files), 3), dtype=np.int64)
+
+    for idx, filename in enumerate(mol2files):
+        lines, coords_pose, signature = read_mol2(filename)
+        if signature not in topologies:
+            topologies[signature] = len(blocks)
+            blocks.append(lines)
+        index[idx] = [len(coords), len(coords_pose), topologies[signature]]
+        coords.extend(coords_pose)
+
+    with open(os.path.join(posedir, topology_file), 'w') as tf:
+        for lines in blocks:
+            tf.writelines(lines)
+    np.save(os.path.join(posedir, coords_file), np.array(coords, dtype=np.float32).reshape((-1, 3)))
+    np.save(os.path.join(posedir, index_file), index)
+
+def has_archive(posedir):
+    return os.path.isfile(os.path.join(posedir, index_file))
+
+def get_archive_size(posedir):
+    """Get number of poses of the pose archive of posedir from the header of the index (the archive is not opened)"""
+
+    with open(os.path.join(posedir, index_file), 'rb') as indexf:
+        version = np.lib.format.read_magic(indexf)
+        if version == (1, 0):
+            shape = np.lib.format.read_array_header_1_0(indexf)[0]
+        else:
+            shape = np.lib.format.read_array_header_2_0(indexf)[0]
+    return shape[0]
+
+def get_archive(posedir):
+    """Get pose archive of posedir (kept open in a LRU cache, the archive is opened again if modified)"""
+
+    posedir = os.path.abspath(posedir)
+    key = (posedir, os.path.getmtime(os.path.join(posedir, index_file)))
+    if key in archives:
+        archive = archives.pop(key)
+    else:
+        archive = PoseArchive(posedir)
+        if len(archives) >= archives_size:
+            archives.popitem(last=False)[1].close()
+    archives[key] = archive
+    return archive
+
+class PoseArchive(object):
+    """Poses of a poses folder stored as a pose archive (see write_archive), coordinates are memory-mapped"""
+
+    def __init__(self, posedir):
+
+        self.posedir = posedir
+        self.index = np.load(os.path.join(posedir, index_file))
+        self.coords = None
+
+        self.topologies = []
+        with open(os.path.join(posedir, topology_file), 'r') as tf:
+            for line in tf:
+                if line.startswith('@<TRIPOS>MOLECULE'):
+                    self.topologies.append([])
+                self.topologies[-1].append(line)
+
+        # mask of the non-hydrogen atoms of each topology (same criterion as mol2.get_coordinates)
+        self.heavy_atoms = []
+        for lines in self.topologies:
+            self.heavy_atoms.append(np.array([line.split()[5][0].lower() != 'h' for line in self.get_atom_lines(lines)], dtype=bool))
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_coords(self):
+        """Get memory-mapped coordinates of the atoms of every pose (mapped again if the archive was closed)"""
+
+        if self.coords is None:
+            if len(self.index):
+                self.coords = np.load(os.path.join(self.posedir, coords_file), mmap_mode='r')
+            else:
+                # empty files cannot be memory-mapped
+                self.coords = np.zeros((0, 3), dtype=np.float32)
+        return self.coords
+
+    def close(self):
+        """Release the memory map of the coordinates (and its file descriptor)"""
+        self.coords = None
+
+    def get_atom_lines(self, lines):
+
+        section = None
+        for line in lines:
+            if line.startswith('@<TRIPOS>'):
+                section = line.strip()[9:]
+            elif section == 'ATOM' and line.strip():
+                yield line
+
+    def get_coordinates(self, pose, keep_h=True):
+        """Get coordinates of pose (numbered from 1 as pose-N.mol2 files)"""
+
+        first, natoms, topology = self.index[pose-1]
+        coords = self.get_coords()[first:first+natoms]
+        if not keep_h:
+            coords = coords[self.heavy_atoms[topology]]
+        return np.array(coords, dtype=float)
+
+    def write_pose(self, pose, filename):
+        """Write pose as a .mol2 file"""
+
+        first, natoms, topology = self.index[pose-1]
+        coords = np.array(self.get_coords()[first:first+natoms])
+
+        section = None
+        idx = 0
+        with open(filename, 'w') as mol2f:
+            for line in self.topologies[topology]:
+                if line.startswith('@<TRIPOS>'):
+                    section = line.strip()[9:]
+                elif section == 'ATOM' and line.strip():
+                    # replace coordinates keeping the columns of the original file
+                    fields = re.findall(r'\s*\S+', line.rstrip('\n'))
+                    for jdx in range(3):
+                        width = len(fields[jdx+2])
+                        fields[jdx+2] = ('%.4f'%coords[idx,jdx]).rjust(width)
+                        if not fields[jdx+2][0].isspace():
+                            fields[jdx+2] = ' ' + fields[jdx+2]
+                    line = ''.join(fields) + '\n'
+                    idx += 1
+                mol2f.write(line)
+
+    def export(self, outputdir, poses=None):
+        """Write poses (every pose if None) as pose-N.mol2 files in outputdir, returns the filenames"""
+
+        if poses is None:
+            poses = range(1, len(self)+1)
+
+        filenames = []
+        for pose in poses:
+            filename = os.path.join(outputdir, 'pose-%i.mol2'%pose)
+            self.write_pose(pose, filename)
+            filenames.append(filename)
+        return filenames
+
+def get_pose_number(filename):
+    return int(os.path.basename(filename).split('.')[-2].split('-')[-1])
+
+def has_pose(filename):
+    """Check if a pose-N.mol2 file exists, either as a file or in the pose archive of its folder"""
+
+    if os.path.isfile(filename):
+        return True
+    posedir = os.path.dirname(filename) or '.'
+    return has_archive(posedir) and 0 < get_pose_number(filename) <= get_archive_size(posedir)
+
+def get_pose_mtime(filename):
+    """Get modification time of a pose-N.mol2 file, or of the pose archive of its folder if the file does not exist"""
+
+    if os.path.isfile(filename):
+        return os.path.getmtime(filename)
+    return os.path.getmtime(os.path.join(os.path.dirname(filename) or '.', index_file))
+
+def get_coordinates(filename, keep_h=True):
+    """Get coordinates of a pose-N.mol2 file, read from the pose archive of its folder if the file does not exist"""
+
+    if os.path.isfile(filename):
+        return np.array(mol2.get_coordinates(filename, keep_h=keep_h))
+    return get_archive(os.path.dirname(filename) or '.').get_coordinates(get_pose_number(filename), keep_h=keep_h)
+
+def copy_pose(filename, outputfile):
+    """Copy a pose-N.mol2 file, written from the pose archive of its folder if the file does not exist"""
+
+    if os.path.isfile(filename):
+        shutil.copyfile(filename, outputfile)
+    else:
+        get_archive(os.path.dirname(filename) or '.').write_pose(get_pose_number(filename), outputfile)
@@ -0,0 +1,98 @@
+import os
+import shutil
+import pstats
+import cProfile
+from glob import glob
+
+# folder where the profiles of every process are written (inherited by worker processes)
+env_profiledir = 'DBX_PROFILE_DIR'
+
+# profiles of the current process (one per stage) and stack of the stages being run
+pid = None
+profiles = {}
+stack = []
+
+def is_enabled():
+    return env_profiledir in os.environ
+
+def enable(profiledir):
+    """Enable profiling, profiles are written in profiledir until they are merged with write_report"""
+
+    profiledir = os.path.abspath(profiledir)
+    shutil.rmtree(profiledir, ignore_errors=True)
+    os.makedirs(profiledir)
+    os.environ[env_profiledir] = profiledir
+
+def check_process():
+    """Discard the profiles inherited from the parent process (worker processes)"""
+    global pid, profiles, stack
+
+    if pid != os.getpid():
+        if stack:
+            # stop profiler of the parent still running in the worker
+            profiles[stack[-1]].disable()
+        pid = os.getpid()
+        profiles = {}
+        stack = []
+
+def start(stage):
+    """Profile the code run from now on as part of stage (the stage being run before is paused)"""
+
+    if not is_enabled():
+        return
+    check_process()
+
+    if stack:
+        profiles[stack[-1]].disable()
+    if stage not in profiles:
+        profiles[stage] = cProfile.Profile()
+    stack.append(stage)
+    profiles[stage].enable()
+
+def stop():
+    """Stop profiling the current stage, the stage being run before is resumed"""
+
+    if not is_enabled():
+        return
+    check_process()
+    if not stack:
+        return
+
+    stage = stack.pop()
+    profiles[stage].disable()
+    # profiles accumulate over every run of the stage, the file is simply overwritten
+    profiles[stage].dump_stats(os.path.join(os.environ[env_profiledir], '%s.%i.prof'%(stage, pid)))
+    if stack:
+        profiles[stack[-1]].enable()
+
+def write_report(filename, statsdir, nlines=20):
+    """Merge profiles of every process stage by stage and write a report with the functions taking most time,
+    the merged profile of each stage is saved in statsdir (e.g., for snakeviz)"""
+
+    while stack:
+        stop()
+    profiledir = os.environ.pop(env_profiledir)
+
+    stages = {}
+    for proffile in glob(profiledir + '/*.prof'):
+        stage = os.path.basename(proffile).rsplit('.', 2)[0]
+        stages.setdefault(stage, []).append(proffile)
+
+    shutil.rmtree(statsdir, ignore_errors=True)
+    os.makedirs(statsdir)
+
+    stats = {}
+    for stage, proffiles in stages.iteritems():
+        stats[stage] = pstats.Stats(*proffiles)
+        stats[stage].dump_stats(os.path.join(statsdir, stage + '.prof'))
+    shutil.rmtree(profiledir, ignore_errors=True)
+
+    with open(filename, 'w') as rf:
+        rf.write("Stages sorted by total time (profile of each stage in %s):\n\n"%statsdir)
+        for stage in sorted(stats, key=lambda stage: -stats[stage].total_tt):
+            rf.write("%10.3f s  %s\n"%(stats[stage].total_tt, stage))
+
+        for stage in sorted(stats, key=lambda stage: -stats[stage].total_tt):
+            rf.write("\n%s\n%s\n"%(stage, '='*len(stage)))
+            stats[stage].stream = rf
+            stats[stage].sort_stats('tottime').print_stats(nlines)
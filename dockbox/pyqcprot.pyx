@@ -79,16 +79,19 @@
 import cython
 import numpy as np
 cimport numpy as np
+from cython.parallel import prange
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     double sqrt(double x)
     double fabs(double x)
 
-cdef double InnerProduct(np.ndarray[np.float64_t,ndim=1] A,
-                 np.ndarray[np.float64_t,ndim=2] coords1,
-                 np.ndarray[np.float64_t,ndim=2] coords2,
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double InnerProduct(double *A,
+                 double[:, :] coords1,
+                 double[:, :] coords2,
                  int N,
-                 np.ndarray[np.float64_t,ndim=1] weight):
+                 double *weight) nogil:
     """
     Calculate the inner product of two structures.
     InnerProduct(A, coords1, coords2, N, weight) --> (G1+G2)/2
@@ -98,7 +101,7 @@ cdef double InnerProduct(np.ndarray[np.float64_t,ndim=1] A,
                    - coords1 -- reference structure
                    - coords2 -- candidate structure
                    - N       -- the size of the system
-                   - weight  -- the weight array of size N: set to None if not needed
+                   - weight  -- the weight array of size N: set to NULL if not needed
             :Output:
                    - A[9]    -- the inner product matrix
             :Returns:
@@ -121,7 +124,7 @@ cdef double InnerProduct(np.ndarray[np.float64_t,ndim=1] A,
 
     A[0] = A[1] = A[2] = A[3] = A[4] = A[5] = A[6] = A[7] = A[8] = 0.0
 
-    if (weight != None):
+    if (weight != NULL):
         for i in xrange(N):
             x1 = weight[i] * coords1[0,i]
             y1 = weight[i] * coords1[1,i]
@@ -175,7 +178,7 @@ cdef double InnerProduct(np.ndarray[np.float64_t,ndim=1] A,
 
     return (G1 + G2) * 0.5
 
-cdef double FastCalcRMSDAndRotation(np.ndarray[np.float64_t,ndim=1] rot, np.ndarray[np.float64_t,ndim=1] A, double E0, int N):
+cdef double FastCalcRMSDAndRotation(double *rot, double *A, double E0, int N) nogil:
     """
     Calculate the RMSD, and/or the optimal rotation matrix.
     FastCalcRMSDAndRotation(rot, A, E0, N)
@@ -188,8 +191,8 @@ cdef double FastCalcRMSDAndRotation(np.ndarray[np.float64_t,ndim=1] rot, np.ndar
                     - rot[9]   -- the rotation matrix in the order of xx, xy, xz, yx, yy, yz, zx, zy, zz
                     - rmsd     -- the RMSD value
             :Returns:
-                    - only the rmsd was calculated if rot is None
-                    - both the RMSD & rotational matrix calculated if rot is not None
+                    - only the rmsd was calculated if rot is NULL
+                    - both the RMSD & rotational matrix calculated if rot is not NULL
     """
     cdef double rmsd
     cdef double Sxx, Sxy, Sxz, Syx, Syy, Syz, Szx, Szy, Szz
@@ -198,7 +201,7 @@ cdef double FastCalcRMSDAndRotation(np.ndarray[np.float64_t,ndim=1] rot, np.ndar
     cdef double SxzpSzx, SyzpSzy, SxypSyx, SyzmSzy,
     cdef double SxzmSzx, SxymSyx, SxxpSyy, SxxmSyy
 
-    cdef np.ndarray[np.float64_t,ndim=1] C = np.zeros(4, dtype=A.dtype)
+    cdef double C[4]
     cdef unsigned int i
     cdef double mxEigenV
     cdef double oldg = 0.0
@@ -275,7 +278,7 @@ cdef double FastCalcRMSDAndRotation(np.ndarray[np.float64_t,ndim=1] rot, np.ndar
     # the fabs() is to guard against extremely small, but *negative* numbers due to npfloat point error
     rms = sqrt(fabs(2.0 * (E0 - mxEigenV)/N))
 
-    if (rot is None):
+    if (rot == NULL):
         return rms # Don't bother with rotation.
 
     a11 = SxxpSyy + Szz-mxEigenV; a12 = SyzmSzy; a13 = - SxzmSzx; a14 = SxymSyx
@@ -363,14 +366,17 @@ cdef double FastCalcRMSDAndRotation(np.ndarray[np.float64_t,ndim=1] rot, np.ndar
 
     return rms
 
-cdef void CenterCoords(np.ndarray[np.float64_t,ndim=2] coords, int N, np.ndarray[np.float64_t,ndim=1] weights):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void CenterCoords(double[:, :] coords, int N, double *weights) nogil:
 
     cdef double          xsum, ysum, zsum, wsum
     cdef unsigned int    i
 
     xsum = ysum = zsum = 0.0
 
-    if (weights != None):
+    if (weights != NULL):
         wsum = 0.0
         for i in xrange(N):
             xsum += weights[i] * coords[0,i]
@@ -423,13 +429,20 @@ def CalcRMSDRotationalMatrix(np.ndarray[np.float64_t,ndim=2] ref,
     cdef double rmsd
     cdef int N = conf.shape[1]
     cdef double E0
-    cdef np.ndarray[np.float64_t,ndim=1] A = np.zeros(9, dtype=ref.dtype)
- 
-    CenterCoords(ref, N, weights)
-    CenterCoords(conf, N, weights)
+    cdef double A[9]
+    cdef double *rotp = NULL
+    cdef double *weightsp = NULL
 
-    E0 = InnerProduct(A, conf, ref, N, weights)
-    rmsd = FastCalcRMSDAndRotation(rot, A, E0, N)
+    if rot is not None:
+        rotp = &rot[0]
+    if weights is not None:
+        weightsp = &weights[0]
+
+    CenterCoords(ref, N, weightsp)
+    CenterCoords(conf, N, weightsp)
+
+    E0 = InnerProduct(A, conf, ref, N, weightsp)
+    rmsd = FastCalcRMSDAndRotation(rotp, A, E0, N)
 
     return rmsd
 
@@ -447,3 +460,132 @@ def CalcRMSDRotationalMatrix(np.ndarray[np.float64_t,ndim=2] ref,
     #    trmsd += (trot[0]-conf[0,k])**2 + (trot[1]-conf[1,k])**2 + (trot[2]-conf[2,k])**2
     #trmsd = sqrt(trmsd/N)
     #print rmsd, trmsd
+
+cdef double CalcRMSDPair(double[:, :] ref, double[:, :] conf, int N, double *weights, double *rot) nogil:
+    """RMSD (and rotation matrix if rot is not NULL) of two centered structures, same as CalcRMSDRotationalMatrix(ref, conf, rot, weights)"""
+    cdef double A[9]
+    cdef double E0
+
+    E0 = InnerProduct(A, conf, ref, N, weights)
+    return FastCalcRMSDAndRotation(rot, A, E0, N)
+
+def CenterStack(confs, weights=None):
+    """Center a stack of structures of shape (K, N, 3), returns a (K, 3, N) array in the layout used by QCP"""
+
+    confs = np.asarray(confs, dtype=np.float64)
+    if confs.ndim != 3 or confs.shape[2] != 3:
+        raise ValueError("coordinates should be an array of shape (K, N, 3)!")
+    if weights is None:
+        center = confs.mean(axis=1)
+    else:
+        center = np.average(confs, axis=1, weights=weights)
+    return np.ascontiguousarray((confs - center[:,np.newaxis,:]).transpose((0, 2, 1)))
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def CalcRMSDBatch(ref, confs, rotations=False, weights=None):
+    """
+    Calculate the RMSD (& rotational matrices) between a reference structure and a stack of conformations.
+    CalcRMSDBatch(ref, confs, rotations=False, weights=None):
+            :Input:
+                   - ref       -- reference structure coordinates of shape (N, 3)
+                   - confs     -- candidate structures coordinates of shape (K, N, 3)
+                   - rotations -- whether rotation matrices are computed
+                   - weights   -- the weight array of size N; None if not needed
+            :Returns:
+                   - RMSD values of shape (K,)
+                   - rotation matrices of shape (K, 3, 3) if rotations is True (same convention as CalcRMSDRotationalMatrix)
+    .. Note:: Input arrays are not modified, the pairs are computed in parallel without the GIL.
+    """
+    cdef double[:, :, ::1] refc = CenterStack(np.asarray(ref)[np.newaxis], weights=weights)
+    cdef double[:, :, ::1] confsc = CenterStack(confs, weights=weights)
+    cdef int K = confsc.shape[0]
+    cdef int N = confsc.shape[2]
+    cdef bint with_rot = rotations
+
+    if refc.shape[2] != N:
+        raise ValueError("reference and conformations should have the same number of atoms!")
+
+    cdef np.ndarray[np.float64_t,ndim=1] rmsd = np.zeros(K)
+    cdef np.ndarray[np.float64_t,ndim=2] rot = np.zeros((K if with_rot else 1, 9))
+    cdef np.ndarray[np.float64_t,ndim=1] w
+    cdef double *weightsp = NULL
+    cdef double *rmsdp = &rmsd[0] if K > 0 else NULL
+    cdef double *rotp = &rot[0,0]
+    cdef int k
+
+    if weights is not None:
+        w = np.ascontiguousarray(weights, dtype=np.float64)
+        weightsp = &w[0]
+
+    for k in prange(K, nogil=True):
+        if with_rot:
+            rmsdp[k] = CalcRMSDPair(refc[0], confsc[k], N, weightsp, rotp + 9*k)
+        else:
+            rmsdp[k] = CalcRMSDPair(refc[0], confsc[k], N, weightsp, NULL)
+
+    if with_rot:
+        return rmsd, rot.reshape((K, 3, 3))
+    return rmsd
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def CalcRMSDMatrix(confs1, confs2=None, rotations=False, weights=None):
+    """
+    Calculate the RMSD (& rotational matrices) between every pair of two stacks of conformations.
+    CalcRMSDMatrix(confs1, confs2=None, rotations=False, weights=None):
+            :Input:
+                   - confs1    -- structures coordinates of shape (K, N, 3)
+                   - confs2    -- structures coordinates of shape (M, N, 3); None to compare confs1 with itself
+                   - rotations -- whether rotation matrices are computed
+                   - weights   -- the weight array of size N; None if not needed
+            :Returns:
+                   - RMSD matrix of shape (K, M) (element i, j as CalcRMSDRotationalMatrix(confs1[i], confs2[j]))
+                   - rotation matrices of shape (K, M, 3, 3) if rotations is True
+    .. Note:: Input arrays are not modified, the pairs are computed in parallel without the GIL. When confs2 is None,
+       only one pair of each (i, j), (j, i) is computed (the RMSD is symmetric, rotation matrices are transposed).
+    """
+    cdef bint symmetric = confs2 is None
+    cdef double[:, :, ::1] confs1c = CenterStack(confs1, weights=weights)
+    cdef double[:, :, ::1] confs2c = confs1c if symmetric else CenterStack(confs2, weights=weights)
+    cdef int K = confs1c.shape[0]
+    cdef int M = confs2c.shape[0]
+    cdef int N = confs1c.shape[2]
+    cdef bint with_rot = rotations
+
+    if confs2c.shape[2] != N:
+        raise ValueError("conformations should have the same number of atoms!")
+
+    cdef np.ndarray[np.float64_t,ndim=2] rmsd = np.zeros((K, M))
+    cdef np.ndarray[np.float64_t,ndim=3] rot = np.zeros((K if with_rot else 1, M if with_rot else 1, 9))
+    cdef np.ndarray[np.float64_t,ndim=1] w
+    cdef double *weightsp = NULL
+    cdef double *rmsdp = &rmsd[0,0] if K*M > 0 else NULL
+    cdef double *rotp = &rot[0,0,0]
+    cdef int i, j, first
+
+    if weights is not None:
+        w = np.ascontiguousarray(weights, dtype=np.float64)
+        weightsp = &w[0]
+
+    # rows are distributed dynamically since they are of different lengths in the symmetric case
+    for i in prange(K, nogil=True, schedule='dynamic'):
+        first = i+1 if symmetric else 0
+        for j in range(first, M):
+            if with_rot:
+                rmsdp[i*M+j] = CalcRMSDPair(confs1c[i], confs2c[j], N, weightsp, rotp + 9*(i*M+j))
+            else:
+                rmsdp[i*M+j] = CalcRMSDPair(confs1c[i], confs2c[j], N, weightsp, NULL)
+
+    if symmetric:
+        rmsd += rmsd.T
+    if not with_rot:
+        return rmsd
+
+    rotations = rot.reshape((K, M, 3, 3))
+    if symmetric:
+        # rotation of (j, i) is the inverse (transpose) of the rotation of (i, j)
+        lower = np.tril_indices(K, -1)
+        rotations[lower] = rotations.transpose((1, 0, 3, 2))[lower]
+        rotations[np.diag_indices(K)] = np.eye(3)
+    return rmsd, rotations
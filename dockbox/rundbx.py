@@ -7,16 +7,55 @@ import shutil
 import argparse
 import ConfigParser
 import time
+import socket
+import tempfile
+import traceback
 
 from glob import glob
 import pandas as pd
-import subprocess
+import numpy as np
+import pipes
 
 from mdkit.utility import mol2
 from mdkit.amber.ambertools import load_PROTON_INFO
 from mdkit.amber.ambertools import load_atomic_ions
 
+import cache
+import method
+import license
 import configure
+import parallel
+import executor
+import tracing
+import profiling
+import accounting
+import posestore
+import scorestore
+from dbxtools import ligdir_prefix, cluster_poses
+
+# receptor cache of a library run when no cache_dir is set (receptor files are prepared once for the whole library)
+library_cache_dir = '.dbx_cache'
+
+def iter_mol2_structures(path):
+    """Iterate over the structures of a (multi-)mol2 file or of all the .mol2 files of a directory, yields (name, lines)"""
+
+    if os.path.isdir(path):
+        filenames = sorted(glob(path+'/*.mol2'))
+    else:
+        filenames = [path]
+
+    for filename in filenames:
+        with open(filename, 'r') as mol2f:
+            lines = None
+            for line in mol2f:
+                if line.startswith('@<TRIPOS>MOLECULE'):
+                    if lines:
+                        yield lines[1].strip(), lines
+                    lines = []
+                if lines is not None:
+                    lines.append(line)
+            if lines:
+                yield lines[1].strip(), lines
 
 class DockingConfig(object):
 
@@ -29,39 +68,69 @@ class DockingConfig(object):
         else:
             raise ValueError("Config file %s not found!"%(args.config_file))
 
+        if getattr(args, 'library', False):
+            # ligands are set one after the other when running the library
+            if not os.path.exists(args.input_file_l):
+                raise IOError("File or directory %s not found!"%(args.input_file_l))
+        else:
+            self.set_ligand(args.input_file_l)
+
+        # license tokens are passed to the docking scripts through the environment
+        self.license = configure.LicenseSetup(config)
+        license.set_environment(self.license.tokens, token_dir=self.license.token_dir)
+
+        if task == 'docking':
+            self.docking = configure.DockingSetup(config)
+            self.rescoring = configure.RescoringSetup(config)
+
+            # caches of prepared receptor files and docking results shared between runs
+            self.receptor_cache = None
+            self.result_cache = None
+            if self.docking.cache_dir:
+                self.receptor_cache = cache.ReceptorCache(self.docking.cache_dir, max_size=self.docking.cache_max_size)
+                if self.docking.cache_results:
+                    self.result_cache = cache.ResultCache(self.docking.cache_dir, max_size=self.docking.cache_max_size)
+            elif getattr(args, 'library', False):
+                self.receptor_cache = cache.ReceptorCache(library_cache_dir)
+        elif task == 'scoring':
+            self.scoring = configure.ScoringSetup(config)
+        else:
+            raise ValueError("Task should be one of docking or scoring")
+
+        with tracing.span('receptor_check'):
+            self.check_pdbfile(args.input_file_r)
+
+    def set_ligand(self, filename):
+        """Set ligand file with unique names for every atom"""
+
         # check if ligand file exists
-        if not os.path.isfile(args.input_file_l):
-            raise IOError("File %s not found!"%(args.input_file_l))
+        if not os.path.isfile(filename):
+            raise IOError("File %s not found!"%(filename))
 
-        file_l_abs = os.path.abspath(args.input_file_l)
-        base = os.path.basename(args.input_file_l)
+        file_l_abs = os.path.abspath(filename)
+        base = os.path.basename(filename)
         pref, ext = os.path.splitext(base)
         if ext != '.mol2':
             raise IOError("Ligand file provided with -l option should be in .mol2 format! %s format detected!"%ext)
 
-        nligands = int(subprocess.check_output('fgrep -c "@<TRIPOS>ATOM" %s'%file_l_abs, shell=True))
+        nligands = 0
+        with open(file_l_abs, 'r') as mol2f:
+            for line in mol2f:
+                if line.startswith('@<TRIPOS>ATOM'):
+                    nligands += 1
         if nligands == 0:
-            raise IOError("No ligand detected in %s, check your file again!"%args.input_file_l)
+            raise IOError("No ligand detected in %s, check your file again!"%filename)
         elif nligands > 1:
-            raise IOError("More than one ligand detected in %s. Only one structure per ligand file is allowed!"%args.input_file_l)
+            raise IOError("More than one ligand detected in %s. Only one structure per ligand file is allowed!"%filename)
 
         # new ligand file with unique names for every atom
         new_file_l = pref + '_dbx' + ext
 
         # create a ligand file with unique atom names
-        mol2.update_mol2file(file_l_abs, new_file_l, unique=True, ligname='LIG')
+        with tracing.span('ligand_preprocessing'):
+            mol2.update_mol2file(file_l_abs, new_file_l, unique=True, ligname='LIG')
         self.input_file_l = os.path.abspath(new_file_l)
 
-        if task == 'docking':
-            self.docking = configure.DockingSetup(config)
-            self.rescoring = configure.RescoringSetup(config)
-        elif task == 'scoring':
-            self.scoring = configure.ScoringSetup(config)
-        else:
-            raise ValueError("Task should be one of docking or scoring")
-
-        self.check_pdbfile(args.input_file_r)
-
     def check_pdbfile(self, filename):
 
         # check if receptor file exists
@@ -163,47 +232,195 @@ Requires one file for the ligand (1 struct.) and one file for the receptor (1 st
         else:
             raise IOError('no folder %s found!'%posedir)
 
-        curdir = os.getcwd()
         workdir = 'rescoring'
         if not os.path.exists(workdir):
             print "Creating rescoring folder..."
             os.mkdir(workdir)
+        workdir = os.path.abspath(workdir)
 
-        os.chdir(workdir)
-        print "Starting rescoring..."
-        # iterate over rescoring instances
-        for instance, program, options in config_r.instances:
-
-            # possibility of renaming the folder and output file 
-            if 'name' in options:
-                name = options['name']
-            else:
-                name = instance
+        resume = getattr(args, 'resume', False)
 
-            # remove old scoring file
-            if os.path.isfile(name+'.score'):
-                os.remove(name+'.score')
+        # poses of a pose archive are written in a local temporary folder for the scoring programs
+        filesdir = posedir
+        if posestore.has_archive(posedir):
+            filesdir = tempfile.mkdtemp(prefix='dbx_poses_')
+            posestore.get_archive(posedir).export(filesdir)
 
+        try:
+            # poses of each binding site with the representatives of their clusters (only representatives are rescored)
+            clusters = []
             for kdx in range(len(config_r.site)):
-                site = config_r.site['site'+str(kdx+1)]
+                files_site = [os.path.abspath(filesdir+'/pose-%s.mol2'%idx) for idx in range(nposes[kdx], nposes[kdx+1])]
+                if config_r.cluster_rmsd > 0:
+                    representatives, members = cluster_poses(files_site, config_r.cluster_rmsd)
+                    print "%i poses out of %i rescored after clustering (%.2f A)."%(len(representatives), len(files_site), config_r.cluster_rmsd)
+                else:
+                    representatives, members = range(len(files_site)), np.arange(len(files_site))
+                clusters.append((representatives, members))
+
+            jobs = []
+            instances = []
+            # iterate over rescoring instances
+            for instance, program, options in config_r.instances:
+
+                # possibility of renaming the folder and output file 
+                if 'name' in options:
+                    name = options['name']
+                else:
+                    name = instance
+
+                signatures = []
+                instance_jobs = []
+                for kdx in range(len(config_r.site)):
+                    site = config_r.site['site'+str(kdx+1)]
+
+                    # get complex filenames
+                    representatives, members = clusters[kdx]
+                    files_l = [os.path.abspath(filesdir+'/pose-%s.mol2'%(nposes[kdx]+idx)) for idx in representatives]
+                    signature = get_rescoring_signature(instance, program, site, options, file_r, files_l)
+                    if config_r.cluster_rmsd > 0:
+                        signature = cache.get_hash(signature, members.tolist())
+                    signatures.append(signature)
+                    instance_jobs.append((instance, program, site, dict(options), file_r, files_l, workdir, config_r.nworkers, config.receptor_cache, signature, resume))
+
+                # the signature of the instance identifies the poses and options used for every binding site
+                signature = cache.get_hash(signatures)
+                marker = workdir+'/.dbx_'+name
+                if resume and os.path.isfile(workdir+'/'+name+'.score') and method.read_stage_signature(marker) == signature:
+                    print "Rescoring with %s already done."%instance
+                    continue
+
+                jobs.extend(instance_jobs)
+                instances.append((name, marker, signature))
+
+            print "Starting rescoring..."
+            # run rescoring jobs (simultaneously if more than one process is used)
+            with tracing.span('rescoring'):
+                outputfiles = parallel.run_jobs(run_rescoring_job, jobs, nprocs=args.nprocs)
+        finally:
+            if filesdir != posedir:
+                shutil.rmtree(filesdir, ignore_errors=True)
+
+        # gather scores of every binding site in a single file per instance
+        nsites = len(config_r.site)
+        columns = {}
+        for jdx, (name, marker, signature) in enumerate(instances):
+
+            # scores are set in the score table by binding site so that a failed site does not shift the others
+            columns[name] = np.full(nposes[-1]-1, np.nan)
+            with open(workdir+'/'+name+'.score', 'w') as sf:
+                for kdx, outputfile in enumerate(outputfiles[jdx*nsites:(jdx+1)*nsites]):
+                    representatives, members = clusters[kdx]
+                    if len(representatives) == len(members):
+                        with open(outputfile, 'r') as of:
+                            shutil.copyfileobj(of, sf)
+                    else:
+                        # scores of the representatives are copied to every member of their cluster
+                        with open(outputfile, 'r') as of:
+                            lines = [line for line in of if line.strip()]
+                        if len(lines) == len(representatives):
+                            sf.writelines(lines[cluster] for cluster in members)
+                        else:
+                            sf.writelines('NaN\n' for cluster in members)
+                    columns[name][nposes[kdx]-1:nposes[kdx+1]-1] = scorestore.read_score_file(outputfile, len(representatives))[members]
+
+                    if config.docking.cleanup >= 1:
+                        shutil.rmtree(os.path.dirname(outputfile), ignore_errors=True)
+            method.write_stage_signature(marker, signature)
+
+        if scorestore.has_scores(posedir):
+            # scores of the instances already done (resume) are read again since the table is rewritten by finalize
+            for instance, program, options in config_r.instances:
+                name = options.get('name', instance)
+                if name not in columns:
+                    columns[name] = scorestore.read_score_file(workdir+'/'+name+'.score', nposes[-1]-1)
+            scorestore.set_scores(posedir, columns)
 
-                # get complex filenames
-                files_l = [os.path.abspath('../'+posedir+'/pose-%s.mol2'%idx) for idx in range(nposes[kdx], nposes[kdx+1])]
-                # get docking class
-                ScoringClass = getattr(sys.modules[program], program.capitalize())
+        tcpu2 = time.time()
+        print "Rescoring done. Total time needed: %i s" %(tcpu2-tcpu1)
 
-                ScoringInstance = ScoringClass(instance, site, options)
-                outputfile = ScoringInstance.run_rescoring(file_r, files_l)
+def get_rescoring_signature(instance, program, site, options, file_r, files_l):
+    """Get signature of a rescoring job (changes whenever the poses, the receptor or the options change)"""
+    return cache.get_hash(instance, program, site, options, cache.get_file_hash(file_r), [cache.get_file_hash(filename) for filename in files_l])
+
+def run_rescoring_job(job):
+    """Run rescoring for one instance/binding site combination (can be called from a worker process)"""
 
-                # cat output in file (cat instead of copying because of the binding sites)
-                subprocess.check_output('cat %s >> %s'%(outputfile,name+'.score'), shell=True, executable='/bin/bash')
+    instance, program, site, options, file_r, files_l, workdir, nworkers, receptor_cache, signature, resume = job
 
-                if config.docking.cleanup >= 1:
-                    shutil.rmtree(os.path.dirname(outputfile), ignore_errors=True)
+    curdir = os.getcwd()
+    try:
+        # get scoring class
+        ScoringClass = getattr(sys.modules[program], program.capitalize())
 
+        ScoringInstance = ScoringClass(instance, site, options)
+        with tracing.span(instance, category='rescoring', program=program, site=site[0], nposes=len(files_l)):
+            return ScoringInstance.run_rescoring(file_r, files_l, workdir=workdir, nworkers=nworkers, receptor_cache=receptor_cache, \
+signature=signature, resume=resume)
+    finally:
         os.chdir(curdir)
-        tcpu2 = time.time()
-        print "Rescoring done. Total time needed: %i s" %(tcpu2-tcpu1)
+
+def get_executor(args):
+    """Get executor used to run docking jobs"""
+
+    name = args.executor
+    if name is None:
+        if args.nprocs == 1:
+            name = 'serial'
+        else:
+            name = 'pool'
+
+    if name == 'serial':
+        return executor.SerialExecutor()
+    elif name == 'pool':
+        return executor.PoolExecutor(nprocs=args.nprocs)
+    elif name == 'array':
+        return executor.ArrayExecutor(nprocs=args.nprocs)
+
+def run_docking_job(job):
+    """Run docking for one instance/binding site combination (can be called from a worker process)"""
+
+    instance, program, site, options, file_r, file_l, kwargs = job
+
+    curdir = os.getcwd()
+    try:
+        # get docking class
+        DockingClass = getattr(sys.modules[program], program.capitalize())
+
+        # create docking instance and run docking
+        DockingInstance = DockingClass(instance, site, options)
+        with tracing.span(instance, category='docking', program=program, site=site[0]):
+            DockingInstance.run_docking(file_r, file_l, **kwargs)
+    finally:
+        os.chdir(curdir)
+
+def get_run_manifest(args, config=None):
+    """Get manifest of a run: command, hashes of the input files and options resolved from the config file"""
+
+    manifest = {'command': ' '.join(map(pipes.quote, sys.argv)), 'host': socket.gethostname(), \
+'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'workdir': os.getcwd()}
+
+    inputs = {}
+    for key, path in [('ligand', args.input_file_l), ('receptor', args.input_file_r), ('config', args.config_file)]:
+        if os.path.isfile(path):
+            inputs[key] = {'file': os.path.abspath(path), 'sha1': cache.get_file_hash(path)}
+        elif os.path.isdir(path):
+            # library of compounds
+            inputs[key] = {'file': os.path.abspath(path), 'sha1': dict((os.path.basename(filename), cache.get_file_hash(filename)) \
+for filename in sorted(glob(path+'/*.mol2')))}
+    manifest['inputs'] = inputs
+
+    if config is not None:
+        config_d = config.docking
+        manifest['docking'] = {'instances': config_d.instances, 'sites': [config_d.site['site'+str(kdx+1)] for kdx in range(config_d.nsites)], \
+'minimize': config_d.minimize, 'cleanup': config_d.cleanup, 'cache_dir': config_d.cache_dir}
+
+        config_r = config.rescoring
+        if config_r.is_rescoring:
+            manifest['rescoring'] = {'instances': config_r.instances, 'sites': [config_r.site['site'+str(kdx+1)] for kdx in range(config_r.nsites)], \
+'nworkers': config_r.nworkers}
+        manifest['license'] = config.license.tokens
+    return manifest
 
 class Docking(object):
 
@@ -245,6 +462,62 @@ Requires one file for the ligand (1 struct.) and one file for the receptor (1 st
             default=False,
             help=argparse.SUPPRESS)
 
+        parser.add_argument('-resume',
+            dest='resume',
+            action='store_true',
+            default=False,
+            help='Resume an interrupted run: skip the stages already completed by each instance and binding site \
+(docking, extraction, minimization, pose filters, rescoring)')
+
+        parser.add_argument('-nprocs', '-jobs',
+            dest='nprocs',
+            type=int,
+            default=1,
+            help='Number of docking/rescoring instances and binding sites run simultaneously (0: use all the cores). Default: 1')
+
+        parser.add_argument('-executor',
+            dest='executor',
+            choices=executor.known_executors,
+            default=None,
+            help='How docking scripts are run: serial (one after the other), pool (in a pool of NPROCS processes) \
+or array (scripts are exported as a job array in dbx_array/ for batch schedulers, extraction and rescoring being run \
+automatically once every task is done). Default: serial if NPROCS is 1, pool otherwise')
+
+        parser.add_argument('-library',
+            dest='library',
+            action='store_true',
+            default=False,
+            help='Library mode: dock every structure of the .mol2 file (or of the .mol2 files in the directory) provided with -l. \
+Results of each structure are stored in a separate %s* folder'%ligdir_prefix)
+
+        parser.add_argument('-strict',
+            dest='strict',
+            action='store_true',
+            default=False,
+            help='Library mode: exit with a non-zero status if any ligand failed (by default, only if every ligand failed)')
+
+        parser.add_argument('-trace',
+            dest='trace',
+            action='store_true',
+            default=False,
+            help='Record the time spent in each stage (setup, ligand preprocessing, receptor preparation, grid generation, docking, \
+extraction, minimization, pose filters, finalize, rescoring) in trace.json (chrome://tracing or Perfetto) \
+together with a manifest of the run (hashes of the input files, options)')
+
+        parser.add_argument('-profile',
+            dest='profile',
+            action='store_true',
+            default=False,
+            help='Profile the python code of each stage with cProfile, the functions taking most time in each stage are \
+reported in dbx_profile.txt (profiles are saved in dbx_profile)')
+
+        parser.add_argument('-accounting',
+            dest='accounting',
+            action='store_true',
+            default=False,
+            help='Record the resources used by each stage and each external command (CPU time, peak memory, wall time, \
+processes, files created, bytes written), the totals per stage and per program are written in dbx_accounting.json')
+
         return parser
 
     def finalize(self, config):
@@ -258,12 +531,18 @@ Requires one file for the ligand (1 struct.) and one file for the receptor (1 st
 
         nposes = [1] # number of poses involved for each binding site
         sh = 1 # shift of model
+        mol2files = []
 
         info = {}
         features = ['program', 'nposes', 'firstidx', 'site']
         for ft in features:
             info[ft] = []
 
+        # score table of the poses (see scorestore.py)
+        scores = {}
+        for ft in scorestore.pose_columns + ['score']:
+            scores[ft] = []
+
         for kdx in range(len(config_d.site)):
             bs = config_d.site['site'+str(kdx+1)] # current binding site
             for name, program, options in config_d.instances:
@@ -278,7 +557,9 @@ Requires one file for the ligand (1 struct.) and one file for the receptor (1 st
                 nposes_idxs = len(poses_idxs)
 
                 for idx, pose_idx in enumerate(poses_idxs):
-                    shutil.copyfile(instdir+'/pose-%s.mol2'%pose_idx, posedir+'/pose-%s.mol2'%(idx+sh))
+                    mol2files.append(instdir+'/pose-%s.mol2'%pose_idx)
+                    if not config_d.pose_archive:
+                        shutil.copyfile(instdir+'/pose-%s.mol2'%pose_idx, posedir+'/pose-%s.mol2'%(idx+sh))
 
                 # update info
                 info['program'].append(name)
@@ -286,10 +567,19 @@ Requires one file for the ligand (1 struct.) and one file for the receptor (1 st
                 info['firstidx'].append(sh)
                 info['site'].append(bs[0])
 
+                scores['pose'].extend(range(sh, sh+nposes_idxs))
+                scores['program'].extend([name]*nposes_idxs)
+                scores['site'].extend([bs[0]]*nposes_idxs)
+                scores['index_pose'].extend(range(nposes_idxs))
+                scores['score'].extend(scorestore.read_score_file(instdir+'/score.out', nposes_idxs))
+
                 # update shift
                 sh += nposes_idxs
             nposes.append(sh)
 
+        if config_d.pose_archive:
+            posestore.write_archive(posedir, mol2files)
+
         # write info
         info = pd.DataFrame(info)
         info[features].to_csv(posedir+'/info.dat', index=False)
@@ -301,6 +591,9 @@ Requires one file for the ligand (1 struct.) and one file for the receptor (1 st
             line = '#' + ','.join(map(str,nposes))+'\n'
             ff.write(line.rstrip('\r\n') + '\n' + content)
 
+        scores = pd.DataFrame(scores)
+        scorestore.write_scores(posedir, scores[scorestore.pose_columns + ['score']])
+
         # copy receptor in folder
         shutil.copyfile(config.input_file_r, posedir+'/rec.pdb')
 
@@ -312,12 +605,23 @@ Requires one file for the ligand (1 struct.) and one file for the receptor (1 st
             config_d = config.docking
             # iterate over all the binding sites
             for kdx in range(len(config_d.site)):
+                bs = config_d.site['site'+str(kdx+1)] # current binding site
                 for instance, program, options in config_d.instances: # iterate over all the instances
-                    for item in glob(instance+'/*'):
-                        if os.path.isfile(item) and item != instance+'/score.out':
+                    # docking directory of the instance for the current site (see method.get_dockdir)
+                    if 'name' in options:
+                        instdir = options['name']
+                    else:
+                        instdir = instance
+                    if bs[0]:
+                        instdir += '.' + bs[0]
+                    for item in glob(instdir+'/*'):
+                        if os.path.isfile(item) and item != instdir+'/score.out':
                             os.remove(item)
                         elif os.path.isdir(item):
                             shutil.rmtree(item)
+                    # poses were removed, stages should be run again when resuming
+                    for item in glob(instdir+'/.dbx_*'):
+                        os.remove(item)
             if config.docking.cleanup == 3:
                 shutil.rmtree('poses', ignore_errors=True)
         os.remove(config.input_file_l)
@@ -328,40 +632,66 @@ Requires one file for the ligand (1 struct.) and one file for the receptor (1 st
         tcpu1 = time.time()
 
         config_d = config.docking
+        kwargs = {'minimize_options': config_d.minimize, 'filter_options': config_d.filter_options, 'cleanup': config_d.cleanup, \
+'prepare_only': args.prepare_only, 'skip_docking': args.skip_docking, 'receptor_cache': config.receptor_cache, 'result_cache': config.result_cache, 'resume': args.resume}
+
+        jobs = []
         # iterate over all the binding sites
         for kdx in range(len(config_d.site)):
             for instance, program, options in config_d.instances: # iterate over all the instances
+                jobs.append((instance, program, config_d.site['site'+str(kdx+1)], dict(options), config.input_file_r, config.input_file_l, kwargs))
 
-                # get docking class
-                DockingClass = getattr(sys.modules[program], program.capitalize())
+        is_deferred = self.executor.is_deferred and not args.prepare_only and not args.skip_docking
+        if is_deferred:
+            # only prepare the scripts, they are run as tasks of the job array
+            kwargs['prepare_only'] = True
 
-                # create docking instance and run docking
-                DockingInstance = DockingClass(instance, config_d.site['site'+str(kdx+1)], options)
-                DockingInstance.run_docking(config.input_file_r, config.input_file_l, minimize_options=config_d.minimize, \
-cleanup=config_d.cleanup, prepare_only=args.prepare_only, skip_docking=args.skip_docking)
+        # run docking jobs (simultaneously if more than one process is used)
+        with tracing.span('docking'):
+            self.executor.run(run_docking_job, jobs)
+
+        if is_deferred:
+            self.add_array_tasks(config, args, jobs)
+            return False
 
         if args.prepare_only:
-            return
+            return False
         tcpu2 = time.time()
         print "Docking procedure done. Total time needed: %i s" %(tcpu2-tcpu1)
+        return True
 
-    def run(self):
-        parser = self.create_arg_parser()
-        args = parser.parse_args()    
+    def add_array_tasks(self, config, args, jobs):
+        """Add docking scripts of the current ligand to the job array"""
 
-        print "Setting up parameters..."
-        config = DockingConfig(args)
+        group = os.getcwd()
+        for instance, program, site, options, file_r, file_l, kwargs in jobs:
+            DockingClass = getattr(sys.modules[program], program.capitalize())
+            dockdir = DockingClass(instance, site, dict(options)).get_dockdir()
+            self.executor.add_task(os.path.abspath(dockdir), 'run_' + program + '.sh', program + '.log', group)
+
+        # once every script is run, extraction, finalize and rescoring are done by rundbx
+        # (paths given on the command line are relative to the folder where rundbx was run)
+        if args.library:
+            file_l = os.path.abspath('ligand.mol2')
+        else:
+            file_l = os.path.join(self.rundir, args.input_file_l)
+        cmd = [sys.executable, os.path.join(self.rundir, sys.argv[0]), '-l', file_l, '-r', os.path.join(self.rundir, args.input_file_r), \
+'-f', os.path.join(self.rundir, args.config_file), '-skip_docking', '-nprocs', str(args.nprocs)]
+        self.executor.add_group(group, ' '.join(map(pipes.quote, cmd)))
+
+    def run_ligand(self, config, args):
+        """Run docking, rescoring and cleanup for the current ligand"""
 
         # run docking
         if not args.rescore_only:
-            self.run_docking(config, args)
-
-        if args.prepare_only:
-            return
+            is_docking_done = self.run_docking(config, args)
+            if not is_docking_done:
+                return
 
         if not args.rescore_only:
             # create folder with poses
-            self.finalize(config)
+            with tracing.span('finalize'):
+                self.finalize(config)
 
         # run rescoring
         if config.rescoring.is_rescoring:
@@ -369,4 +699,86 @@ cleanup=config_d.cleanup, prepare_only=args.prepare_only, skip_docking=args.skip
 
         # final cleanup if needed
         if config.docking.cleanup >= 1:
-            self.do_final_cleanup(config)
+            with tracing.span('cleanup'):
+                self.do_final_cleanup(config)
+
+    def run_library(self, config, args):
+        """Run every ligand of the library in its own folder, the config and the receptor are set up only once"""
+
+        tcpu1 = time.time()
+
+        curdir = os.getcwd()
+        compounds = {'ligID': [], 'name': []}
+        nfailed = 0
+
+        for idx, (name, lines) in enumerate(iter_mol2_structures(args.input_file_l)):
+            ligID = ligdir_prefix + str(idx+1)
+            print "Running ligand %s (%s)..."%(ligID, name)
+
+            if not os.path.isdir(ligID):
+                os.mkdir(ligID)
+            with open(ligID+'/ligand.mol2', 'w') as mol2f:
+                mol2f.writelines(lines)
+
+            compounds['ligID'].append(ligID)
+            compounds['name'].append(name)
+
+            os.chdir(ligID)
+            try:
+                with tracing.span(ligID, category='ligand', compound=name):
+                    config.set_ligand('ligand.mol2')
+                    self.run_ligand(config, args)
+            except Exception as e:
+                # a single ligand should not stop the whole library
+                with open(os.path.join(curdir, ligID, 'error.log'), 'w') as logf:
+                    logf.write(traceback.format_exc())
+                print "Error: ligand %s (%s) failed (check %s/error.log file for more details): %s"%(ligID, name, ligID, e)
+                nfailed += 1
+            finally:
+                os.chdir(curdir)
+
+        # save names of compounds (used by extract_dbx_best_poses)
+        compounds = pd.DataFrame(compounds)
+        compounds[['ligID', 'name']].to_csv('compounds.csv', index=False)
+
+        tcpu2 = time.time()
+        print "Library done (%i ligands, %i failed). Total time needed: %i s" %(len(compounds), nfailed, tcpu2-tcpu1)
+        return len(compounds), nfailed
+
+    def run(self):
+        parser = self.create_arg_parser()
+        args = parser.parse_args()    
+
+        self.rundir = os.getcwd()
+        if args.trace:
+            tracing.enable('.dbx_trace')
+        if args.profile:
+            profiling.enable('.dbx_profile')
+        if args.accounting:
+            accounting.enable('.dbx_accounting')
+
+        config = None
+        status = 0
+        try:
+            print "Setting up parameters..."
+            with tracing.span('setup'):
+                config = DockingConfig(args)
+            self.executor = get_executor(args)
+
+            if args.library:
+                nligands, nfailed = self.run_library(config, args)
+                if nfailed and (nfailed == nligands or args.strict):
+                    status = 1
+            else:
+                self.run_ligand(config, args)
+            self.executor.close()
+        finally:
+            os.chdir(self.rundir)
+            if args.trace:
+                tracing.write_trace('trace.json', manifest=get_run_manifest(args, config))
+            if args.profile:
+                profiling.write_report('dbx_profile.txt', 'dbx_profile')
+            if args.accounting:
+                accounting.write_summary('dbx_accounting.json')
+        if status:
+            sys.exit(status)
@@ -0,0 +1,268 @@
+import os
+import time
+import errno
+import signal
+import tempfile
+import subprocess
+import multiprocessing
+
+import accounting
+
+class Job(object):
+    """Shell command submitted to a JobRunner"""
+
+    def __init__(self, cmd, resources=None, cwd=None, capture=True):
+
+        self.cmd = cmd
+        self.cwd = cwd
+        # resources used while the command is running (e.g., {'cores': 1} or {'moe': 1})
+        if resources is None:
+            self.resources = {'cores': 1}
+        else:
+            self.resources = resources
+        # output is captured (returned by check) or sent to the standard output of the runner
+        self.capture = capture
+
+        self.process = None
+        self.outputfile = None
+        self.start_time = None
+
+        self.returncode = None
+        self.output = None
+        self.cancelled = False
+
+    def is_done(self):
+        return self.returncode is not None
+
+    def check(self):
+        """Return the output of the command or raise CalledProcessError if the command failed"""
+
+        if self.returncode:
+            raise subprocess.CalledProcessError(self.returncode, self.cmd, output=self.output)
+        return self.output
+
+def sigterm_handler(signum, frame):
+    raise SystemExit(128 + signum)
+
+def get_returncode(status):
+    """Get return code of a command from its exit status (as returned by os.wait4)"""
+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class JobRunner(object):
+    """Run shell commands in a single polling loop.
+
+    Commands are started in order of submission as soon as the resources they need are available
+    (limits are given per resource, resources without limit are not restricted) and are waited with
+    os.wait4 so that their resource usage is recorded when accounting is enabled. Each command runs
+    in its own process group so that it can be cancelled with all its children."""
+
+    def __init__(self, limits=None, interval=0.05):
+
+        self.limits = {'cores': multiprocessing.cpu_count()}
+        if limits:
+            self.limits.update(limits)
+        self.interval = interval
+
+        self.queued = []
+        self.running = []
+        self.pid = os.getpid()
+
+    def submit(self, cmd, resources=None, cwd=None, capture=True):
+        """Submit a shell command, returns the corresponding job"""
+
+        job = Job(cmd, resources=resources, cwd=cwd, capture=capture)
+        self.queued.append(job)
+        self.start_jobs()
+        return job
+
+    def get_used_resources(self):
+        used = {}
+        for job in self.running:
+            for key, value in job.resources.iteritems():
+                used[key] = used.get(key, 0) + value
+        return used
+
+    def can_start(self, job, used):
+
+        if not self.running:
+            # never wait for nothing, even if the job needs more than the limits
+            return True
+
+        for key, value in job.resources.iteritems():
+            if key in self.limits and used.get(key, 0) + value > self.limits[key]:
+                return False
+        return True
+
+    def start_jobs(self):
+        """Start queued jobs whose resources are available"""
+
+        used = self.get_used_resources()
+        for job in list(self.queued):
+            if self.can_start(job, used):
+                self.queued.remove(job)
+                self.start(job)
+                for key, value in job.resources.iteritems():
+                    used[key] = used.get(key, 0) + value
+
+    def start(self, job):
+
+        # commands are in their own process groups so they do not get the signals sent to the group of the runner,
+        # SIGTERM is turned into SystemExit so that running commands are cancelled when waiting (see wait)
+        try:
+            if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+                signal.signal(signal.SIGTERM, sigterm_handler)
+        except ValueError:
+            # not in the main thread
+            pass
+
+        if job.capture:
+            # output is written to a temporary file so that the runner never blocks on a full pipe
+            job.outputfile = tempfile.TemporaryFile()
+        job.start_time = time.time()
+        job.process = subprocess.Popen(job.cmd, shell=True, executable='/bin/bash', cwd=job.cwd, \
+stdout=job.outputfile, preexec_fn=os.setpgrp)
+        self.running.append(job)
+
+    def finish(self, job, status, rusage):
+
+        job.returncode = job.process.returncode = get_returncode(status)
+        if job.capture:
+            job.outputfile.seek(0)
+            job.output = job.outputfile.read()
+            job.outputfile.close()
+        self.running.remove(job)
+        accounting.add_job(job.cmd, time.time() - job.start_time, rusage)
+
+    def wait4(self, job, options):
+        """Wait for the process of a job with os.wait4, returns True if the job completed"""
+
+        while True:
+            try:
+                pid, status, rusage = os.wait4(job.process.pid, options)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if pid == 0:
+            return False
+        self.finish(job, status, rusage)
+        return True
+
+    def poll(self, block=False):
+        """Collect exit status of completed jobs and start the next ones, returns True if any job completed
+
+        If block is True and only one job is running, wait for it without polling"""
+
+        if block and len(self.running) == 1:
+            completed = self.wait4(self.running[0], 0)
+        else:
+            completed = False
+            for job in list(self.running):
+                completed = self.wait4(job, os.WNOHANG) or completed
+
+        if completed:
+            self.start_jobs()
+        return completed
+
+    def wait(self, jobs=None, timeout=None):
+        """Wait for jobs (all the submitted jobs if None) to complete, returns True if they all completed
+
+        Every job is cancelled if the wait is interrupted (e.g., Ctrl-C or SIGTERM)"""
+
+        if jobs is None:
+            jobs = self.queued + self.running
+
+        t0 = time.time()
+        try:
+            while not all(job.is_done() for job in jobs):
+                if timeout is not None and time.time() - t0 > timeout:
+                    return False
+                if not self.poll(block=timeout is None and not self.queued):
+                    time.sleep(self.interval)
+        except BaseException:
+            self.cancel_all()
+            raise
+        return True
+
+    def cancel(self, job, grace_period=5):
+        """Cancel a job, running jobs are sent SIGTERM then SIGKILL after grace_period seconds"""
+
+        if job in self.queued:
+            self.queued.remove(job)
+            job.returncode = -signal.SIGTERM
+            job.output = ''
+        elif job in self.running:
+            self.kill(job, grace_period)
+            self.start_jobs()
+        else:
+            return
+        job.cancelled = True
+
+    def kill(self, job, grace_period):
+
+        for signum in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(job.process.pid, signum)
+            except OSError:
+                # process group already gone
+                pass
+
+            t0 = time.time()
+            while not self.wait4(job, os.WNOHANG) and time.time() - t0 < grace_period:
+                time.sleep(self.interval)
+            if job.is_done():
+                break
+        if not job.is_done():
+            self.wait4(job, 0)
+
+    def cancel_all(self):
+
+        for job in list(self.queued):
+            self.cancel(job)
+        for job in list(self.running):
+            self.cancel(job)
+
+# runner of the current process (every process has its own runner)
+runner = None
+
+def get_runner():
+    global runner
+
+    if runner is None or runner.pid != os.getpid():
+        runner = JobRunner()
+    return runner
+
+def submit(cmd, resources=None, cwd=None):
+    """Submit a shell command to the runner of the current process, its output is captured"""
+    return get_runner().submit(cmd, resources=resources, cwd=cwd)
+
+def check_jobs(jobs):
+    """Wait for jobs submitted together and return their outputs, raise CalledProcessError if any job failed"""
+
+    get_runner().wait(jobs)
+    return [job.check() for job in jobs]
+
+def run(cmd, resources=None, cwd=None, stdout=None):
+    """Run a shell command through the runner of the current process, returns its exit status and its output
+    (only captured if stdout is subprocess.PIPE)"""
+
+    job_runner = get_runner()
+    job = job_runner.submit(cmd, resources=resources, cwd=cwd, capture=stdout is not None)
+    job_runner.wait([job])
+    return job.returncode, job.output
+
+def call(cmd, resources=None, cwd=None):
+    """Run a shell command and return its exit status (same as subprocess.call(cmd, shell=True, executable='/bin/bash'))"""
+    return run(cmd, resources=resources, cwd=cwd)[0]
+
+def check_output(cmd, resources=None, cwd=None):
+    """Run a shell command and return its output
+    (same as subprocess.check_output(cmd, shell=True, executable='/bin/bash'))"""
+
+    returncode, output = run(cmd, resources=resources, cwd=cwd, stdout=subprocess.PIPE)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd, output=output)
+    return output
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import pandas as pd
+
+# table of the scores of a poses folder with one row per pose (pose-N.mol2) and one column per
+# docking (score) or rescoring function (name of the rescoring instance)
+scores_file = 'scores.csv'
+
+# columns identifying each pose
+pose_columns = ['pose', 'program', 'site', 'index_pose']
+
+def has_scores(posedir):
+    return os.path.isfile(os.path.join(posedir, scores_file))
+
+def read_score_file(filename, nscores):
+    """Read a file with one score per line (score.out), NaN are returned if the number of scores is not nscores"""
+
+    scores = []
+    if os.path.isfile(filename):
+        with open(filename, 'r') as sf:
+            scores = [float(line) for line in sf if line.strip()]
+
+    if len(scores) != nscores:
+        print "Warning: %i scores found in %s instead of %i, scores set to NaN!"%(len(scores), filename, nscores)
+        return np.full(nscores, np.nan)
+    return np.array(scores)
+
+def read_scores(posedir):
+    """Read the score table of posedir in a single pass"""
+
+    scores = pd.read_csv(os.path.join(posedir, scores_file))
+    scores['site'] = scores['site'].fillna('')
+    return scores
+
+def write_scores(posedir, scores):
+    """Write the score table of posedir (readers never see a partially written table)"""
+
+    filename = os.path.join(posedir, scores_file)
+    tmpfile = filename + '.%i.tmp'%os.getpid()
+    scores.to_csv(tmpfile, index=False)
+    os.rename(tmpfile, filename)
+
+def set_scores(posedir, columns):
+    """Add or replace columns (name -> scores of every pose) of the score table of posedir"""
+
+    scores = read_scores(posedir)
+    for name, values in sorted(columns.iteritems()):
+        scores[name] = values
+    write_scores(posedir, scores)
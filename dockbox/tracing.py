@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import shutil
+import contextlib
+from glob import glob
+
+import profiling
+import accounting
+
+# folder where the events of every process are written (inherited by worker processes and docking scripts)
+env_tracedir = 'DBX_TRACE_DIR'
+
+# file where docking scripts write the beginning of their stages
+script_stages_file = '.dbx_stages'
+
+# bash function used by docking scripts to mark the beginning of each stage (no-op if tracing is disabled)
+script_functions = """dbx_stage() { if [ -n "$%s" ]; then echo "$1 `date +%%s.%%N`" >> %s; fi; }"""%(env_tracedir, script_stages_file)
+
+# categories of spans named after the item they process (e.g., one span per ligand of a library), profiled
+# as a single stage named after the category so that one profile is kept whatever the number of items
+item_categories = ['ligand']
+
+def is_enabled():
+    return env_tracedir in os.environ
+
+def enable(tracedir):
+    """Enable tracing, events are written in tracedir until they are merged with write_trace"""
+
+    tracedir = os.path.abspath(tracedir)
+    shutil.rmtree(tracedir, ignore_errors=True)
+    os.makedirs(tracedir)
+    os.environ[env_tracedir] = tracedir
+
+def add_event(name, category, start, duration, args=None):
+    """Add complete event (Chrome trace format) to the events of the current process"""
+
+    pid = os.getpid()
+    event = {'name': name, 'cat': category, 'ph': 'X', 'ts': int(start*1e6), 'dur': int(duration*1e6), 'pid': pid, 'tid': pid}
+    if args:
+        event['args'] = args
+
+    # every process has its own file so that no lock is needed
+    with open(os.path.join(os.environ[env_tracedir], 'events-%i.jsonl'%pid), 'a') as ef:
+        ef.write(json.dumps(event) + '\n')
+
+@contextlib.contextmanager
+def span(name, category='dbx', **args):
+    """Record the time spent in a block of code as an event named name (the block is also profiled and
+    its resources are accounted as a stage if profiling or accounting are enabled)"""
+
+    is_tracing = is_enabled()
+    is_profiling = profiling.is_enabled()
+    is_accounting = accounting.is_enabled()
+    if not is_tracing and not is_profiling and not is_accounting:
+        yield
+        return
+
+    start = time.time()
+    if is_accounting:
+        accounting.start(category, name, os.getcwd())
+    if is_profiling:
+        if category in item_categories:
+            profiling.start(category)
+        else:
+            profiling.start(category + ':' + name)
+    try:
+        yield
+    finally:
+        if is_profiling:
+            profiling.stop()
+        if is_accounting:
+            accounting.stop()
+        if is_tracing:
+            add_event(name, category, start, time.time() - start, args=args)
+
+def add_script_stages(category='script', **args):
+    """Add events for the stages marked by the docking script run in the current directory (see script_functions)"""
+
+    if not os.path.isfile(script_stages_file):
+        return
+    end = time.time()
+
+    stages = []
+    with open(script_stages_file, 'r') as sf:
+        for line in sf:
+            name, start = line.split()
+            stages.append((name, float(start)))
+    os.remove(script_stages_file)
+
+    # each stage lasts until the next one begins (the last one until the end of the script)
+    for idx, (name, start) in enumerate(stages):
+        if idx+1 < len(stages):
+            stop = stages[idx+1][1]
+        else:
+            stop = end
+        add_event(name, category, start, stop - start, args=args)
+
+def reset_script_stages():
+    if os.path.isfile(script_stages_file):
+        os.remove(script_stages_file)
+
+def write_trace(filename, manifest=None):
+    """Merge the events of every process in a JSON file viewable in chrome://tracing or Perfetto"""
+
+    tracedir = os.environ.pop(env_tracedir)
+    events = []
+    for eventsfile in sorted(glob(tracedir + '/events-*.jsonl')):
+        pid = int(eventsfile.split('-')[-1].split('.')[0])
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': pid, 'args': {'name': 'dbx %i'%pid}})
+        with open(eventsfile, 'r') as ef:
+            for line in ef:
+                events.append(json.loads(line))
+
+    content = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    if manifest:
+        content['metadata'] = manifest
+    with open(filename, 'w') as tf:
+        json.dump(content, tf, indent=1)
+    shutil.rmtree(tracedir, ignore_errors=True)
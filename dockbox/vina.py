@@ -1,11 +1,11 @@
 import os
 import sys
 import shutil
-import subprocess
 from glob import glob
 
 from mdkit.utility import mol2
 import autodock
+import tracing
 
 required_programs = ['prepare_ligand4.py', 'prepare_receptor4.py', 'vina', 'babel']
 
@@ -44,23 +44,30 @@ class Vina(autodock.ADBased):
 
         # write vina script
         if not rescoring:
+            stage_functions = tracing.script_functions
             with open(filename, 'w') as ff:
                 script ="""#!/bin/bash
 set -e
+%(stage_functions)s
 
 MGLPATH=`which prepare_ligand4.py`
 MGLPATH=`python -c "print '/'.join('$MGLPATH'.split('/')[:-3])"`
 export PYTHONPATH=$PYTHONPATH:$MGLPATH
 
 # prepare ligand
+dbx_stage ligand_preparation
 prepare_ligand4.py -l %(file_l)s -o ligand.pdbqt
 python check_ligand_pdbqt.py ligand.pdbqt
 
-# prepare receptor
-prepare_receptor4.py -U nphs_lps_waters -r %(file_r)s -o target.pdbqt &> prepare_receptor4.log
-python check_ions.py target.pdbqt prepare_receptor4.log
+# prepare receptor (unless already taken from the cache)
+dbx_stage receptor_preparation
+if [ ! -f target.pdbqt ]; then
+  prepare_receptor4.py -U nphs_lps_waters -r %(file_r)s -o target.pdbqt &> prepare_receptor4.log
+  python check_ions.py target.pdbqt prepare_receptor4.log
+fi
 
 # run vina
+dbx_stage docking
 vina --config vina.config 1> vina.out 2> vina.err"""% locals()
                 ff.write(script)
         else:
@@ -91,8 +98,7 @@ vina --score_only --config vina.config > vina.out"""% locals()
         poses_extracted = False
         if os.path.exists('ligand_out.pdbqt'):
             try:
-                subprocess.check_output('babel -ipdbqt ligand_out.pdbqt -omol2 pose-.mol2 -m &>/dev/null', shell=True, executable='/bin/bash')
-                self.update_output_mol2files(sample=input_file_l)
+                self.update_output_mol2files('babel -ipdbqt ligand_out.pdbqt -omol2 pose-.mol2 -m &>/dev/null', sample=input_file_l)
                 poses_extracted = True
             except:
                 for mol2file in glob('pose-*.mol2'):
@@ -0,0 +1,446 @@
+import os
+import sys
+import time
+import json
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+
+import parallel
+import dbxtools
+from cache import FileLock, get_shared_time
+
+class WorkQueue(object):
+    """Queue of docking folders (%s*/%s*/%s* architecture) shared by workers on any node through a shared file system.
+
+    Each task is a folder in which the command of the queue is run. A worker claims a task by writing a lease
+    file (under the lock of the queue) and renews it while the command is running. The lease of a worker which
+    died expires after lease_time seconds and the task is claimed again by another worker (at most max_attempts
+    times). Tasks completed are marked by a file containing the exit status of the command and the index of the first
+    task not done is kept in a cursor file so that claims start from it. Times stored in the leases are taken from the clock of the shared file system (see get_time)."""%(dbxtools.ligdir_prefix,
+dbxtools.tardir_prefix, dbxtools.isodir_prefix)
+
+    def __init__(self, queuedir='dbx_queue'):
+
+        self.queuedir = os.path.abspath(queuedir)
+        self.tasksfile = os.path.join(self.queuedir, 'tasks.json')
+        self.lockfile = os.path.join(self.queuedir, 'queue.lock')
+        self.cursorfile = os.path.join(self.queuedir, 'cursor.json')
+
+        self.leasesdir = os.path.join(self.queuedir, 'leases')
+        self.donedir = os.path.join(self.queuedir, 'done')
+        self.logsdir = os.path.join(self.queuedir, 'logs')
+
+        self.content = None
+
+    def create(self, dirs, command, lease_time=600, max_attempts=3):
+        """Create the queue with one task per folder of dirs"""
+
+        if os.path.isfile(self.tasksfile):
+            raise ValueError("Queue already exists in %s!"%self.queuedir)
+
+        dirs = [dir for dir in dirs if os.path.isdir(dir)]
+        if not dirs:
+            raise ValueError("No folder found to create the queue!")
+        # folders should all have the same architecture
+        dbxtools.check_directories(dirs)
+
+        for dir in [self.queuedir, self.leasesdir, self.donedir, self.logsdir]:
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+
+        self.content = {'command': command, 'lease_time': lease_time, 'max_attempts': max_attempts, \
+'tasks': [os.path.abspath(dir) for dir in dirs]}
+        write_json(self.tasksfile, self.content)
+
+    def load(self):
+
+        if self.content is None:
+            if not os.path.isfile(self.tasksfile):
+                raise ValueError("No queue found in %s!"%self.queuedir)
+            with open(self.tasksfile, 'r') as tf:
+                self.content = json.load(tf)
+        return self.content
+
+    def get_time(self):
+        """Get current time of the shared file system (the same clock for the workers of every node)"""
+        return get_shared_time(self.lockfile)
+
+    def get_task_name(self, idx):
+        return 'task-%i'%(idx+1)
+
+    def get_lease_file(self, idx):
+        return os.path.join(self.leasesdir, self.get_task_name(idx))
+
+    def get_done_file(self, idx):
+        return os.path.join(self.donedir, self.get_task_name(idx))
+
+    def get_log_file(self, idx):
+        return os.path.join(self.logsdir, 'task-%i.log'%(idx+1))
+
+    def read_lease(self, idx):
+        """Get lease of task idx (worker, host, attempt, time it was started and last renewed) or None if the task is not leased"""
+
+        try:
+            with open(self.get_lease_file(idx), 'r') as lf:
+                return json.load(lf)
+        except (IOError, ValueError):
+            return None
+
+    def read_done(self, idx):
+        """Get exit status of task idx or None if the task is not done"""
+
+        try:
+            with open(self.get_done_file(idx), 'r') as df:
+                return json.load(df)
+        except (IOError, ValueError):
+            return None
+
+    def read_cursor(self):
+        """Get index of the first task not done (0 if the cursor was never written)"""
+
+        try:
+            with open(self.cursorfile, 'r') as cf:
+                return json.load(cf)
+        except (IOError, ValueError):
+            return 0
+
+    def is_expired(self, lease, now):
+        return now - lease['renewed'] > self.load()['lease_time']
+
+    def claim(self, worker):
+        """Claim the first task available (pending or whose lease expired), returns its index or None"""
+
+        content = self.load()
+        ntasks = len(content['tasks'])
+        with FileLock(self.lockfile):
+            now = self.get_time()
+            # list the queue once per claim, only the leases of running tasks are read
+            done = set(os.listdir(self.donedir))
+            leased = set(os.listdir(self.leasesdir))
+
+            cursor = self.read_cursor()
+            first = cursor
+            while first < ntasks and self.get_task_name(first) in done:
+                first += 1
+            if first != cursor:
+                write_json(self.cursorfile, first)
+
+            for idx in range(first, ntasks):
+                name = self.get_task_name(idx)
+                if name in done:
+                    continue
+
+                attempt = 1
+                lease = self.read_lease(idx) if name in leased else None
+                if lease is not None:
+                    if not self.is_expired(lease, now):
+                        continue
+                    # worker holding the lease is dead, requeue the task
+                    if lease['attempt'] >= content['max_attempts']:
+                        write_json(self.get_done_file(idx), {'status': None, 'worker': lease['worker'], \
+'message': 'lease expired %i times'%lease['attempt']})
+                        os.remove(self.get_lease_file(idx))
+                        continue
+                    print "Lease of task %i (%s) expired, requeued"%(idx+1, lease['worker'])
+                    attempt = lease['attempt'] + 1
+
+                write_json(self.get_lease_file(idx), {'worker': worker, 'host': socket.gethostname(), 'attempt': attempt, \
+'started': now, 'renewed': now})
+                return idx
+        return None
+
+    def holds_lease(self, idx, worker):
+        lease = self.read_lease(idx)
+        return lease is not None and lease['worker'] == worker
+
+    def renew(self, idx, worker):
+        """Renew the lease of task idx, returns False if the lease is no longer held by worker"""
+
+        with FileLock(self.lockfile):
+            lease = self.read_lease(idx)
+            if lease is None or lease['worker'] != worker:
+                return False
+            lease['renewed'] = self.get_time()
+            try:
+                write_json(self.get_lease_file(idx), lease)
+            except (IOError, OSError):
+                return False
+        return True
+
+    def release(self, idx, worker, status=None):
+        """Release the lease of task idx, the task is marked as done if status is not None"""
+
+        with FileLock(self.lockfile):
+            if not self.holds_lease(idx, worker):
+                return
+            if status is not None:
+                lease = self.read_lease(idx)
+                write_json(self.get_done_file(idx), {'status': status, 'worker': worker, \
+'time': self.get_time() - lease['started']})
+            os.remove(self.get_lease_file(idx))
+
+    def requeue_failed(self):
+        """Requeue tasks which failed, returns the number of tasks requeued"""
+
+        content = self.load()
+        requeued = []
+        with FileLock(self.lockfile):
+            for idx in range(len(content['tasks'])):
+                done = self.read_done(idx)
+                if done is not None and done['status'] != 0:
+                    os.remove(self.get_done_file(idx))
+                    requeued.append(idx)
+            # move the cursor back to the first task requeued
+            if requeued and requeued[0] < self.read_cursor():
+                write_json(self.cursorfile, requeued[0])
+        return len(requeued)
+
+    def get_status(self):
+        """Get state of every task: pending, running, expired (to be requeued), done or failed"""
+
+        content = self.load()
+        now = self.get_time()
+        states = []
+        for idx in range(len(content['tasks'])):
+            done = self.read_done(idx)
+            if done is not None:
+                if done['status'] == 0:
+                    states.append(('done', done))
+                else:
+                    states.append(('failed', done))
+                continue
+            lease = self.read_lease(idx)
+            if lease is None:
+                states.append(('pending', None))
+            elif self.is_expired(lease, now):
+                states.append(('expired', lease))
+            else:
+                states.append(('running', lease))
+        return states
+
+    def is_finished(self):
+        return all(state in ['done', 'failed'] for state, info in self.get_status())
+
+    def print_status(self, verbose=False):
+
+        content = self.load()
+        states = self.get_status()
+        ntasks = len(states)
+
+        counts = {}
+        for state, info in states:
+            counts[state] = counts.get(state, 0) + 1
+
+        print "Queue %s: %i tasks"%(self.queuedir, ntasks)
+        for state in ['pending', 'running', 'expired', 'done', 'failed']:
+            print "%-8s %6i (%5.1f%%)"%(state, counts.get(state, 0), counts.get(state, 0)*100.0/ntasks)
+
+        times = [info['time'] for state, info in states if state == 'done' and 'time' in info]
+        if times:
+            print "Average time per task: %.1f s"%(sum(times)/len(times))
+
+        workers = set(info['worker'] for state, info in states if state == 'running')
+        print "Active workers: %i"%len(workers)
+
+        if verbose:
+            now = self.get_time()
+            for idx, (state, info) in enumerate(states):
+                if state in ['running', 'expired']:
+                    print "%s task %i (%s): %s, attempt %i, started %i s ago"%(state, idx+1, content['tasks'][idx], \
+info['worker'], info['attempt'], now - info['started'])
+                elif state == 'failed':
+                    if info['status'] is None:
+                        print "failed task %i (%s): %s"%(idx+1, content['tasks'][idx], info['message'])
+                    else:
+                        print "failed task %i (%s): exit status %i, check %s"%(idx+1, content['tasks'][idx], \
+info['status'], self.get_log_file(idx))
+
+def write_json(filename, content):
+    """Write JSON file atomically (readers never see incomplete files)"""
+
+    tmpfile = filename + '.tmp-%s-%i'%(socket.gethostname(), os.getpid())
+    with open(tmpfile, 'w') as tf:
+        json.dump(content, tf)
+    os.rename(tmpfile, filename)
+
+def kill_process(process, grace_period=5):
+    """Kill process and its children (process should be started in its own process group)"""
+
+    for signum in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, signum)
+        except OSError:
+            pass
+        t0 = time.time()
+        while process.poll() is None and time.time() - t0 < grace_period:
+            time.sleep(0.1)
+        if process.returncode is not None:
+            break
+    process.wait()
+
+def sigterm_handler(signum, frame):
+    # batch schedulers stop jobs with SIGTERM, exit cleanly to release the lease
+    sys.exit(128 + signum)
+
+def run_task(queue, idx, worker):
+    """Run the command of the queue in the folder of task idx while renewing the lease, returns the exit status
+    or None if the lease was lost"""
+
+    content = queue.load()
+    workdir = content['tasks'][idx]
+    # renew 10 times per lease period so that slow file systems do not make leases expire
+    interval = content['lease_time'] / 10.0
+
+    print "Running task %i (%s) on %s"%(idx+1, workdir, worker)
+    sys.stdout.flush()
+
+    with open(queue.get_log_file(idx), 'w') as logf:
+        process = subprocess.Popen(content['command'], shell=True, executable='/bin/bash', cwd=workdir, \
+stdout=logf, stderr=subprocess.STDOUT, preexec_fn=os.setpgrp)
+
+    stop = threading.Event()
+    lost = []
+    def heartbeat():
+        while not stop.wait(interval):
+            if not queue.renew(idx, worker):
+                lost.append(True)
+                kill_process(process)
+                return
+
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while process.poll() is None:
+            time.sleep(0.5)
+    except BaseException:
+        stop.set()
+        kill_process(process)
+        # task is requeued right away
+        queue.release(idx, worker)
+        raise
+    finally:
+        stop.set()
+        thread.join()
+
+    if lost:
+        print "Lease of task %i lost, task stopped"%(idx+1)
+        return None
+
+    status = process.returncode
+    queue.release(idx, worker, status=status)
+    if status != 0:
+        print "Error: task %i failed, check %s file for more details!"%(idx+1, queue.get_log_file(idx))
+    return status
+
+def run_worker(queuedir, wait=True, max_tasks=None):
+    """Claim and run tasks of the queue until every task is done, returns the number of tasks run"""
+
+    queue = WorkQueue(queuedir)
+    content = queue.load()
+    worker = '%s:%i'%(socket.gethostname(), os.getpid())
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    ntasks = 0
+    while max_tasks is None or ntasks < max_tasks:
+        idx = queue.claim(worker)
+        if idx is None:
+            # tasks of other workers are requeued when their leases expire
+            if wait and not queue.is_finished():
+                time.sleep(content['lease_time'] / 10.0)
+                continue
+            break
+        run_task(queue, idx, worker)
+        ntasks += 1
+    return ntasks
+
+def run_worker_job(job):
+    return run_worker(*job)
+
+class DbxWorkQueue(object):
+
+    def create_arg_parser(self):
+        parser = argparse.ArgumentParser(description="""dbx_workqueue : run docking folders (%s*/%s*/%s*) from a queue
+shared by workers on multiple nodes"""%(dbxtools.ligdir_prefix, dbxtools.tardir_prefix, dbxtools.isodir_prefix))
+
+        parser.add_argument('action',
+            choices=['init', 'worker', 'status', 'requeue'],
+            help='init: create the queue, worker: run tasks of the queue, status: print progress of the queue, \
+requeue: requeue failed tasks')
+
+        parser.add_argument('-q',
+            dest='queuedir',
+            default='dbx_queue',
+            metavar='DIRECTORY',
+            help='Folder of the queue (should be on a file system shared by the workers). Default: dbx_queue')
+
+        parser.add_argument('-dirs',
+            dest='dirs',
+            nargs='+',
+            metavar=('DIR1', 'DIR2'),
+            help='(init) Folders to be run (one task per folder)')
+
+        parser.add_argument('-cmd',
+            dest='command',
+            metavar='COMMAND',
+            help='(init) Command run in each folder (e.g., "rundbx -l ligand.mol2 -r target.pdb -f config.ini -resume")')
+
+        parser.add_argument('-lease_time',
+            dest='lease_time',
+            type=int,
+            default=600,
+            metavar='SECONDS',
+            help='(init) Time after which the task of a worker which stopped renewing its lease is requeued. Default: 600')
+
+        parser.add_argument('-max_attempts',
+            dest='max_attempts',
+            type=int,
+            default=3,
+            help='(init) Maximum number of times a task is claimed after a lease expired. Default: 3')
+
+        parser.add_argument('-nprocs',
+            dest='nprocs',
+            type=int,
+            default=1,
+            help='(worker) Number of workers started (0: use all the cores). Default: 1')
+
+        parser.add_argument('-nowait',
+            dest='wait',
+            action='store_false',
+            default=True,
+            help='(worker) Stop when no task is available instead of waiting for tasks of other workers to be done \
+or requeued')
+
+        parser.add_argument('-v',
+            dest='verbose',
+            action='store_true',
+            default=False,
+            help='(status) Print running and failed tasks')
+
+        return parser
+
+    def run(self):
+
+        parser = self.create_arg_parser()
+        args = parser.parse_args()
+
+        queue = WorkQueue(args.queuedir)
+        if args.action == 'init':
+            if not args.dirs or not args.command:
+                parser.error("options -dirs and -cmd are required to create a queue")
+            queue.create(args.dirs, args.command, lease_time=args.lease_time, max_attempts=args.max_attempts)
+            print "Queue of %i tasks created in %s"%(len(queue.load()['tasks']), queue.queuedir)
+
+        elif args.action == 'worker':
+            nprocs = parallel.get_nprocs(args.nprocs)
+            parallel.run_jobs(run_worker_job, [(args.queuedir, args.wait) for idx in range(nprocs)], nprocs=nprocs)
+
+        elif args.action == 'status':
+            queue.print_status(verbose=args.verbose)
+
+        elif args.action == 'requeue':
+            print "%i failed tasks requeued"%queue.requeue_failed()
@@ -1,6 +1,13 @@
+import os
 import sys
+import shutil
+import tempfile
 import numpy as np
 
+from distutils.ccompiler import new_compiler
+from distutils.sysconfig import customize_compiler
+from distutils.errors import CompileError, LinkError
+
 from setuptools import setup, Extension
 from Cython.Distutils import build_ext
 from Cython.Build import cythonize
@@ -14,15 +21,44 @@ except AttributeError:
 if not (sys.version_info[0] == 2 and sys.version_info[1] >= 6):
     sys.exit("You need Python 2.6.x or Python 2.7.x to install the DockBox package!")
 
+def has_openmp():
+    """Check that the C compiler can build and link a program using OpenMP"""
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        srcfile = os.path.join(tmpdir, 'check_openmp.c')
+        with open(srcfile, 'w') as sf:
+            sf.write("#include <omp.h>\nint main(void) { return omp_get_max_threads() < 1; }\n")
+
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        objects = compiler.compile([srcfile], output_dir=tmpdir, extra_postargs=['-fopenmp'])
+        compiler.link_executable(objects, os.path.join(tmpdir, 'check_openmp'), extra_postargs=['-fopenmp'])
+    except (CompileError, LinkError):
+        return False
+    finally:
+        shutil.rmtree(tmpdir)
+    return True
+
+# batched RMSD functions run their pairs in parallel with OpenMP,
+# prange loops run serially if the compiler does not support it
+if has_openmp():
+    openmp_args = ['-fopenmp']
+else:
+    print "OpenMP not supported by the C compiler, RMSD functions will run serially"
+    openmp_args = []
+
 ext_modules = [Extension(
     name='dockbox.pyqcprot',
     sources=["dockbox/pyqcprot.pyx"],
-    include_dirs=[numpy_include])]
+    include_dirs=[numpy_include],
+    extra_compile_args=openmp_args,
+    extra_link_args=openmp_args)]
 
 setup(name='dockbox',
     version='1.3',
     packages=['dockbox'],
-    scripts=['bin/rundbx', 'bin/extract_dbx_best_poses'],
+    scripts=['bin/rundbx', 'bin/extract_dbx_best_poses', 'bin/dbx_workqueue', 'bin/export_dbx_poses'],
     install_requires=['mdkit', 'pandas==0.23.4', 'nwalign', 'oldnumeric'],
     ext_modules = cythonize(ext_modules),
     license='LICENSE.txt',
@@ -0,0 +1,55 @@
+"""Small structures written on the fly for the tests"""
+
+import numpy as np
+
+def write_mol2(filename, coords, types, bonds=(), name='LIG'):
+    """Write a .mol2 file with one structure (bonds given as pairs of 1-based atom indices)"""
+
+    with open(filename, 'w') as mol2f:
+        mol2f.write('@<TRIPOS>MOLECULE\n%s\n%5i %5i     1     0     0\nSMALL\nUSER_CHARGES\n\n'%(name, len(coords), len(bonds)))
+        mol2f.write('@<TRIPOS>ATOM\n')
+        for idx, (xyz, type) in enumerate(zip(coords, types)):
+            mol2f.write('%7i %-6s %10.4f%10.4f%10.4f %-6s %4i  %-6s %9.4f\n'%(idx+1, type.split('.')[0]+str(idx+1), \
+xyz[0], xyz[1], xyz[2], type, 1, name, 0.0))
+        mol2f.write('@<TRIPOS>BOND\n')
+        for idx, (atom1, atom2) in enumerate(bonds):
+            mol2f.write('%6i %5i %5i    1\n'%(idx+1, atom1, atom2))
+
+def write_dock_pose(filename, coords, types, bonds, score, next_score=None, name='LIG'):
+    """Write a pose as split from a DOCK output file: comment lines with the scores of the pose before the structure
+    and comment lines of the next pose (if next_score is given) at the end"""
+
+    def get_comments(score):
+        return ''.join('##########%30s:%20s\n'%(key, value) for key, value in [('Name', name), ('Grid Score', '%.6f'%score),
+            ('Grid_vdw_energy', '%.6f'%(0.8*score)), ('Grid_es_energy', '%.6f'%(0.2*score))]) + '\n'
+
+    write_mol2(filename, coords, types, bonds, name=name)
+    with open(filename, 'r') as mol2f:
+        structure = mol2f.read()
+    with open(filename, 'w') as mol2f:
+        mol2f.write(get_comments(score) + structure)
+        if next_score is not None:
+            mol2f.write('\n' + get_comments(next_score))
+
+def get_ligand(seed=0, nheavy=6, nhydrogens=2):
+    """Get coordinates, types and bonds of a chain of nheavy carbons followed by nhydrogens hydrogens"""
+
+    rng = np.random.RandomState(seed)
+    # coordinates as written in the files
+    coords = np.round(np.cumsum(rng.uniform(-1.0, 1.0, size=(nheavy+nhydrogens, 3)), axis=0), 4)
+    types = ['C.3']*nheavy + ['H']*nhydrogens
+    bonds = [(idx, idx+1) for idx in range(1, nheavy)] + [(nheavy, nheavy+idx+1) for idx in range(nhydrogens)]
+    return coords, types, bonds
+
+def write_pdb(filename, residues, coords):
+    """Write a PDB file with one ATOM line per atom (residues given as (name, number, [atom names]))"""
+
+    idx = 0
+    with open(filename, 'w') as pdbf:
+        for resname, resnum, atoms in residues:
+            for atom in atoms:
+                x, y, z = coords[idx]
+                pdbf.write('ATOM  %5i  %-3s %3s A%4i    %8.3f%8.3f%8.3f  1.00  0.00           %s\n'%(idx+1, atom, resname, \
+resnum, x, y, z, atom[0]))
+                idx += 1
+        pdbf.write('END\n')
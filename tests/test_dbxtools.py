@@ -0,0 +1,388 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import nwalign as nw
+
+from dockbox import cache
+from dockbox import dbxtools
+from dockbox import pyqcprot
+
+import samples
+
+# residues of the receptors written by the tests (LYN and HIE are equivalent to LYS and HIS, ACE is not a residue
+# of the sequence), backbone atoms and CB
+residues = [('ACE', ['C', 'O']), ('ALA', ['N', 'CA', 'C', 'O', 'CB']), ('GLY', ['N', 'CA', 'C', 'O']), ('SER', ['N', 'CA', 'C', 'O', 'CB']),
+    ('LYN', ['N', 'CA', 'C', 'O', 'CB']), ('VAL', ['N', 'CA', 'C', 'O', 'CB']), ('HIE', ['N', 'CA', 'C', 'O', 'CB']),
+    ('ASP', ['N', 'CA', 'C', 'O', 'CB']), ('GLY', ['N', 'CA', 'C', 'O']), ('TRP', ['N', 'CA', 'C', 'O', 'CB'])]
+
+def get_sequence_reference(filename):
+    """Sequence and residue numbers of a PDB file as read before read_receptor"""
+
+    indices = []
+    sequence = ''
+    with open(filename, 'r') as pdbf:
+        for line in pdbf:
+            if line.startswith('ATOM'):
+                resnum = line[22:26].strip()
+                resname = line[17:20].strip()
+                resname = dbxtools.equivalent_residues.get(resname, resname)
+                if resnum not in indices and resname in dbxtools.residues_3_to_1:
+                    sequence += dbxtools.residues_3_to_1[resname]
+                    indices.append(resnum)
+    return sequence, indices
+
+def get_transform_reference(file1, file2):
+    """Superimpose 2 targets as done before read_receptor (each file read several times, atoms matched one by one)"""
+
+    seq1, ind1 = get_sequence_reference(file1)
+    seq2, ind2 = get_sequence_reference(file2)
+    alignment = nw.global_align(seq1, seq2)
+
+    ind1new = []
+    ind2new = []
+    idx1, idx2 = 0, 0
+    for idx in range(len(alignment[0])):
+        if (idx < min(len(seq1), len(seq2))) and seq1[idx] == seq2[idx] and seq1[idx] != '-':
+            ind1new.append(ind1[idx1])
+            ind2new.append(ind2[idx2])
+        if (idx < len(seq1)) and seq1[idx] != '-':
+            idx1 += 1
+        if (idx < len(seq2)) and seq2[idx] != '-':
+            idx2 += 1
+
+    coords = []
+    for filename, indices in [(file1, ind1new), (file2, ind2new)]:
+        coords_file = dict((resnum, []) for resnum in indices)
+        with open(filename, 'r') as pdbf:
+            for line in pdbf:
+                if line.startswith('ATOM') and line[22:26].strip() in coords_file and line[12:16].strip() in ['CA', 'C', 'N', 'O']:
+                    coords_file[line[22:26].strip()].append([line[12:16].strip(), float(line[30:38]), float(line[38:46]), float(line[46:54])])
+        coords.append([coords_file[resnum] for resnum in indices])
+
+    new_coords1 = []
+    new_coords2 = []
+    for idx, (coords1_res, coords2_res) in enumerate(zip(*coords)):
+        if set(item[0] for item in coords1_res) != set(item[0] for item in coords2_res):
+            sys.exit("Inconsistency found in residue %s in file %s and residue %s in file %s! Missing atom suspected..."%(ind1new[idx], \
+file1, ind2new[idx], file2))
+        for an1, x1, y1, z1 in coords1_res:
+            for an2, x2, y2, z2 in coords2_res:
+                if an1 == an2:
+                    new_coords1.append([x1, y1, z1])
+                    new_coords2.append([x2, y2, z2])
+                    break
+
+    new_coords1 = np.array(new_coords1).T
+    new_coords2 = np.array(new_coords2).T
+    trans1 = -new_coords1[:,0]
+    trans2 = -new_coords2[:,0]
+
+    rotation = np.zeros(9)
+    pyqcprot.CalcRMSDRotationalMatrix(new_coords1, new_coords2, rotation, None)
+    return rotation.reshape((3, 3)), trans1 + new_coords1[:,0], trans2 + new_coords2[:,0]
+
+class DbxToolsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def write_pose(self, name, coords, types, bonds):
+        filename = os.path.join(self.workdir, name)
+        samples.write_mol2(filename, coords, types, bonds)
+        return filename
+
+class ClusterTest(DbxToolsTest):
+
+    def test_rmsd_matrix(self):
+        coords = np.random.RandomState(0).uniform(-10.0, 10.0, size=(5, 7, 3))
+        rmsd = [[np.sqrt(np.mean(np.sum((coords1 - coords2)**2, axis=1))) for coords2 in coords] for coords1 in coords]
+
+        # round-off errors of the squared distances are amplified by the square root close to 0
+        np.testing.assert_allclose(dbxtools.compute_rmsd_matrix(coords), rmsd, atol=1e-6)
+
+    def test_cluster_poses(self):
+        coords, types, bonds = samples.get_ligand(seed=1)
+        coords_other, types_other, bonds_other = samples.get_ligand(seed=2, nheavy=4)
+
+        # shifts of 0.1 and 0.05 A (RMSD equal to the shift), 3 A and a ligand with less atoms
+        mol2files = [self.write_pose('pose-1.mol2', coords, types, bonds),
+            self.write_pose('pose-2.mol2', coords + [0.1, 0.0, 0.0], types, bonds),
+            self.write_pose('pose-3.mol2', coords + [0.0, 3.0, 0.0], types, bonds),
+            self.write_pose('pose-4.mol2', coords_other, types_other, bonds_other),
+            self.write_pose('pose-5.mol2', coords + [0.0, 2.95, 0.0], types, bonds),
+            self.write_pose('pose-6.mol2', coords + [0.0, 0.0, 0.05], types, bonds)]
+
+        representatives, clusters = dbxtools.cluster_poses(mol2files, 0.5)
+        self.assertEqual(representatives, [0, 2, 3])
+        np.testing.assert_array_equal(clusters, [0, 0, 1, 2, 1, 0])
+
+        # every pose is its own representative below the smallest RMSD
+        representatives, clusters = dbxtools.cluster_poses(mol2files, 0.01)
+        self.assertEqual(representatives, range(6))
+
+class RMSDTest(DbxToolsTest):
+
+    def setUp(self):
+        super(RMSDTest, self).setUp()
+        self.coords, self.types, self.bonds = samples.get_ligand(seed=1)
+        self.heavy_atoms = np.array([type != 'H' for type in self.types])
+
+    def test_compute_rmsd(self):
+        coords2 = samples.get_ligand(seed=2)[0]
+        file1 = self.write_pose('pose-1.mol2', self.coords, self.types, self.bonds)
+        file2 = self.write_pose('pose-2.mol2', coords2, self.types, self.bonds)
+
+        # hydrogens are not taken into account
+        diff = (self.coords - coords2)[self.heavy_atoms]
+        self.assertAlmostEqual(dbxtools.compute_rmsd(file1, file2), np.sqrt(np.mean(np.sum(diff**2, axis=1))), places=10)
+        self.assertTrue(np.isnan(dbxtools.compute_rmsd(file1, float('nan'))))
+
+        # RMSD after superimposing the first pose onto the second
+        rotation = np.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+        trans1 = np.array([1.0, 2.0, 3.0])
+        trans2 = np.array([-1.0, 0.5, 0.0])
+        file3 = self.write_pose('pose-3.mol2', np.dot(self.coords + trans1, rotation.T) - trans2, self.types, self.bonds)
+        self.assertAlmostEqual(dbxtools.compute_rmsd(file1, file3, rotation, trans1, trans2), 0.0, places=10)
+
+    def test_coordinates_cache(self):
+        filename = self.write_pose('pose-1.mol2', self.coords, self.types, self.bonds)
+
+        coords = dbxtools.get_heavy_atom_coordinates(filename)
+        np.testing.assert_allclose(coords, self.coords[self.heavy_atoms])
+        self.assertIs(dbxtools.get_heavy_atom_coordinates(filename), coords)
+        # cached arrays are shared, they cannot be modified
+        self.assertFalse(coords.flags.writeable)
+
+        # a modified file is read again
+        os.utime(filename, (0, 0))
+        np.testing.assert_allclose(dbxtools.get_heavy_atom_coordinates(filename), coords)
+        self.assertIsNot(dbxtools.get_heavy_atom_coordinates(filename), coords)
+
+    def test_cache_size(self):
+        cache_size = dbxtools.coords_cache_size
+        dbxtools.coords_cache.clear()
+        dbxtools.coords_cache_size = 2
+        try:
+            filenames = [self.write_pose('pose-%i.mol2'%(idx+1), self.coords, self.types, self.bonds) for idx in range(3)]
+            coords = [dbxtools.get_heavy_atom_coordinates(filename) for filename in filenames[:2]]
+            # least recently used pose (pose-2) is dropped
+            dbxtools.get_heavy_atom_coordinates(filenames[0])
+            dbxtools.get_heavy_atom_coordinates(filenames[2])
+
+            self.assertEqual(len(dbxtools.coords_cache), 2)
+            self.assertIs(dbxtools.get_heavy_atom_coordinates(filenames[0]), coords[0])
+            self.assertIsNot(dbxtools.get_heavy_atom_coordinates(filenames[1]), coords[1])
+        finally:
+            dbxtools.coords_cache_size = cache_size
+            dbxtools.coords_cache.clear()
+
+class ConsensusTest(DbxToolsTest):
+
+    def setUp(self):
+        super(ConsensusTest, self).setUp()
+        nan = float('nan')
+        ligands = [samples.get_ligand(seed=seed) for seed in range(1, 4)] + [samples.get_ligand(seed=seed, nheavy=4) for seed in range(4, 7)]
+
+        files = {}
+        for idx, (coords, types, bonds) in enumerate(ligands):
+            files[idx] = self.write_pose('pose-%i.mol2'%(idx+1), coords, types, bonds)
+
+        # ligands with different topologies, missing poses and poses of a pair (not involving the first column) with
+        # different numbers of atoms
+        self.files = [[files[0], files[3], files[0], nan, nan],
+            [files[1], files[4], nan, files[1], nan],
+            [files[2], files[5], files[1], files[4], nan]]
+
+    def test_consensus_rmsd(self):
+        rmsd = dbxtools.compute_consensus_rmsd(self.files)
+        self.assertEqual(sorted(rmsd), [(0, 1), (0, 2), (1, 2)])
+
+        for (idx, jdx), rmsd_pair in rmsd.iteritems():
+            rmsd_ref = [dbxtools.compute_rmsd(file1, file2) for file1, file2 in zip(self.files[idx][:3], self.files[jdx][:3])]
+            np.testing.assert_allclose(rmsd_pair[:3], rmsd_ref, atol=1e-10)
+            # missing poses and poses with different numbers of atoms
+            self.assertTrue(np.isnan(rmsd_pair[3:]).all())
+
+    def test_consensus_rmsd_transforms(self):
+        rng = np.random.RandomState(0)
+        nrows = len(self.files[0])
+
+        transforms = []
+        for idx in range(len(self.files)-1):
+            # random rotations (QR decomposition of random matrices) and translations
+            rotmats = np.array([np.linalg.qr(rng.normal(size=(3, 3)))[0] for row in range(nrows)])
+            transforms.append((rotmats, rng.uniform(-5.0, 5.0, size=(nrows, 3)), rng.uniform(-5.0, 5.0, size=(nrows, 3))))
+        rmsd = dbxtools.compute_consensus_rmsd(self.files, transforms=transforms)
+
+        for row in range(3):
+            coords = [None if dbxtools.is_missing(column[row]) else dbxtools.get_heavy_atom_coordinates(column[row]) for column in self.files]
+            for idx, (rotmats, trans1, trans2) in enumerate(transforms):
+                if coords[idx+1] is not None:
+                    coords[idx+1] = np.dot(coords[idx+1] + trans1[row], rotmats[row].T) - trans2[row]
+            for (idx, jdx), rmsd_pair in rmsd.iteritems():
+                if coords[idx] is None or coords[jdx] is None:
+                    self.assertTrue(np.isnan(rmsd_pair[row]))
+                else:
+                    self.assertAlmostEqual(rmsd_pair[row], np.sqrt(np.mean(np.sum((coords[idx] - coords[jdx])**2, axis=1))), places=10)
+            # same RMSD as compute_rmsd for the pairs involving the first column
+            for idx, (rotmats, trans1, trans2) in enumerate(transforms):
+                rmsd_ref = dbxtools.compute_rmsd(self.files[idx+1][row], self.files[0][row], rotmats[row], trans1[row], trans2[row])
+                np.testing.assert_allclose(rmsd[(0, idx+1)][row], rmsd_ref, atol=1e-10)
+        self.assertTrue(np.isnan(rmsd[(1, 2)][3:]).all())
+
+    def test_different_topology(self):
+        # pose with a different number of atoms than the pose of the first column
+        files = [[self.files[0][0]], [float('nan')], [self.files[1][1]]]
+        with self.assertRaises(ValueError) as cm:
+            dbxtools.compute_consensus_rmsd(files)
+        self.assertEqual(str(cm.exception), "Poses %s, %s do not have the same number of non-hydrogen atoms!"%(files[0][0], files[2][0]))
+
+class TargetTest(DbxToolsTest):
+
+    def setUp(self):
+        super(TargetTest, self).setUp()
+        rng = np.random.RandomState(0)
+        self.residues = [(resname, idx+1, atoms) for idx, (resname, atoms) in enumerate(residues)]
+        self.coords = rng.uniform(-20.0, 20.0, size=(sum(len(atoms) for resname, resnum, atoms in self.residues), 3))
+        self.rotation = np.array([[0.0, 0.0, 1.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+
+        self.file_r1 = self.write_receptor('target1.pdb', self.residues, self.coords)
+        # rotated copy of the first target
+        self.file_r2 = self.write_receptor('target2.pdb', self.residues, np.dot(self.coords, self.rotation.T) + 5.0)
+
+    def write_receptor(self, name, residues, coords):
+        filename = os.path.join(self.workdir, name)
+        samples.write_pdb(filename, residues, coords)
+        return filename
+
+    def remove_atoms(self, name, removed):
+        """Write a rotated copy of the first target without the atoms removed (residue number, atom name or None)"""
+
+        kept_residues = []
+        kept_coords = []
+        idx = 0
+        for resname, resnum, atoms in self.residues:
+            kept_atoms = []
+            for atom in atoms:
+                if (resnum, atom) not in removed and (resnum, None) not in removed:
+                    kept_atoms.append(atom)
+                    kept_coords.append(self.coords[idx])
+                idx += 1
+            if kept_atoms:
+                kept_residues.append((resname, resnum, kept_atoms))
+        return self.write_receptor(name, kept_residues, np.dot(kept_coords, self.rotation.T) + 5.0)
+
+    def test_read_receptor(self):
+        receptor = dbxtools.read_receptor(self.file_r1)
+        self.assertIs(dbxtools.read_receptor(self.file_r1), receptor)
+
+        self.assertEqual(receptor['nresidues'], len(residues))
+        self.assertEqual(receptor['sequence'], 'AGSKVHDGW')
+        self.assertEqual((receptor['sequence'], receptor['indices']), get_sequence_reference(self.file_r1))
+        # backbone atoms only
+        self.assertEqual(len(receptor['coords']), sum(len([atom for atom in atoms if atom != 'CB']) for resname, atoms in residues))
+
+    def check_transform(self, file_r2):
+        rotation, trans1, trans2 = dbxtools.get_rmsd_rotation_and_translations(self.file_r1, file_r2)
+        rotation_ref, trans1_ref, trans2_ref = get_transform_reference(self.file_r1, file_r2)
+
+        np.testing.assert_allclose(rotation, rotation_ref, atol=1e-12)
+        np.testing.assert_allclose(trans1, trans1_ref, atol=1e-12)
+        np.testing.assert_allclose(trans2, trans2_ref, atol=1e-12)
+        return rotation, trans1, trans2
+
+    def test_superposition(self):
+        rotation, trans1, trans2 = self.check_transform(self.file_r2)
+        # rotation of the first target onto the second one
+        np.testing.assert_allclose(rotation, self.rotation, atol=1e-6)
+
+    def test_superposition_aligned(self):
+        # residue 6 and the side chain of residue 7 are missing, residues are aligned
+        self.check_transform(self.remove_atoms('target3.pdb', [(6, None), (7, 'CB')]))
+
+    def test_missing_atom(self):
+        file_r3 = self.remove_atoms('target3.pdb', [(3, 'O')])
+        self.assertRaises(SystemExit, get_transform_reference, self.file_r1, file_r3)
+        try:
+            get_transform_reference(self.file_r1, file_r3)
+        except SystemExit as e:
+            message = str(e)
+
+        with self.assertRaises(SystemExit) as cm:
+            dbxtools.get_rmsd_rotation_and_translations(self.file_r1, file_r3)
+        self.assertEqual(str(cm.exception), message)
+
+    def apply_transform(self, coords, rotation, trans1, trans2):
+        return np.dot(coords + trans1, rotation.T) - trans2
+
+    def test_invert_transform(self):
+        transform = dbxtools.get_rmsd_rotation_and_translations(self.file_r1, self.file_r2)
+        inverse = dbxtools.invert_transform(*transform)
+
+        coords = self.apply_transform(self.apply_transform(self.coords, *transform), *inverse)
+        np.testing.assert_allclose(coords, self.coords, atol=1e-10)
+
+    def test_transform_cache(self):
+        transform_cache = cache.TransformCache(os.path.join(self.workdir, 'cache'))
+        key = transform_cache.get_key(self.file_r1, self.file_r2)
+        self.assertNotEqual(key, transform_cache.get_key(self.file_r2, self.file_r1))
+        self.assertIsNone(transform_cache.fetch_transform(key))
+
+        transform = dbxtools.get_rmsd_rotation_and_translations(self.file_r1, self.file_r2)
+        transform_cache.store_transform(key, transform)
+        for array, array_ref in zip(transform_cache.fetch_transform(key), transform):
+            np.testing.assert_array_equal(array, array_ref)
+
+    def test_all_targets(self):
+        files_r = {'target1': self.file_r1, 'target2': self.file_r2, 'target3': self.remove_atoms('target3.pdb', [(6, None)])}
+        # copy of the first target, superimposed with the identity
+        files_r['target4'] = os.path.join(self.workdir, 'target4.pdb')
+        shutil.copyfile(self.file_r1, files_r['target4'])
+
+        get_transform = dbxtools.get_transform
+        computed = []
+        def get_transform_counted(files):
+            computed.append(files)
+            return get_transform(files)
+
+        cachedir = os.path.join(self.workdir, 'cache')
+        dbxtools.get_transform = get_transform_counted
+        try:
+            rmsd_rot_trans = dbxtools.get_rmsd_rotation_and_translations_all_targets(files_r, cachedir=cachedir)
+            # only one transform per pair of different files
+            self.assertEqual(len(computed), 3)
+            # transforms read from the cache
+            rmsd_rot_trans_cached = dbxtools.get_rmsd_rotation_and_translations_all_targets(files_r, cachedir=cachedir)
+            self.assertEqual(len(computed), 3)
+        finally:
+            dbxtools.get_transform = get_transform
+
+        self.assertEqual(sorted(rmsd_rot_trans), sorted(files_r))
+        for key1 in files_r:
+            self.assertEqual(sorted(rmsd_rot_trans[key1]), sorted(files_r))
+            for key2 in files_r:
+                for array, array_ref in zip(rmsd_rot_trans_cached[key1][key2], rmsd_rot_trans[key1][key2]):
+                    np.testing.assert_array_equal(array, array_ref)
+                if key1 == key2 or set([key1, key2]) == set(['target1', 'target4']):
+                    transform_ref = (np.eye(3), np.zeros(3), np.zeros(3))
+                else:
+                    transform_ref = dbxtools.get_rmsd_rotation_and_translations(files_r[key1], files_r[key2])
+                for array, array_ref in zip(rmsd_rot_trans[key1][key2], transform_ref):
+                    np.testing.assert_allclose(array, array_ref, atol=1e-10)
+
+        # pairs specified and several processes
+        pairs = [('target2', 'target3'), ('target3', 'target1')]
+        rmsd_rot_trans_pairs = dbxtools.get_rmsd_rotation_and_translations_all_targets(files_r, pairs=pairs, nprocs=2)
+        for key1, key2 in pairs:
+            self.assertEqual(rmsd_rot_trans_pairs[key1].keys(), [key2])
+            for array, array_ref in zip(rmsd_rot_trans_pairs[key1][key2], rmsd_rot_trans[key1][key2]):
+                np.testing.assert_allclose(array, array_ref, atol=1e-10)
+
+if __name__ == '__main__':
+    unittest.main()
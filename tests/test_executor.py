@@ -0,0 +1,76 @@
+import os
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from dockbox import executor
+
+def square(x):
+    return x*x
+
+class ExecutorTest(unittest.TestCase):
+
+    def test_results_in_order(self):
+        jobs = range(10)
+        self.assertEqual(executor.SerialExecutor().run(square, jobs), [x*x for x in jobs])
+        self.assertEqual(executor.PoolExecutor(nprocs=3).run(square, jobs), [x*x for x in jobs])
+
+class ArrayExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def add_ligand(self, array, name, statuses):
+        """Add a ligand folder with one docking folder per status (exit status of its script)"""
+
+        group = os.path.join(self.workdir, name)
+        os.mkdir(group)
+        for idx, status in enumerate(statuses):
+            dockdir = os.path.join(group, 'dock%i'%(idx+1))
+            os.mkdir(dockdir)
+            with open(os.path.join(dockdir, 'run_dock.sh'), 'w') as sf:
+                sf.write('#!/bin/bash\necho docked\nexit %i\n'%status)
+            os.chmod(os.path.join(dockdir, 'run_dock.sh'), 0755)
+            with open(os.path.join(dockdir, '.dbx_script'), 'w') as mf:
+                mf.write('signature\n')
+            array.add_task(dockdir, 'run_dock.sh', 'dock.log', group)
+        # the command of the group is run once every task of the ligand is done
+        array.add_group(group, 'echo finalized >> finalize.log')
+        return group
+
+    def test_local_runner(self):
+        array = executor.ArrayExecutor(arraydir=os.path.join(self.workdir, 'dbx_array'), nprocs=1)
+        group1 = self.add_ligand(array, 'lig1', [0, 0, 0])
+        group2 = self.add_ligand(array, 'lig2', [0, 1])
+        array.close()
+
+        with open(os.path.join(self.workdir, 'dbx_array', 'manifest.json'), 'r') as mf:
+            self.assertEqual(len(json.load(mf)['tasks']), 5)
+
+        with open(os.devnull, 'w') as devnull:
+            status = subprocess.call([os.path.join(self.workdir, 'dbx_array', 'run_array_local.sh'), '3'], stdout=devnull)
+        # one task failed
+        self.assertEqual(status, 1)
+
+        for group, statuses in [(group1, [0, 0, 0]), (group2, [0, 1])]:
+            with open(os.path.join(group, 'finalize.log'), 'r') as ff:
+                self.assertEqual(ff.read(), 'finalized\n')
+            for idx, status in enumerate(statuses):
+                dockdir = os.path.join(group, 'dock%i'%(idx+1))
+                with open(os.path.join(dockdir, 'dock.log'), 'r') as lf:
+                    self.assertEqual(lf.read(), 'docked\n')
+                # the docking marker is only written for the tasks which succeeded
+                self.assertEqual(os.path.isfile(os.path.join(dockdir, '.dbx_docking')), status == 0)
+
+    def test_no_task(self):
+        array = executor.ArrayExecutor(arraydir=os.path.join(self.workdir, 'dbx_array'))
+        array.close()
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, 'dbx_array')))
+
+if __name__ == '__main__':
+    unittest.main()
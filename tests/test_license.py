@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from dockbox import license
+
+# path of the module, resolved before the tests change directory
+license_exe = os.path.abspath(os.path.splitext(license.__file__)[0] + '.py')
+
+class TokenPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.token_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.token_dir)
+
+    def write_holders(self, holders):
+        with open(os.path.join(self.token_dir, 'moe.json'), 'w') as sf:
+            json.dump({'holders': holders, 'backoff': 0, 'backoff_until': 0}, sf)
+
+    def read_holders(self):
+        with open(os.path.join(self.token_dir, 'moe.json'), 'r') as sf:
+            return json.load(sf)['holders']
+
+    def test_tokens_limited(self):
+        pool1 = license.TokenPool('moe', ntokens=1, token_dir=self.token_dir)
+        pool2 = license.TokenPool('moe', ntokens=1, token_dir=self.token_dir)
+        pool2.holder = 'otherhost:1'
+
+        self.assertTrue(pool1.update_state(pool1.try_acquire))
+        self.assertFalse(pool2.update_state(pool2.try_acquire))
+        pool1.release()
+        self.assertTrue(pool2.update_state(pool2.try_acquire))
+
+    def test_expired_lease_reclaimed_on_any_host(self):
+        now = time.time()
+        self.write_holders({'otherhost:1': now - 1000, 'otherhost:2': now})
+        pool = license.TokenPool('moe', ntokens=2, token_dir=self.token_dir, lease_time=300)
+
+        self.assertTrue(pool.update_state(pool.try_acquire))
+        self.assertEqual(sorted(self.read_holders()), sorted(['otherhost:2', pool.holder]))
+
+    def test_dead_process_reclaimed(self):
+        pool = license.TokenPool('moe', ntokens=1, token_dir=self.token_dir)
+        # pid numbers are smaller than pid_max (at most 2**22 on Linux)
+        self.write_holders({'%s:%i'%(pool.holder.rsplit(':', 1)[0], 2**22+1): time.time()})
+
+        self.assertTrue(pool.update_state(pool.try_acquire))
+
+    def test_holders_of_earlier_versions(self):
+        self.write_holders(['otherhost:1'])
+        pool = license.TokenPool('moe', ntokens=1, token_dir=self.token_dir)
+
+        self.assertFalse(pool.update_state(pool.try_acquire))
+        self.assertEqual(self.read_holders().keys(), ['otherhost:1'])
+
+    def test_lease_renewed(self):
+        pool = license.TokenPool('moe', ntokens=1, token_dir=self.token_dir, lease_time=0.5)
+        pool.acquire()
+        renewed = self.read_holders()[pool.holder]
+
+        pool.start_renewal()
+        time.sleep(1.0)
+        pool.stop_renewal()
+        # the lease would have expired without renewal
+        self.assertGreater(self.read_holders()[pool.holder], renewed)
+
+        pool.release()
+        self.assertEqual(self.read_holders(), {})
+
+class RunCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.curdir = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        self.min_backoff = license.min_backoff
+        license.min_backoff = 0.2
+
+    def tearDown(self):
+        license.min_backoff = self.min_backoff
+        os.chdir(self.curdir)
+        shutil.rmtree(self.workdir)
+
+    def get_fake_command(self, counterfile, nseats, duration):
+        return '%s %s fake %s %i %s'%(sys.executable, license_exe, counterfile, nseats, duration)
+
+    def test_fake_server_refuses_when_full(self):
+        server = license.FakeLicenseServer('counter', 1)
+        self.assertTrue(server.update(1))
+        self.assertEqual(server.run(0, logfile='run.log'), 1)
+        self.assertTrue(license.check_moe_license('run.log'))
+
+        server.update(-1)
+        self.assertEqual(server.run(0), 0)
+
+    def test_command_run_again_after_refusal(self):
+        # seat taken by a run outside the pool, freed after a while
+        server = license.FakeLicenseServer('counter', 1)
+        server.update(1)
+        timer = threading.Timer(0.5, server.update, args=(-1,))
+        timer.start()
+
+        pool = license.TokenPool('moe', ntokens=1, token_dir=os.path.join(self.workdir, 'tokens'))
+        status = license.run_command('moe', 'moebatch.log', self.get_fake_command('counter', 1, 0.1), token_pool=pool)
+        timer.join()
+
+        self.assertEqual(status, 0)
+        with open('license_times.csv', 'r') as tf:
+            lines = tf.readlines()
+        self.assertEqual(len(lines), 2)
+        self.assertGreater(int(lines[1].split(',')[-3]), 1)
+
+        # every seat and token was released
+        with open('counter', 'r') as cf:
+            self.assertEqual(cf.read(), '0')
+        self.assertTrue(pool.update_state(pool.try_acquire))
+
+class SchrodingerMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        # fake jobcontrol listing the jobs written in jobs.txt
+        self.jobsfile = os.path.join(self.workdir, 'jobs.txt')
+        open(self.jobsfile, 'w').close()
+        with open(os.path.join(self.workdir, 'jobcontrol'), 'w') as jf:
+            jf.write('#!/bin/bash\nif [ "$1" == "-list" ]; then cat %s; fi\n'%self.jobsfile)
+        os.chmod(os.path.join(self.workdir, 'jobcontrol'), 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.workdir + ':' + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.workdir)
+
+    def test_list_older_than_submission_refreshed(self):
+        status_cache = license.JobStatusCache(self.workdir, max_age=60)
+        # list made before the submission, still recent enough to be used by other monitors
+        self.assertEqual(status_cache.get_job_list(), '')
+
+        time.sleep(0.01)
+        with open(self.jobsfile, 'w') as jf:
+            jf.write('JobId: host-0-1\n')
+        monitor = license.SchrodingerMonitor('dock.log', 'host-0-1', token_dir=self.workdir)
+        self.assertTrue(monitor.is_running())
+
+    def test_job_done(self):
+        with open(self.jobsfile, 'w') as jf:
+            jf.write('JobId: host-0-1\n')
+        monitor = license.SchrodingerMonitor(os.path.join(self.workdir, 'dock.log'), 'host-0-2', token_dir=self.workdir, min_interval=0.01)
+        self.assertEqual(monitor.wait(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from dockbox import posefilter
+
+import samples
+
+# binding site centered at the origin (name, center, box size as in the configuration file)
+site = ['site1', '0.0, 0.0, 0.0', '10.0, 10.0, 10.0']
+
+class PoseFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def write_poses(self, poses):
+        mol2files = []
+        for idx, (coords, types, bonds) in enumerate(poses):
+            filename = os.path.join(self.workdir, 'pose-%i.mol2'%(idx+1))
+            samples.write_mol2(filename, coords, types, bonds)
+            mol2files.append(filename)
+        return mol2files
+
+    def test_read_pose(self):
+        coords, types, bonds = samples.get_ligand()
+        filename = self.write_poses([(coords, types, bonds)])[0]
+
+        coords_r, types_r, bonds_r = posefilter.read_pose(filename)
+        np.testing.assert_allclose(coords_r, coords)
+        self.assertEqual(types_r, types)
+        # atom indices start from 0
+        self.assertEqual(bonds_r, tuple((atom1-1, atom2-1) for atom1, atom2 in bonds))
+
+    def test_read_dock_pose(self):
+        coords, types, bonds = samples.get_ligand()
+        filename = os.path.join(self.workdir, 'pose-1.mol2')
+        samples.write_dock_pose(filename, coords, types, bonds, -54.784906, next_score=-50.1)
+
+        # comment lines of the next pose at the end of the BOND section are not bonds
+        self.assertEqual(posefilter.read_pose(filename), posefilter.read_pose(self.write_poses([(coords, types, bonds)])[0]))
+
+    def test_box(self):
+        coords, types, bonds = samples.get_ligand()
+        coords = coords - coords.mean(axis=0)
+        mol2files = self.write_poses([(coords, types, bonds), (coords + [10.0, 0.0, 0.0], types, bonds), (coords, types, bonds)])
+
+        kept, counts = posefilter.filter_poses(mol2files, [-5.0]*3, site)
+        np.testing.assert_array_equal(kept, [True, False, True])
+        self.assertEqual(counts.items(), [('box', 1)])
+
+        kept, counts = posefilter.filter_poses(mol2files, [-5.0]*3, site, box=False)
+        self.assertTrue(np.all(kept))
+        self.assertEqual(counts.items(), [])
+
+    def test_extent(self):
+        # linear chains of 3 atoms, 1.5 and 3.0 A between consecutive atoms
+        types = ['C.3']*3
+        bonds = [(1, 2), (2, 3)]
+        mol2files = self.write_poses([([[0.0, 0.0, 0.0], [1.5, 0.0, 0.0], [3.0, 0.0, 0.0]], types, bonds), \
+([[0.0, 0.0, 0.0], [3.0, 0.0, 0.0], [6.0, 0.0, 0.0]], types, bonds)])
+
+        kept, counts = posefilter.filter_poses(mol2files, [0.0, 0.0], site, box=False, max_extent=4.0)
+        np.testing.assert_array_equal(kept, [True, False])
+        self.assertEqual(counts['extent'], 1)
+
+    def test_clash(self):
+        # atoms 1 and 4 are neither bonded nor in the same angle
+        types = ['C.3', 'C.3', 'C.3', 'C.3', 'H']
+        bonds = [(1, 2), (2, 3), (3, 4), (4, 5)]
+        square = [[0.0, 0.0, 0.0], [1.5, 0.0, 0.0], [1.5, 1.5, 0.0], [0.0, 1.5, 0.0], [-1.0, 1.5, 0.0]]
+        folded = [[0.0, 0.0, 0.0], [1.5, 0.0, 0.0], [1.5, 1.5, 0.0], [0.3, 0.5, 0.0], [-1.0, 1.5, 0.0]]
+        # hydrogens are not checked
+        hydrogen = [[0.0, 0.0, 0.0], [1.5, 0.0, 0.0], [1.5, 1.5, 0.0], [0.0, 1.5, 0.0], [0.2, 0.2, 0.0]]
+        mol2files = self.write_poses([(square, types, bonds), (folded, types, bonds), (hydrogen, types, bonds)])
+
+        kept, counts = posefilter.filter_poses(mol2files, [0.0]*3, site, box=False, clash_distance=1.0)
+        np.testing.assert_array_equal(kept, [True, False, True])
+        self.assertEqual(counts['clash'], 1)
+
+    def test_score(self):
+        coords, types, bonds = samples.get_ligand()
+        coords = coords - coords.mean(axis=0)
+        mol2files = self.write_poses([(coords, types, bonds)]*3 + [(coords + [10.0, 0.0, 0.0], types, bonds)])
+
+        # poses without score are kept, a pose can be rejected by several filters
+        kept, counts = posefilter.filter_poses(mol2files, [-8.0, -2.0, np.nan, -1.0], site, max_score=-5.0)
+        np.testing.assert_array_equal(kept, [True, False, True, False])
+        self.assertEqual(counts.items(), [('box', 1), ('score', 2)])
+
+    def test_topologies(self):
+        # poses with different topologies are checked separately
+        ligand1 = samples.get_ligand(seed=1)
+        ligand2 = samples.get_ligand(seed=2, nheavy=4, nhydrogens=1)
+        mol2files = self.write_poses([ligand1, ligand2, ligand1])
+
+        kept, counts = posefilter.filter_poses(mol2files, [0.0]*3, site, box=False, max_extent=0.0)
+        self.assertFalse(np.any(kept))
+        self.assertEqual(counts['extent'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
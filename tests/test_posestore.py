@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from dockbox import posestore
+
+import samples
+
+class PoseArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.posedir = tempfile.mkdtemp()
+
+        # poses 1 and 3 share the same topology
+        self.poses = [samples.get_ligand(seed=1), samples.get_ligand(seed=2, nheavy=4, nhydrogens=3), samples.get_ligand(seed=3)]
+        self.mol2files = []
+        for idx, (coords, types, bonds) in enumerate(self.poses):
+            filename = os.path.join(self.posedir, 'pose-%i.mol2'%(idx+1))
+            samples.write_mol2(filename, coords, types, bonds)
+            self.mol2files.append(filename)
+
+        self.originals = [posestore.read_mol2(filename) for filename in self.mol2files]
+        posestore.write_archive(self.posedir, self.mol2files)
+
+    def tearDown(self):
+        shutil.rmtree(self.posedir)
+
+    def test_archive(self):
+        archive = posestore.get_archive(self.posedir)
+        self.assertEqual(len(archive), 3)
+        self.assertEqual(len(archive.topologies), 2)
+        self.assertIs(posestore.get_archive(self.posedir), archive)
+
+        for idx, (coords, types, bonds) in enumerate(self.poses):
+            heavy_atoms = np.array([type != 'H' for type in types])
+            np.testing.assert_allclose(archive.get_coordinates(idx+1), coords, atol=1e-4)
+            np.testing.assert_allclose(archive.get_coordinates(idx+1, keep_h=False), coords[heavy_atoms], atol=1e-4)
+
+    def test_round_trip(self):
+        outputdir = os.path.join(self.posedir, 'export')
+        os.mkdir(outputdir)
+        filenames = posestore.get_archive(self.posedir).export(outputdir)
+
+        self.assertEqual([os.path.basename(filename) for filename in filenames], ['pose-1.mol2', 'pose-2.mol2', 'pose-3.mol2'])
+        for filename, (lines, coords, signature) in zip(filenames, self.originals):
+            # the files are written again line by line with the same columns
+            self.assertEqual(posestore.read_mol2(filename), (lines, coords, signature))
+
+    def test_poses_read_from_archive(self):
+        for filename in self.mol2files:
+            os.remove(filename)
+        filename = self.mol2files[1]
+
+        # number of poses read from the header of the index without opening the archive
+        posestore.archives.clear()
+        self.assertTrue(posestore.has_pose(filename))
+        self.assertFalse(posestore.has_pose(os.path.join(self.posedir, 'pose-4.mol2')))
+        self.assertEqual(len(posestore.archives), 0)
+        np.testing.assert_allclose(posestore.get_coordinates(filename), self.poses[1][0], atol=1e-4)
+        self.assertEqual(posestore.get_pose_mtime(filename), os.path.getmtime(os.path.join(self.posedir, posestore.index_file)))
+
+        outputfile = os.path.join(self.posedir, 'copy.mol2')
+        posestore.copy_pose(filename, outputfile)
+        self.assertEqual(posestore.read_mol2(outputfile), self.originals[1])
+
+    def test_dock_poses(self):
+        posedir = os.path.join(self.posedir, 'dock')
+        os.mkdir(posedir)
+
+        mol2files = []
+        for idx, (coords, types, bonds) in enumerate([self.poses[0], self.poses[2]]):
+            filename = os.path.join(posedir, 'pose-%i.mol2'%(idx+1))
+            samples.write_dock_pose(filename, coords, types, bonds, -50.0-idx, next_score=-49.0-idx)
+            mol2files.append(filename)
+        posestore.write_archive(posedir, mol2files)
+
+        # scores in the comment lines are not part of the topology
+        archive = posestore.get_archive(posedir)
+        self.assertEqual(len(archive.topologies), 1)
+        self.assertFalse(any(line.startswith('#') for line in archive.topologies[0]))
+        self.assertEqual(posestore.read_mol2(mol2files[0])[2], self.originals[0][2])
+        np.testing.assert_allclose(archive.get_coordinates(2), self.poses[2][0], atol=1e-4)
+
+    def test_archives_cache(self):
+        archives_size = posestore.archives_size
+        posestore.archives.clear()
+        posestore.archives_size = 2
+        try:
+            posedirs = []
+            for idx in range(3):
+                posedir = os.path.join(self.posedir, 'poses%i'%(idx+1))
+                os.mkdir(posedir)
+                posestore.write_archive(posedir, self.mol2files)
+                posedirs.append(posedir)
+
+            archives = [posestore.get_archive(posedir) for posedir in posedirs[:2]]
+            for archive in archives:
+                archive.get_coordinates(1)
+            # least recently used archive (poses2) is closed
+            posestore.get_archive(posedirs[0])
+            posestore.get_archive(posedirs[2])
+
+            self.assertEqual(len(posestore.archives), 2)
+            self.assertIsNotNone(archives[0].coords)
+            self.assertIsNone(archives[1].coords)
+            self.assertIsNot(posestore.get_archive(posedirs[1]), archives[1])
+
+            # a closed archive is mapped again when used
+            np.testing.assert_allclose(archives[1].get_coordinates(2), self.poses[1][0], atol=1e-4)
+        finally:
+            posestore.archives_size = archives_size
+            posestore.archives.clear()
+
+    def test_empty_archive(self):
+        posedir = os.path.join(self.posedir, 'empty')
+        os.mkdir(posedir)
+        posestore.write_archive(posedir, [])
+        self.assertEqual(len(posestore.get_archive(posedir)), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import numpy as np
+
+from dockbox import pyqcprot
+
+def get_rotation(rng):
+    """Get a random rotation matrix"""
+    q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+    q *= np.sign(np.diag(r))
+    if np.linalg.det(q) < 0:
+        q[:,0] *= -1
+    return q
+
+def calc_rmsd_rotation(ref, conf, weights=None):
+    """RMSD and rotation matrix of the single-pair function (structures of shape (N, 3), not modified)"""
+
+    rot = np.zeros(9)
+    rmsd = pyqcprot.CalcRMSDRotationalMatrix(np.ascontiguousarray(ref.T), np.ascontiguousarray(conf.T), rot, weights)
+    return rmsd, rot.reshape((3, 3))
+
+class PyQCProtTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.natoms = 12
+        self.ref = self.rng.uniform(-5.0, 5.0, size=(self.natoms, 3))
+        # rotated and translated copies of the reference with some noise
+        self.confs = np.array([np.dot(self.ref, get_rotation(self.rng).T) + self.rng.normal(size=3) + \
+self.rng.normal(scale=0.5, size=(self.natoms, 3)) for idx in range(7)])
+
+    def test_rotation(self):
+        rotation = get_rotation(self.rng)
+        rmsd, rot = calc_rmsd_rotation(self.ref, np.dot(self.ref, rotation.T) + 1.0)
+        self.assertAlmostEqual(rmsd, 0.0, places=5)
+        np.testing.assert_allclose(rot, rotation, atol=1e-6)
+
+    def test_batch(self):
+        ref = self.ref.copy()
+        confs = self.confs.copy()
+        rmsd, rotations = pyqcprot.CalcRMSDBatch(ref, confs, rotations=True)
+
+        # inputs are not modified
+        np.testing.assert_array_equal(ref, self.ref)
+        np.testing.assert_array_equal(confs, self.confs)
+
+        for k, conf in enumerate(self.confs):
+            rmsd_k, rot_k = calc_rmsd_rotation(self.ref, conf)
+            self.assertAlmostEqual(rmsd[k], rmsd_k, places=10)
+            np.testing.assert_allclose(rotations[k], rot_k, atol=1e-10)
+        np.testing.assert_array_equal(pyqcprot.CalcRMSDBatch(ref, confs), rmsd)
+
+    def test_batch_weights(self):
+        weights = self.rng.uniform(0.5, 2.0, size=self.natoms)
+        rmsd = pyqcprot.CalcRMSDBatch(self.ref, self.confs, weights=weights)
+
+        for k, conf in enumerate(self.confs):
+            rmsd_k, rot_k = calc_rmsd_rotation(self.ref, conf, weights=weights)
+            self.assertAlmostEqual(rmsd[k], rmsd_k, places=10)
+        self.assertTrue(np.all(np.abs(rmsd - pyqcprot.CalcRMSDBatch(self.ref, self.confs)) > 1e-6))
+
+    def test_matrix(self):
+        confs2 = self.confs[:3] + 1.0
+        rmsd, rotations = pyqcprot.CalcRMSDMatrix(self.confs, confs2, rotations=True)
+        self.assertEqual(rmsd.shape, (7, 3))
+
+        for i, conf1 in enumerate(self.confs):
+            for j, conf2 in enumerate(confs2):
+                rmsd_ij, rot_ij = calc_rmsd_rotation(conf1, conf2)
+                self.assertAlmostEqual(rmsd[i, j], rmsd_ij, places=10)
+                np.testing.assert_allclose(rotations[i, j], rot_ij, atol=1e-10)
+
+    def test_symmetric_matrix(self):
+        rmsd, rotations = pyqcprot.CalcRMSDMatrix(self.confs, rotations=True)
+
+        np.testing.assert_array_equal(rmsd, rmsd.T)
+        np.testing.assert_array_equal(np.diag(rmsd), np.zeros(7))
+        for i, conf1 in enumerate(self.confs):
+            for j, conf2 in enumerate(self.confs):
+                if i != j:
+                    # only one of (i, j) and (j, i) is computed, both are equal up to the precision of QCP
+                    rmsd_ij, rot_ij = calc_rmsd_rotation(conf1, conf2)
+                    self.assertAlmostEqual(rmsd[i, j], rmsd_ij, places=6)
+                    np.testing.assert_allclose(rotations[i, j], rot_ij, atol=1e-6)
+        np.testing.assert_array_equal(pyqcprot.CalcRMSDMatrix(self.confs), rmsd)
+
+    def test_empty(self):
+        self.assertEqual(pyqcprot.CalcRMSDBatch(self.ref, np.zeros((0, self.natoms, 3))).shape, (0,))
+        self.assertRaises(ValueError, pyqcprot.CalcRMSDBatch, self.ref, self.confs[:,:-1])
+
+if __name__ == '__main__':
+    unittest.main()
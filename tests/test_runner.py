@@ -0,0 +1,88 @@
+import os
+import time
+import signal
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from dockbox import runner
+
+class JobRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_output_and_status(self):
+        self.assertEqual(runner.check_output('echo docked'), 'docked\n')
+        self.assertEqual(runner.call('exit 3'), 3)
+        self.assertEqual(runner.run('pwd', cwd=self.workdir, stdout=subprocess.PIPE), (0, os.path.realpath(self.workdir)+'\n'))
+
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            runner.check_output('echo failed; exit 2')
+        self.assertEqual((cm.exception.returncode, cm.exception.output), (2, 'failed\n'))
+
+    def test_jobs_run_together(self):
+        job_runner = runner.JobRunner()
+        t0 = time.time()
+        jobs = [job_runner.submit('sleep 0.5; echo %i'%idx, resources={}) for idx in range(4)]
+        self.assertTrue(job_runner.wait(jobs))
+
+        self.assertLess(time.time() - t0, 1.5)
+        self.assertEqual([job.check() for job in jobs], ['0\n', '1\n', '2\n', '3\n'])
+
+    def test_limits(self):
+        job_runner = runner.JobRunner(limits={'cores': 2, 'moe': 1})
+        # the second moe job waits for the first one, the cores job runs alongside
+        jobs = [job_runner.submit('sleep 0.3', resources={'cores': 1, 'moe': 1}),
+            job_runner.submit('sleep 0.3', resources={'cores': 1, 'moe': 1}),
+            job_runner.submit('sleep 0.3', resources={'cores': 1})]
+        self.assertEqual(job_runner.running, [jobs[0], jobs[2]])
+        self.assertEqual(job_runner.queued, [jobs[1]])
+
+        self.assertFalse(job_runner.wait([jobs[1]], timeout=0.1))
+        job_runner.wait()
+        self.assertTrue(all(job.returncode == 0 for job in jobs))
+        self.assertEqual(job_runner.running, [])
+
+    def test_cancel(self):
+        job_runner = runner.JobRunner()
+        startfile = os.path.join(self.workdir, 'started')
+        donefile = os.path.join(self.workdir, 'done')
+        # child process of the shell (in the process group of the job)
+        job = job_runner.submit('(touch %s; sleep 0.5; touch %s) & wait'%(startfile, donefile))
+        queued = job_runner.submit('echo never', resources={'cores': job_runner.limits['cores']})
+
+        while not os.path.isfile(startfile):
+            time.sleep(0.05)
+        job_runner.cancel_all()
+        self.assertTrue(job.cancelled and queued.cancelled)
+        self.assertEqual(job.returncode, -15)
+        self.assertEqual(queued.output, '')
+
+        # the child was killed with the shell
+        time.sleep(1.0)
+        self.assertFalse(os.path.isfile(donefile))
+
+    def test_interrupted_wait(self):
+        job_runner = runner.JobRunner()
+        job = job_runner.submit('sleep 30', resources={})
+
+        # the jobs are cancelled when the wait is interrupted
+        def interrupt(signum, frame):
+            raise KeyboardInterrupt
+        handler = signal.signal(signal.SIGALRM, interrupt)
+        signal.setitimer(signal.ITIMER_REAL, 0.2)
+        try:
+            self.assertRaises(KeyboardInterrupt, job_runner.wait, [job])
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+        self.assertTrue(job.cancelled)
+        self.assertEqual(job_runner.running, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from dockbox import scorestore
+
+class ScoreTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.posedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.posedir)
+
+    def get_table(self):
+        # sites are empty when a single binding site is used
+        return pd.DataFrame({'pose': [1, 2, 3], 'program': ['dock', 'dock', 'vina'], 'site': ['', '', ''], \
+'index_pose': [1, 2, 1], 'score': [-7.5, -6.25, np.nan]}, columns=scorestore.pose_columns + ['score'])
+
+    def test_round_trip(self):
+        scores = self.get_table()
+        scorestore.write_scores(self.posedir, scores)
+
+        self.assertTrue(scorestore.has_scores(self.posedir))
+        self.assertEqual(os.listdir(self.posedir), [scorestore.scores_file])
+        pd.testing.assert_frame_equal(scorestore.read_scores(self.posedir), scores)
+
+    def test_set_scores(self):
+        scorestore.write_scores(self.posedir, self.get_table())
+        scorestore.set_scores(self.posedir, {'dsx': np.array([1.0, 2.0, 3.0])})
+        scorestore.set_scores(self.posedir, {'dsx': np.array([4.0, 5.0, 6.0]), 'colvar': np.array([np.nan, 1.5, 2.5])})
+
+        scores = scorestore.read_scores(self.posedir)
+        self.assertEqual(list(scores.columns), scorestore.pose_columns + ['score', 'dsx', 'colvar'])
+        np.testing.assert_array_equal(scores['dsx'], [4.0, 5.0, 6.0])
+        np.testing.assert_array_equal(scores['colvar'], [np.nan, 1.5, 2.5])
+        np.testing.assert_array_equal(scores['score'], [-7.5, -6.25, np.nan])
+
+    def test_read_score_file(self):
+        filename = os.path.join(self.posedir, 'score.out')
+        with open(filename, 'w') as sf:
+            sf.write('-7.5\nNaN\n\n-6.25\n')
+
+        np.testing.assert_array_equal(scorestore.read_score_file(filename, 3), [-7.5, np.nan, -6.25])
+        # inconsistent number of scores
+        np.testing.assert_array_equal(scorestore.read_score_file(filename, 2), [np.nan, np.nan])
+        np.testing.assert_array_equal(scorestore.read_score_file(os.path.join(self.posedir, 'missing.out'), 1), [np.nan])
+
+if __name__ == '__main__':
+    unittest.main()
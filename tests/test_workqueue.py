@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from dockbox import workqueue
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.curdir = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+
+        self.dirs = []
+        for ligid in ['lig1', 'lig2', 'lig3']:
+            os.makedirs(os.path.join(ligid, 'target1'))
+            self.dirs.append(os.path.join(ligid, 'target1'))
+        self.queue = workqueue.WorkQueue('dbx_queue')
+        self.queue.create(self.dirs, 'echo $PWD > out.txt', lease_time=60, max_attempts=2)
+
+    def tearDown(self):
+        os.chdir(self.curdir)
+        shutil.rmtree(self.workdir)
+
+    def expire_lease(self, idx):
+        # lease renewed for the last time more than lease_time ago
+        lease = self.queue.read_lease(idx)
+        lease['renewed'] -= 3600
+        workqueue.write_json(self.queue.get_lease_file(idx), lease)
+
+    def test_claim(self):
+        self.assertEqual([self.queue.claim('worker1') for idx in range(4)], [0, 1, 2, None])
+
+        lease = self.queue.read_lease(0)
+        self.assertEqual(lease['worker'], 'worker1')
+        self.assertEqual(lease['attempt'], 1)
+        self.assertIn('host', lease)
+        self.assertEqual(lease['started'], lease['renewed'])
+        self.assertEqual([state for state, info in self.queue.get_status()], ['running']*3)
+
+    def test_renew(self):
+        idx = self.queue.claim('worker1')
+        self.expire_lease(idx)
+        self.assertEqual(self.queue.get_status()[idx][0], 'expired')
+
+        self.assertTrue(self.queue.renew(idx, 'worker1'))
+        self.assertEqual(self.queue.get_status()[idx][0], 'running')
+        # only the holder of the lease can renew it
+        self.assertFalse(self.queue.renew(idx, 'worker2'))
+
+    def test_expired_lease_requeued(self):
+        self.queue.claim('worker1')
+        self.expire_lease(0)
+
+        # the task of the dead worker is claimed again
+        self.assertEqual(self.queue.claim('worker2'), 0)
+        self.assertEqual(self.queue.read_lease(0)['attempt'], 2)
+        self.assertFalse(self.queue.renew(0, 'worker1'))
+
+        # at most max_attempts attempts
+        self.expire_lease(0)
+        self.assertEqual(self.queue.claim('worker3'), 1)
+        self.assertEqual(self.queue.get_status()[0][0], 'failed')
+
+    def test_release(self):
+        idx = self.queue.claim('worker1')
+        self.queue.release(idx, 'worker1')
+        self.assertEqual(self.queue.get_status()[idx][0], 'pending')
+
+        idx = self.queue.claim('worker1')
+        self.queue.release(idx, 'worker1', status=1)
+        self.assertEqual(self.queue.get_status()[idx][0], 'failed')
+        self.assertEqual(self.queue.requeue_failed(), 1)
+        self.assertEqual(self.queue.get_status()[idx][0], 'pending')
+
+    def test_cursor(self):
+        for idx in range(2):
+            self.queue.release(self.queue.claim('worker1'), 'worker1', status=0 if idx == 0 else 1)
+        # claims start from the first task not done
+        self.assertEqual(self.queue.claim('worker1'), 2)
+        self.assertEqual(self.queue.read_cursor(), 2)
+        self.assertIsNone(self.queue.claim('worker1'))
+
+        # failed tasks requeued are claimed again
+        self.assertEqual(self.queue.requeue_failed(), 1)
+        self.assertEqual(self.queue.read_cursor(), 1)
+        self.assertEqual(self.queue.claim('worker2'), 1)
+
+    def test_worker(self):
+        self.assertEqual(workqueue.run_worker('dbx_queue', wait=False), 3)
+        self.assertTrue(self.queue.is_finished())
+
+        for idx, dir in enumerate(self.dirs):
+            self.assertEqual(self.queue.read_done(idx)['status'], 0)
+            with open(os.path.join(dir, 'out.txt'), 'r') as of:
+                self.assertEqual(of.read().strip(), os.path.realpath(dir))
+
+if __name__ == '__main__':
+    unittest.main()